@@ -0,0 +1,214 @@
+"""模拟 ChatGPT 网页和对话接口的本地服务器，用于离线性能测试
+
+单独运行:
+
+    python benchmarks/fake_server.py --port 8964 --delay 0.5 --chunks 20
+"""
+import argparse
+import asyncio
+import json
+import random
+import uuid
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+SEND_BUTTON_CLASS = (
+    "absolute p-1 rounded-md text-gray-500 bottom-1.5 right-1 md:bottom-2.5 "
+    "md:right-2 hover:bg-gray-100 dark:hover:text-gray-400 dark:hover:bg-gray-900 "
+    "disabled:hover:bg-transparent dark:disabled:hover:bg-transparent"
+)
+
+CHAT_PAGE = f"""<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>ChatGPT</title></head>
+<body>
+  <nav><a href="#">Updates &amp; FAQ</a></nav>
+  <main id="messages"></main>
+  <form onsubmit="return false">
+    <textarea rows="1"></textarea>
+    <button class="{SEND_BUTTON_CLASS}" type="button">Send</button>
+  </form>
+  <script>
+    const textarea = document.querySelector("textarea");
+    const button = document.querySelector("button");
+    button.addEventListener("click", async () => {{
+      const response = await fetch("backend-api/conversation", {{
+        method: "POST",
+        headers: {{ "Content-Type": "application/json" }},
+        body: JSON.stringify({{ prompt: textarea.value }}),
+      }});
+      const text = await response.text();
+      const div = document.createElement("div");
+      div.textContent = text.length;
+      document.getElementById("messages").appendChild(div);
+      textarea.value = "";
+    }});
+  </script>
+</body>
+</html>
+"""
+
+WORDS = "the quick brown fox jumps over the lazy dog 你好 世界".split()
+
+
+@dataclass
+class Options:
+    delay: float = 0.5
+    chunks: int = 20
+    chunk_delay: float = 0.02
+    words_per_chunk: int = 5
+    rate_429: float = 0.0
+    rate_403: float = 0.0
+
+
+class FakeChatGPT:
+    def __init__(self, options: Options) -> None:
+        self.options = options
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.requests: Dict[str, int] = {}
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while request := await self.read_request(reader):
+                method, path, body = request
+                route = f"{method} {path.split('?')[0]}"
+                self.requests[route] = self.requests.get(route, 0) + 1
+                if method == "GET" and path.startswith("/chat"):
+                    await self.send(writer, 200, "text/html; charset=utf-8", CHAT_PAGE)
+                elif method == "GET" and path.startswith("/api/auth/session"):
+                    await self.send(
+                        writer,
+                        200,
+                        "application/json",
+                        json.dumps({"accessToken": "fake", "expires": "2099-01-01"}),
+                    )
+                elif method == "POST" and path.startswith("/backend-api/conversation"):
+                    await self.conversation(writer, body)
+                else:
+                    await self.send(writer, 404, "text/plain", "not found")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def read_request(
+        reader: asyncio.StreamReader,
+    ) -> Optional[Tuple[str, str, bytes]]:
+        line = await reader.readline()
+        if not line:
+            return None
+        method, path, _ = line.decode().split(" ", 2)
+        length = 0
+        while (header := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            name, _, value = header.decode().partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value.strip())
+        body = await reader.readexactly(length) if length else b""
+        return method, path, body
+
+    @staticmethod
+    async def send(
+        writer: asyncio.StreamWriter, status: int, content_type: str, body: str
+    ) -> None:
+        data = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status} OK\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            "\r\n".encode()
+            + data
+        )
+        await writer.drain()
+
+    async def conversation(self, writer: asyncio.StreamWriter, body: bytes) -> None:
+        options = self.options
+        await asyncio.sleep(options.delay)
+        roll = random.random()
+        if roll < options.rate_429:
+            await self.send(writer, 429, "application/json", '{"detail":"Too many"}')
+            return
+        if roll < options.rate_429 + options.rate_403:
+            await self.send(writer, 403, "text/html", "<html>challenge</html>")
+            return
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            payload = {}
+        conversation_id = payload.get("conversation_id") or str(uuid.uuid4())
+        message_id = str(uuid.uuid4())
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Transfer-Encoding: chunked\r\n"
+            b"\r\n"
+        )
+        text = ""
+        for i in range(options.chunks):
+            text += " ".join(random.choices(WORDS, k=options.words_per_chunk)) + " "
+            if i % 10 == 9:
+                text += "\n\n"
+            event = {
+                "message": {
+                    "id": message_id,
+                    "author": {"role": "assistant"},
+                    "content": {"content_type": "text", "parts": [text]},
+                },
+                "conversation_id": conversation_id,
+                "error": None,
+            }
+            await self.chunk(writer, f"data: {json.dumps(event)}\n\n")
+            await asyncio.sleep(options.chunk_delay)
+        await self.chunk(writer, "data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    @staticmethod
+    async def chunk(writer: asyncio.StreamWriter, data: str) -> None:
+        raw = data.encode()
+        writer.write(f"{len(raw):x}\r\n".encode() + raw + b"\r\n")
+        await writer.drain()
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--delay", type=float, default=0.5, help="首字节延迟，单位：秒")
+    parser.add_argument("--chunks", type=int, default=20, help="每个回复的帧数")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="帧间隔，单位：秒")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="返回 429 的概率")
+    parser.add_argument("--rate-403", type=float, default=0.0, help="返回 403 的概率")
+
+
+def options_from_args(args: argparse.Namespace) -> Options:
+    return Options(
+        delay=args.delay,
+        chunks=args.chunks,
+        chunk_delay=args.chunk_delay,
+        rate_429=args.rate_429,
+        rate_403=args.rate_403,
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8964)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = FakeChatGPT(options_from_args(args))
+    port = await server.start(port=args.port)
+    print(f"fake ChatGPT listening on http://127.0.0.1:{port}/")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,317 @@
+"""离线性能测试
+
+启动本地模拟服务器，构造 OneBot v11 消息事件交给 NoneBot 处理，
+请求经过插件的完整流程：限流、回复缓存、请求合并、排队、账号调度、渲染和发送，
+发送的消息由不连接任何实现端的 BenchBot 记录。
+统计延迟分位数、吞吐量、进程树的峰值内存和浏览器页面数。
+
+不需要访问网络，但需要先运行 playwright install firefox。
+渲染图片还需要 nonebot-plugin-htmlrender 和 playwright install chromium，
+未安装时 long 场景跳过渲染，只测量长回复的发送，结果中的 render 为 false。
+
+    python benchmarks/run.py --scenario all --requests 20 --groups 8
+    python benchmarks/run.py --scenario groups --transport http --output bench.json
+"""
+import argparse
+import asyncio
+import importlib.util
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import nonebot
+from nonebot.adapters.onebot.v11 import (
+    Adapter,
+    Bot,
+    GroupMessageEvent,
+    Message,
+    MessageEvent,
+    PrivateMessageEvent,
+)
+from nonebot.adapters.onebot.v11.event import Sender
+from nonebot.message import handle_event
+
+from fake_server import FakeChatGPT, Options, add_arguments, options_from_args
+
+ROOT = Path(__file__).resolve().parent.parent
+SCENARIOS = ("single", "groups", "long")
+BOT_ID = "10000"
+
+# 插件对失败请求的回复，用于区分失败和正常回复
+FAILURE_REPLIES = (
+    "ChatGPT回复已超时",
+    "请求过多",
+    "token失效",
+    "ChatGPT 服务器返回了非预期的内容",
+    "ChatGPT 目前无法回复您的问题",
+    "ChatGPT 正在",
+)
+LIMITED_REPLIES = ("ChatGPT 冷却中", "本群使用 ChatGPT 过于频繁", "ChatGPT 繁忙中，请在")
+
+# 当前请求中插件发送的消息
+replies: ContextVar[Optional[List[str]]] = ContextVar("replies", default=None)
+message_ids = itertools.count(1)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class Sampler:
+    """定期采样内存占用和浏览器页面数"""
+
+    def __init__(self, dispatcher: Any, interval: float = 0.2) -> None:
+        self.dispatcher = dispatcher
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_pages = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def pages(self) -> int:
+        return sum(
+            len(bot.content.pages) for bot in self.dispatcher.bots if bot.content
+        )
+
+    def sample(self) -> None:
+        from nonebot_plugin_chatgpt.supervisor import process_tree_rss
+
+        self.peak_rss = max(self.peak_rss, process_tree_rss(os.getpid()))
+        self.peak_pages = max(self.peak_pages, self.pages())
+
+    async def run(self) -> None:
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self) -> "Sampler":
+        self.peak_rss = self.peak_pages = 0
+        self.task = asyncio.create_task(self.run())
+        return self
+
+    def __exit__(self, *_) -> None:
+        if self.task:
+            self.task.cancel()
+        self.sample()
+
+
+class BenchBot(Bot):
+    """记录插件发送的消息，不连接任何 OneBot 实现端"""
+
+    async def call_api(self, api: str, **data: Any) -> Any:
+        if (sent := replies.get()) is not None:
+            sent.append(str(data.get("message") or data.get("messages") or ""))
+        return {"message_id": next(message_ids)}
+
+
+def make_event(user_id: int, group_id: Optional[int], prompt: str) -> MessageEvent:
+    fields: Dict[str, Any] = {
+        "time": int(time.time()),
+        "self_id": int(BOT_ID),
+        "post_type": "message",
+        "message_id": next(message_ids),
+        "message": Message(prompt),
+        "original_message": Message(prompt),
+        "raw_message": prompt,
+        "font": 0,
+        "user_id": user_id,
+        "to_me": True,
+    }
+    if group_id is None:
+        return PrivateMessageEvent(
+            message_type="private",
+            sub_type="friend",
+            sender=Sender(user_id=user_id),
+            **fields,
+        )
+    return GroupMessageEvent(
+        message_type="group",
+        sub_type="normal",
+        group_id=group_id,
+        sender=Sender(user_id=user_id, role="member"),
+        **fields,
+    )
+
+
+class Bench:
+    def __init__(self, bot: Bot, args: argparse.Namespace) -> None:
+        self.bot = bot
+        self.args = args
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.limited = 0
+
+    async def chat(self, user_id: int, group_id: Optional[int], prompt: str) -> None:
+        sent: List[str] = []
+        token = replies.set(sent)
+        start = time.perf_counter()
+        try:
+            await handle_event(self.bot, make_event(user_id, group_id, prompt))
+        finally:
+            replies.reset(token)
+        elapsed = time.perf_counter() - start
+        if any(reply.startswith(LIMITED_REPLIES) for reply in sent):
+            self.limited += 1
+        elif not sent or any(reply.startswith(FAILURE_REPLIES) for reply in sent):
+            self.errors += 1
+            print(f"  request failed: {sent}", file=sys.stderr)
+        else:
+            self.latencies.append(elapsed)
+
+    async def single(self) -> None:
+        for i in range(self.args.requests):
+            await self.chat(1, None, f"问题 {i}")
+
+    async def groups(self) -> None:
+        await asyncio.gather(
+            *(
+                self.chat(100 + g, 1000 + g, f"问题 {i}")
+                for i in range(self.args.requests)
+                for g in range(self.args.groups)
+            )
+        )
+
+    async def long(self) -> None:
+        await asyncio.gather(
+            *(
+                self.chat(200 + g, 2000 + g, f"长问题 {g}")
+                for g in range(self.args.groups)
+            )
+        )
+
+
+async def run_scenario(
+    name: str,
+    plugin: Any,
+    bot: Bot,
+    server: FakeChatGPT,
+    base: Options,
+    args: argparse.Namespace,
+) -> Dict[str, Any]:
+    server.options = Options(**vars(base))
+    if name == "long":
+        server.options.chunks = base.chunks * 10
+    bench = Bench(bot, args)
+    with Sampler(plugin.dispatcher) as sampler:
+        start = time.perf_counter()
+        await getattr(bench, name)()
+        elapsed = time.perf_counter() - start
+    total = len(bench.latencies) + bench.errors + bench.limited
+    return {
+        "requests": total,
+        "errors": bench.errors,
+        "limited": bench.limited,
+        "p50": percentile(bench.latencies, 0.50),
+        "p95": percentile(bench.latencies, 0.95),
+        "p99": percentile(bench.latencies, 0.99),
+        "throughput": len(bench.latencies) / elapsed if elapsed else 0.0,
+        "peak_rss_mb": sampler.peak_rss / 1024 / 1024,
+        "peak_pages": sampler.peak_pages,
+    }
+
+
+async def can_render() -> bool:
+    """是否安装了渲染图片需要的 nonebot-plugin-htmlrender 和 Chromium"""
+    if importlib.util.find_spec("nonebot_plugin_htmlrender") is None:
+        return False
+    from playwright.async_api import async_playwright
+
+    async with async_playwright() as playwright:
+        return Path(playwright.chromium.executable_path).exists()
+
+
+def load_plugin(api: str, data: str, render: bool, args: argparse.Namespace) -> Any:
+    nonebot.init(
+        chatgpt_session_token="benchmark",
+        chatgpt_api=api,
+        chatgpt_data=data,
+        chatgpt_transport=args.transport,
+        chatgpt_max_concurrency=args.concurrency,
+        chatgpt_page_pool_size=args.pool_size,
+        chatgpt_timeout=60,
+        chatgpt_image=render,
+        # 限流仍然生效，但容量足够放行所有请求
+        chatgpt_cd_time=1,
+        chatgpt_user_burst=args.requests,
+        chatgpt_response_cache=args.response_cache,
+    )
+    sys.path.insert(0, str(ROOT))
+    return nonebot.load_plugin("nonebot_plugin_chatgpt").module
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(f"startup: {report['startup']:.2f}s, render: {report['render']}")
+    header = f"{'scenario':<10}{'reqs':>6}{'errs':>6}{'lim':>5}"
+    header += f"{'p50':>9}{'p95':>9}{'p99':>9}"
+    print(header + f"{'req/s':>9}{'rss MB':>9}{'pages':>7}")
+    for name, result in report["scenarios"].items():
+        print(
+            f"{name:<10}{result['requests']:>6}{result['errors']:>6}"
+            f"{result['limited']:>5}"
+            f"{result['p50']:>9.3f}{result['p95']:>9.3f}{result['p99']:>9.3f}"
+            f"{result['throughput']:>9.2f}{result['peak_rss_mb']:>9.1f}"
+            f"{result['peak_pages']:>7}"
+        )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--scenario", choices=(*SCENARIOS, "all"), default="all")
+    parser.add_argument("--requests", type=int, default=10, help="每个会话的请求数")
+    parser.add_argument("--groups", type=int, default=8, help="并发的会话数")
+    parser.add_argument("--transport", choices=("browser", "http"), default="browser")
+    parser.add_argument("--concurrency", type=int, default=3)
+    parser.add_argument("--pool-size", type=int, default=1)
+    parser.add_argument(
+        "--response-cache", action="store_true", help="开启回复缓存，相同问题不再请求"
+    )
+    parser.add_argument("--output", type=Path, help="将结果以 JSON 格式写入文件")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    base = options_from_args(args)
+    server = FakeChatGPT(base)
+    port = await server.start()
+    render = await can_render()
+    if not render:
+        print("未安装 Chromium 或 htmlrender，跳过图片渲染", file=sys.stderr)
+    with tempfile.TemporaryDirectory() as data:
+        plugin = load_plugin(f"http://127.0.0.1:{port}/", data, render, args)
+        bot = BenchBot(Adapter(nonebot.get_driver()), BOT_ID)
+        start = time.perf_counter()
+        await plugin.dispatcher.start()
+        startup = time.perf_counter() - start
+        report: Dict[str, Any] = {
+            "args": {k: str(v) for k, v in vars(args).items()},
+            "startup": startup,
+            "render": render,
+            "scenarios": {},
+        }
+        scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+        try:
+            for name in scenarios:
+                print(f"running {name} ...", file=sys.stderr)
+                report["scenarios"][name] = await run_scenario(
+                    name, plugin, bot, server, base, args
+                )
+        finally:
+            await plugin.dispatcher.close()
+            await server.close()
+    report["server_requests"] = server.requests
+    print_report(report)
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
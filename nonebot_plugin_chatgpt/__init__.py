@@ -1,39 +1,64 @@
-from nonebot import on_command, require
-from nonebot.adapters.onebot.v11 import (
-    GroupMessageEvent,
-    Message,
-    MessageEvent,
-    MessageSegment,
-)
+import asyncio
+import json
+import time
+from typing import AsyncGenerator, Optional, Tuple
+
+from nonebot import get_driver, on_command, require
+from nonebot.adapters.onebot.v11 import GroupMessageEvent, Message, MessageEvent
+from nonebot.drivers import URL, HTTPServerSetup, Request, Response, ReverseDriver
 from nonebot.log import logger
 from nonebot.params import CommandArg, _command_arg, _command_start
+from nonebot.permission import SUPERUSER
 from nonebot.rule import to_me
 from nonebot.typing import T_State
 
-from playwright._impl._api_types import Error as PlaywrightAPIError
-
-from .chatgpt import Chatbot
+from .cache import ResponseCache
+from .chatgpt import ChatContext
 from .config import config
-from .data import setting
-from .utils import Session, cooldow_checker, create_matcher
+from .data import flush_setting
+from .delivery import Delivery
+from .dispatcher import ChatBackend, ChatDispatcher, Dispatcher
+from .errors import (
+    BadResponse,
+    BrowserUnavailable,
+    ChatError,
+    ChatTimeout,
+    RateLimited,
+    SessionExpired,
+)
+from .history import EXPORT_LIMIT, HistoryLog, Record
+from .limiter import RateLimiter, SqliteBucketStore, limiter_checker
+from .metrics import metrics
+from .queue import FairQueue, SingleFlight
+from .render import Renderer
+from .storage import create_storage
+from .utils import DEFAULT_SESSION_LIMIT, Session, create_matcher
+from .worker import RemoteDispatcher, WorkerServer
 
 require("nonebot_plugin_apscheduler")
 
 from nonebot_plugin_apscheduler import scheduler
 
-require("nonebot_plugin_htmlrender")
+if config.chatgpt_image:
+    require("nonebot_plugin_htmlrender")
 
-from nonebot_plugin_htmlrender import md_to_pic
 
+worker_socket = config.chatgpt_worker_socket or config.chatgpt_data / "worker.sock"
+
+dispatcher: ChatDispatcher
+if config.chatgpt_worker == "client":
+    dispatcher = RemoteDispatcher(worker_socket)
+else:
+    dispatcher = Dispatcher()
+get_driver().on_shutdown(dispatcher.close)
+get_driver().on_shutdown(flush_setting)
+
+
+@get_driver().on_startup
+async def start_dispatcher() -> None:
+    """在后台启动浏览器，不阻塞机器人启动"""
+    dispatcher.warm_up()
 
-chat_bot = Chatbot(
-    token=setting.token or config.chatgpt_session_token,
-    account=config.chatgpt_account,
-    password=config.chatgpt_password,
-    api=config.chatgpt_api,
-    proxies=config.chatgpt_proxies,
-    timeout=config.chatgpt_timeout,
-)
 
 matcher = create_matcher(
     config.chatgpt_command,
@@ -43,7 +68,104 @@ matcher = create_matcher(
     config.chatgpt_block,
 )
 
-session = Session(config.chatgpt_scope)
+storage = create_storage()
+get_driver().on_shutdown(storage.close)
+
+session = Session(
+    config.chatgpt_scope,
+    storage,
+    limit=config.chatgpt_session_limit,
+    ttl=config.chatgpt_session_ttl,
+)
+
+history = (
+    HistoryLog(
+        config.chatgpt_data / "history",
+        max_size=config.chatgpt_history_max_size * 1024,
+        ttl=config.chatgpt_history_ttl * 86400,
+        limit=session.limit or DEFAULT_SESSION_LIMIT,
+    )
+    if config.chatgpt_history
+    else None
+)
+
+limiter = RateLimiter(
+    user_rate=1 / config.chatgpt_cd_time if config.chatgpt_cd_time > 0 else 0,
+    user_burst=config.chatgpt_user_burst,
+    group_rate=config.chatgpt_group_rate / 60,
+    group_burst=config.chatgpt_group_burst,
+    global_rate=config.chatgpt_global_rate / 60,
+    global_burst=config.chatgpt_global_burst,
+    backoff=config.chatgpt_limit_backoff,
+    recover_time=config.chatgpt_limit_recover_time,
+    store=SqliteBucketStore(config.chatgpt_data / "chatgpt.db")
+    if config.chatgpt_shared
+    else None,
+)
+get_driver().on_shutdown(limiter.store.close)
+
+queue = FairQueue(config.chatgpt_max_concurrency)
+
+if config.chatgpt_worker == "server":
+    worker = WorkerServer(dispatcher, worker_socket, queue)
+    get_driver().on_startup(worker.start)
+    get_driver().on_shutdown(worker.close)
+
+flights: SingleFlight[Tuple[str, ChatContext]] = SingleFlight()
+
+renderer = Renderer(
+    config.chatgpt_image_width,
+    cache_size=config.chatgpt_image_cache_size,
+    cache_dir=config.chatgpt_data / "image_cache"
+    if config.chatgpt_image_cache_persist
+    else None,
+    disk_size=config.chatgpt_image_cache_max_size * 1024 * 1024,
+    workers=config.chatgpt_render_workers,
+    min_length=config.chatgpt_image_min_length,
+)
+
+delivery = Delivery(
+    renderer if config.chatgpt_image else None,
+    split_length=config.chatgpt_split_length,
+    forward_threshold=config.chatgpt_forward_threshold,
+    nickname=next(iter(get_driver().config.nickname), "ChatGPT"),
+)
+
+response_cache = ResponseCache(
+    size=config.chatgpt_response_cache_size,
+    ttl=config.chatgpt_response_cache_ttl,
+    model=config.chatgpt_model if config.chatgpt_response_cache_model else "",
+    limit=session.limit or DEFAULT_SESSION_LIMIT,
+)
+
+metrics.gauge("chatgpt_ready", lambda: int(dispatcher.ready), "浏览器是否已启动完成")
+metrics.gauge(
+    "chatgpt_open_pages",
+    lambda: sum(len(bot.content.pages) for bot in dispatcher.bots if bot.content),
+    "当前打开的浏览器页面数",
+)
+metrics.gauge("chatgpt_queue_depth", lambda: queue.depth, "正在排队的请求数")
+metrics.gauge("chatgpt_queue_running", lambda: queue.running, "正在执行的请求数")
+metrics.gauge("chatgpt_inflight", lambda: len(flights), "正在执行的不同请求数")
+metrics.gauge("chatgpt_sessions", lambda: len(session), "内存中的会话数")
+metrics.gauge("chatgpt_limiter_buckets", lambda: len(limiter), "限流令牌桶数")
+metrics.gauge("chatgpt_limiter_scale", lambda: limiter.scale, "当前速率相对于配置速率的比例")
+metrics.gauge("chatgpt_response_cache_entries", lambda: len(response_cache), "缓存的回复数")
+
+if config.chatgpt_metrics_path and isinstance(get_driver(), ReverseDriver):
+
+    async def export_metrics(request: Request) -> Response:
+        return Response(
+            200,
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+            content=metrics.render(),
+        )
+
+    get_driver().setup_http_server(
+        HTTPServerSetup(
+            URL(config.chatgpt_metrics_path), "GET", "chatgpt_metrics", export_metrics
+        )
+    )
 
 
 def check_purview(event: MessageEvent) -> bool:
@@ -54,44 +176,189 @@ def check_purview(event: MessageEvent) -> bool:
     )
 
 
-@matcher.handle(parameterless=[cooldow_checker(config.chatgpt_cd_time)])
+async def send_stream(stream: AsyncGenerator[str, None]) -> str:
+    """按段落分批发送流式回复，返回尚未发送的内容
+
+    发送失败或被取消时立即关闭 stream，使其中的页面等资源尽快释放
+    """
+    buffer = ""
+    last_send = time.monotonic()
+    try:
+        async for delta in stream:
+            buffer += delta
+            if time.monotonic() - last_send < config.chatgpt_stream_interval:
+                continue
+            cut = buffer.rfind("\n\n")
+            if cut <= 0 or buffer[:cut].count("```") % 2 != 0:
+                continue
+            await delivery.send(matcher, buffer[:cut].strip())
+            buffer = buffer[cut:].lstrip()
+            last_send = time.monotonic()
+    finally:
+        await stream.aclose()
+    return buffer
+
+
+@matcher.handle(parameterless=[limiter_checker(limiter)])
 async def ai_chat(event: MessageEvent, state: T_State) -> None:
-    if not chat_bot.content:
-        await chat_bot.playwright_start()
+    metrics.inc("chatgpt_requests_total")
+    with metrics.request() as stages:
+        try:
+            with metrics.timer("total"):
+                await chat(event, state)
+        finally:
+            if config.chatgpt_metrics_log:
+                record = {
+                    "session": session.id(event),
+                    "stages": {k: round(v, 3) for k, v in stages.items()},
+                }
+                logger.bind(chatgpt=record).info(
+                    f"ChatGPT request metrics: {json.dumps(record)}"
+                )
+
+
+async def chat(event: MessageEvent, state: T_State) -> None:
     message = _command_arg(state) or event.get_message()
     text = message.extract_plain_text().strip()
     if start := _command_start(state):
         text = text[len(start):]
+    sid = session.id(event)
+    if (
+        config.chatgpt_response_cache
+        and not await session.load(event)
+        and sid not in response_cache.pending
+        and (msg := response_cache.get(text))
+    ):
+        response_cache.defer(sid, text)
+        await reply(msg)
+        return
+    if not dispatcher.ready and not await dispatcher.wait_ready(
+        config.chatgpt_startup_wait
+    ):
+        await matcher.finish("ChatGPT 正在启动中，请稍后再试", at_sender=True)
+    # 同一会话中基于相同消息提出的相同问题只发送一次，其余请求等待同一个回复
+    conversation_id, parent_id, _ = (
+        await session.load(event) or [(None, None, None)]
+    )[-1]
+    key = (sid, conversation_id, parent_id, text)
     try:
-        msg = await chat_bot(**session[event]).get_chat_response(text)
-        if (msg == "token失效，请重新设置token") and (
-            chat_bot.session_token != config.chatgpt_session_token
-        ):
-            await chat_bot.set_cookie(config.chatgpt_session_token)
-            msg = await chat_bot(**session[event]).get_chat_response(text)
-    except PlaywrightAPIError as e:
-        error = f"{type(e).__name__}: {e}"
-        logger.opt(exception=e).error(f"ChatGPT request failed: {error}")
-        if type(e).__name__ == "TimeoutError":
-            await matcher.finish(
-                "ChatGPT回复已超时。", at_sender=True
-            )
-        elif type(e).__name__ == "Error":
-            msg = "ChatGPT 目前无法回复您的问题。"
-            if config.chatgpt_detailed_error:
-                msg += f"\n{error}"
-            else:
-                msg += "可能的原因是同时提问过多，问题过于复杂等。"
-            await matcher.finish(
-                msg, at_sender=True
-            )
-    if config.chatgpt_image:
-        if msg.count("```") % 2 != 0:
-            msg += "\n```"
-        img = await md_to_pic(msg, width=config.chatgpt_image_width)
-        msg = MessageSegment.image(img)
-    await matcher.send(msg, at_sender=True)
-    session[event] = chat_bot.conversation_id, chat_bot.parent_id
+        (msg, context), leader = await flights.run(
+            key, lambda: ask(event, sid, text)
+        )
+    except BrowserUnavailable:
+        await matcher.finish("ChatGPT 正在重启，请稍后再试", at_sender=True)
+    except ChatError as e:
+        logger.opt(exception=e).error(f"ChatGPT request failed: {e!r}")
+        if isinstance(e, ChatTimeout):
+            metrics.inc("chatgpt_timeouts_total", stage=e.stage)
+        await matcher.finish(error_message(e), at_sender=True)
+    if not leader:
+        # 分批发送时只有发起请求的一方收到了前面的内容
+        msg = context.reply or msg
+    await reply(msg)
+
+
+async def ask(event: MessageEvent, sid: str, text: str) -> Tuple[str, ChatContext]:
+    """排队并发送请求，返回尚未发送的回复内容和请求上下文"""
+    if config.chatgpt_queue_notice and (ahead := queue.ahead(sid)) is not None:
+        await matcher.send(
+            f"ChatGPT 繁忙中，前面还有 {ahead} 个请求在排队", at_sender=True
+        )
+    async with queue.acquire(sid):
+        context = ChatContext.from_history(await session.load(event))
+        context.sid = sid
+        fresh = context.conversation_id is None
+        replay = response_cache.replay(sid) if fresh else None
+        try:
+            async with dispatcher.acquire(context) as chat_bot:
+                if replay:
+                    # 上一个问题的回复来自缓存，先重放该问题创建会话
+                    parent_id = context.parent_id
+                    try:
+                        await chat_bot.get_chat_response(replay, context)
+                    except ChatError as e:
+                        logger.warning(f"重放缓存的问题失败: {e!r}")
+                    else:
+                        # 立即保存，之后的提问失败时不会丢失重放创建的会话
+                        await session.push(
+                            event,
+                            (
+                                context.conversation_id,
+                                context.parent_id,
+                                context.account,
+                            ),
+                        )
+                        await remember(sid, replay, context, parent_id, True)
+                parent_id = context.parent_id
+                root = context.conversation_id is None
+                try:
+                    msg = await respond(chat_bot, text, context)
+                except SessionExpired:
+                    # 重新登录或换回配置中的 token 后再试一次
+                    token = dispatcher.configured.get(chat_bot.name)
+                    if not await chat_bot.tokens.recover(token):
+                        raise
+                    msg = await respond(chat_bot, text, context)
+        finally:
+            if context.status == 429:
+                await limiter.call(limiter.throttle)
+        await session.push(
+            event, (context.conversation_id, context.parent_id, context.account)
+        )
+        await remember(sid, text, context, parent_id, root)
+    if config.chatgpt_response_cache and fresh and not replay and context.reply:
+        response_cache.put(text, context.reply)
+    return msg, context
+
+
+async def remember(
+    sid: str, prompt: str, context: ChatContext, parent_id: Optional[str], root: bool
+) -> None:
+    """将问答写入对话记录，文件操作在线程中进行"""
+    if history is None or not context.reply:
+        return
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(
+        None,
+        history.append,
+        sid,
+        Record(
+            time.time(),
+            context.conversation_id,
+            context.parent_id,
+            parent_id,
+            root,
+            prompt,
+            context.reply,
+        ),
+    )
+
+
+async def respond(chat_bot: ChatBackend, text: str, context: ChatContext) -> str:
+    if config.chatgpt_stream and not config.chatgpt_image:
+        return await send_stream(chat_bot.stream_chat_response(text, context))
+    return await chat_bot.get_chat_response(text, context)
+
+
+def error_message(error: ChatError) -> str:
+    if isinstance(error, ChatTimeout):
+        return "ChatGPT回复已超时。"
+    if isinstance(error, RateLimited):
+        return "请求过多，请放慢速度"
+    if isinstance(error, SessionExpired):
+        return "token失效，请重新设置token"
+    if isinstance(error, BadResponse):
+        return f"ChatGPT 服务器返回了非预期的内容: HTTP{error.status}\n{error.text}"
+    msg = "ChatGPT 目前无法回复您的问题。"
+    if config.chatgpt_detailed_error:
+        msg += f"\n{type(error).__name__}: {error}"
+    else:
+        msg += "可能的原因是同时提问过多，问题过于复杂等。"
+    return msg
+
+
+async def reply(msg: str) -> None:
+    await delivery.send(matcher, msg)
 
 
 refresh = on_command("刷新对话", aliases={"刷新会话"}, block=True, rule=to_me(), priority=1)
@@ -101,7 +368,8 @@ refresh = on_command("刷新对话", aliases={"刷新会话"}, block=True, rule=
 async def refresh_conversation(event: MessageEvent) -> None:
     if not check_purview(event):
         await import_.finish("当前为公共会话模式, 仅支持群管理操作")
-    del session[event]
+    await session.clear(event)
+    response_cache.replay(session.id(event))
     await refresh.send("当前会话已刷新")
 
 
@@ -109,14 +377,26 @@ export = on_command("导出对话", aliases={"导出会话"}, block=True, rule=t
 
 
 @export.handle()
-async def export_conversation(event: MessageEvent) -> None:
-    if cvst := session[event]:
-        await export.send(
-            f"已成功导出会话:\n"
-            f"会话ID: {cvst['conversation_id'][-1]}\n"
-            f"父消息ID: {cvst['parent_id'][-1]}",
-            at_sender=True,
-        )
+async def export_conversation(event: MessageEvent, arg: Message = CommandArg()) -> None:
+    if cvst := await session.load(event):
+        conversation_id, parent_id, _ = cvst[-1]
+        msg = f"已成功导出会话:\n会话ID: {conversation_id}\n父消息ID: {parent_id}"
+        if history:
+            sid = session.id(event)
+            days = arg.extract_plain_text().strip()
+            loop = asyncio.get_running_loop()
+            if days.isdigit():
+                timestamp = time.time() - int(days) * 86400
+                records = await loop.run_in_executor(
+                    None, history.since, sid, timestamp
+                )
+            else:
+                records = await loop.run_in_executor(
+                    None, history.chain, sid, parent_id, EXPORT_LIMIT
+                )
+            if records:
+                msg += "\n\n" + "\n\n".join(record.format() for record in records)
+        await delivery.send(export, msg)
     else:
         await export.finish("你还没有任何会话记录", at_sender=True)
 
@@ -135,7 +415,8 @@ async def import_conversation(event: MessageEvent, arg: Message = CommandArg())
         await import_.finish("至少需要提供会话ID", at_sender=True)
     if len(args) > 2:
         await import_.finish("提供的参数格式不正确", at_sender=True)
-    session[event] = args.pop(0), args[0] if args else None
+    await session.push(event, (args.pop(0), args[0] if args else None))
+    response_cache.replay(session.id(event))
     await import_.send("已成功导入会话", at_sender=True)
 
 
@@ -146,9 +427,9 @@ save = on_command("保存对话", aliases={"保存会话"}, block=True, rule=to_
 async def save_conversation(event: MessageEvent, arg: Message = CommandArg()) -> None:
     if not check_purview(event):
         await save.finish("当前为公共会话模式, 仅支持群管理操作")
-    if session[event]:
+    if await session.load(event):
         name = arg.extract_plain_text().strip()
-        session.save(name, event)
+        await session.save(name, event)
         await save.send(f"已将当前会话保存为: {name}", at_sender=True)
     else:
         await save.finish("你还没有任何会话记录", at_sender=True)
@@ -159,7 +440,19 @@ check = on_command("查看对话", aliases={"查看会话"}, block=True, rule=to
 
 @check.handle()
 async def check_conversation(event: MessageEvent) -> None:
-    name_list = "\n".join(list(session.find(event).keys()))
+    sid = session.id(event)
+    loop = asyncio.get_running_loop()
+    names = []
+    for name, cvst in (await session.find(event)).items():
+        if history and (
+            record := await loop.run_in_executor(
+                None, history.get, sid, cvst.get("parent_id")
+            )
+        ):
+            names.append(f"{name} [{record.date}] {record.prompt[:20]}")
+        else:
+            names.append(name)
+    name_list = "\n".join(names)
     await check.send(f"已保存的会话有:\n{name_list}", at_sender=True)
 
 
@@ -172,17 +465,29 @@ async def switch_conversation(event: MessageEvent, arg: Message = CommandArg())
         await switch.finish("当前为公共会话模式, 仅支持群管理操作")
     name = arg.extract_plain_text().strip()
     try:
-        session[event] = session.find(event)[name]
+        await session.push(event, (await session.find(event))[name])
+        response_cache.replay(session.id(event))
         await switch.send(f"已切换到会话: {name}", at_sender=True)
     except KeyError:
         await switch.send(f"找不到会话: {name}", at_sender=True)
 
 
-@scheduler.scheduled_job("interval", minutes=config.chatgpt_refresh_interval)
-async def refresh_session() -> None:
-    await chat_bot.refresh_session()
-    setting.token = chat_bot.session_token
-    setting.save()
+@scheduler.scheduled_job("interval", minutes=config.chatgpt_sweep_interval)
+async def sweep_memory() -> None:
+    sessions = session.sweep()
+    buckets = await limiter.call(limiter.sweep)
+    response_cache.sweep()
+    loop = asyncio.get_running_loop()
+    if history:
+        await loop.run_in_executor(None, history.sweep)
+    if images := await loop.run_in_executor(None, renderer.sweep):
+        logger.debug(f"已删除 {images} 张超出大小上限的图片缓存")
+    stats = session.stats()
+    logger.debug(
+        f"已清理 {sessions} 条过期会话和 {buckets} 个限流令牌桶，"
+        f"当前会话数: {stats['entries']}，约占用内存 {stats['memory'] / 1024:.1f} KiB，"
+        f"令牌桶数: {len(limiter)}"
+    )
 
 
 rollback = on_command("回滚对话", aliases={"回滚会话"}, block=True, rule=to_me(), priority=1)
@@ -190,16 +495,30 @@ rollback = on_command("回滚对话", aliases={"回滚会话"}, block=True, rule
 
 @rollback.handle()
 async def rollback_conversation(event: MessageEvent, arg: Message = CommandArg()):
-    num = arg.extract_plain_text().strip()
-    if num.isdigit():
-        num = int(num)
-        if session[event]:
-            count = session.count(event)
+    text = arg.extract_plain_text().strip()
+    if text.isdigit():
+        num = int(text)
+        if cvst := await session.load(event):
+            _, parent_id, account = cvst[-1]
+            loop = asyncio.get_running_loop()
+            if history and (
+                state := await loop.run_in_executor(
+                    None, history.rollback, session.id(event), parent_id, num
+                )
+            ):
+                # 对话记录足够时直接根据记录回滚，不受最大回滚数的限制
+                if state[0] is None:
+                    await session.clear(event)
+                else:
+                    # 回滚后仍在同一个会话中，由同一个账号处理
+                    await session.push(event, (*state, account))
+                await rollback.finish(f"已成功回滚{num}条会话", at_sender=True)
+            count = await session.count(event)
             if num > count:
                 await rollback.finish(f"历史会话数不足，当前历史会话数为{count}", at_sender=True)
             else:
                 for _ in range(num):
-                    session.pop(event)
+                    await session.pop(event)
                 await rollback.send(f"已成功回滚{num}条会话", at_sender=True)
         else:
             await save.finish("你还没有任何会话记录", at_sender=True)
@@ -207,3 +526,14 @@ async def rollback_conversation(event: MessageEvent, arg: Message = CommandArg()
         await rollback.finish(
             f"请输入有效的数字，最大回滚数为{config.chatgpt_max_rollback}", at_sender=True
         )
+
+
+purge = on_command(
+    "清除缓存", aliases={"清空缓存"}, block=True, rule=to_me(), permission=SUPERUSER, priority=1
+)
+
+
+@purge.handle()
+async def purge_cache() -> None:
+    count = response_cache.clear()
+    await purge.send(f"已清除 {count} 条缓存的回复")
@@ -0,0 +1,203 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, AsyncGenerator, Callable, Optional, TypeVar
+
+from nonebot.log import logger
+
+from .data import get_setting
+from .errors import ChatTimeout
+from .metrics import metrics
+
+if TYPE_CHECKING:
+    from .chatgpt import Chatbot
+    from .retry import Deadline
+
+T = TypeVar("T")
+
+SESSION_TOKEN_KEY = "__Secure-next-auth.session-token"
+
+# 刷新前等待进行中的请求结束的最长时间，单位：秒
+DRAIN_TIMEOUT = 30
+# 两次检查之间的最短和最长间隔，单位：秒
+MIN_CHECK_INTERVAL = 60
+MAX_CHECK_INTERVAL = 3600
+
+
+class AuthExecutor:
+    """登录等阻塞操作使用的线程池
+
+    同时运行的操作数不超过 workers，超时或被取消时不再等待结果。
+    线程无法被强制终止，超时的操作会继续占用线程直到结束，因此不会超过线程数的上限。
+    """
+
+    def __init__(self, workers: int = 1, timeout: float = 60) -> None:
+        self.workers = max(workers, 1)
+        self.timeout = timeout
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+
+    async def run(self, func: Callable[[], T], stage: str = "login") -> T:
+        """在线程池中运行 func，超时时抛出 ChatTimeout(stage)"""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                self.workers, thread_name_prefix="chatgpt-auth"
+            )
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.workers)
+        semaphore = self.semaphore
+        await semaphore.acquire()
+        future = asyncio.get_running_loop().run_in_executor(self.executor, func)
+        # 线程结束后才释放，超时的操作仍然计入线程数
+        future.add_done_callback(lambda _: semaphore.release())
+        try:
+            with metrics.timer(stage):
+                return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            metrics.inc("chatgpt_timeouts_total", stage=stage)
+            raise ChatTimeout(stage) from None
+        except asyncio.CancelledError:
+            # 尚未开始运行时可以取消，已经开始运行时只能放弃结果
+            future.cancel()
+            raise
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        self.semaphore = None
+
+
+class TokenManager:
+    """session token 的生命周期管理
+
+    记录 session token 的过期时间，仅在即将过期时于后台刷新，无法获知过期时间时按固定间隔刷新。
+    刷新期间新的请求等待刷新完成后再使用新的 token 发送，刷新前等待进行中的请求结束，
+    刷新得到的 token 写入 setting.json。
+    """
+
+    def __init__(self, bot: "Chatbot", *, margin: int = 86400, interval: int = 1800) -> None:
+        self.bot = bot
+        self.margin = margin
+        self.interval = interval
+        self.expires: Optional[float] = None
+        self.refreshed_at = time.time()
+        self.active = 0
+        self.refreshing: Optional["asyncio.Task[bool]"] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task and not self.task.done():
+            self.task.cancel()
+        self.task = None
+
+    @property
+    def busy(self) -> bool:
+        """是否正在刷新"""
+        return self.refreshing is not None and not self.refreshing.done()
+
+    @asynccontextmanager
+    async def use(self, deadline: "Deadline") -> AsyncGenerator[None, None]:
+        """发送请求期间使用 token，正在刷新时先等待刷新完成"""
+        if self.refreshing and self.busy:
+            logger.debug(f"账号 {self.bot.name} 正在刷新 token，等待刷新完成")
+            await asyncio.wait({self.refreshing}, timeout=deadline.remaining())
+            if not self.refreshing.done():
+                raise ChatTimeout("refresh")
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+
+    def next_check(self) -> float:
+        """距离下次需要刷新的秒数"""
+        if self.expires is not None:
+            due = self.expires - self.margin
+        else:
+            due = self.refreshed_at + self.interval
+        return min(max(due - time.time(), MIN_CHECK_INTERVAL), MAX_CHECK_INTERVAL)
+
+    @property
+    def due(self) -> bool:
+        if self.expires is not None:
+            return time.time() >= self.expires - self.margin
+        return time.time() >= self.refreshed_at + self.interval
+
+    async def run(self) -> None:
+        while True:
+            await self.update_expiry()
+            await asyncio.sleep(self.next_check())
+            await self.update_expiry()
+            if self.due:
+                await self.refresh()
+
+    async def update_expiry(self) -> None:
+        """从浏览器上下文的 cookies 中读取 session token 的过期时间"""
+        if self.bot.content is None:
+            return
+        try:
+            cookies = await self.bot.content.cookies(self.bot.api_url)
+        except Exception as e:
+            logger.opt(exception=e).debug("读取 cookies 失败")
+            return
+        for cookie in cookies:
+            if cookie["name"] == SESSION_TOKEN_KEY:
+                # 由 add_cookies 设置的 cookie 没有过期时间，值为 -1
+                expires = cookie.get("expires", -1)
+                self.expires = expires if expires > 0 else None
+                return
+
+    def schedule(self) -> "asyncio.Task[bool]":
+        """在后台开始刷新，已经在刷新时返回正在进行的刷新"""
+        if self.refreshing is None or self.refreshing.done():
+            self.refreshing = asyncio.create_task(self.do_refresh())
+        return self.refreshing
+
+    async def refresh(self) -> bool:
+        """刷新 token，同时只会进行一次刷新，成功时返回 True"""
+        return await asyncio.shield(self.schedule())
+
+    async def do_refresh(self) -> bool:
+        bot = self.bot
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while self.active and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        try:
+            await bot.refresh_session()
+        except Exception as e:
+            logger.opt(exception=e).error(f"账号 {bot.name} 刷新 token 失败")
+            metrics.inc("chatgpt_session_refresh_failures_total")
+            return False
+        finally:
+            # 失败时同样推迟下次刷新，避免频繁重试
+            self.refreshed_at = time.time()
+        if bot.http:
+            bot.http.invalidate()
+        await self.update_expiry()
+        self.save()
+        return True
+
+    def save(self) -> None:
+        setting = get_setting()
+        if setting.tokens.get(self.bot.name) != self.bot.session_token:
+            setting.tokens[self.bot.name] = self.bot.session_token
+            setting.save()
+
+    async def recover(self, configured: Optional[str] = None) -> bool:
+        """请求时发现 session 已过期，成功换用新的 token 时返回 True
+
+        使用账号密码登录时重新登录，否则换回配置中的 token
+        """
+        if self.bot.auto_auth:
+            return await self.refresh()
+        if configured and configured != self.bot.session_token:
+            await self.bot.set_cookie(configured)
+            self.save()
+            return True
+        return False
@@ -0,0 +1,127 @@
+from fnmatch import fnmatch
+from typing import TYPE_CHECKING, Dict, Iterable, Tuple
+from urllib.parse import urlsplit
+
+from nonebot.log import logger
+
+from .metrics import metrics
+
+if TYPE_CHECKING:
+    from playwright.async_api import BrowserContext, Page, Response, Route
+
+DEFAULT_BLOCK_RESOURCES = ("image", "font", "media")
+DEFAULT_BLOCK_HOSTS = (
+    "*.google-analytics.com",
+    "*.googletagmanager.com",
+    "*.intercom.io",
+    "*.intercomcdn.com",
+    "*.datadoghq.com",
+    "*.sentry.io",
+    "*.segment.io",
+    "*.segment.com",
+)
+# cf 验证需要的资源，无论如何都不拦截
+CLOUDFLARE_HOSTS = ("challenges.cloudflare.com", "*.challenges.cloudflare.com")
+CLOUDFLARE_PATH = "/cdn-cgi/"
+
+
+def match_host(host: str, patterns: Iterable[str]) -> bool:
+    return any(fnmatch(host, pattern) for pattern in patterns)
+
+
+class RequestFilter:
+    """拦截聊天页面中不需要的请求
+
+    按资源类型拦截图片、字体等资源，按域名拦截统计和遥测脚本，设置了 allow_hosts 时
+    只放行 ChatGPT 自身和列表中的第三方域名。cf 验证需要的资源始终放行。
+    每个页面加载完成时记录放行和拦截的请求数，以及放行的响应大小。
+    """
+
+    def __init__(
+        self,
+        api: str,
+        *,
+        block_resources: Iterable[str] = DEFAULT_BLOCK_RESOURCES,
+        block_hosts: Iterable[str] = DEFAULT_BLOCK_HOSTS,
+        allow_hosts: Iterable[str] = (),
+    ) -> None:
+        self.host = urlsplit(api).hostname or ""
+        self.block_resources = frozenset(block_resources)
+        self.block_hosts = tuple(block_hosts)
+        self.allow_hosts = tuple(allow_hosts)
+        self.blocked: Dict["Page", int] = {}
+        self.allowed: Dict["Page", int] = {}
+        self.received: Dict["Page", int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.block_resources or self.block_hosts or self.allow_hosts)
+
+    async def attach(self, context: "BrowserContext") -> None:
+        """在浏览器上下文中启用拦截，页面的路由优先于浏览器上下文的路由"""
+        context.on("page", self.watch)
+        await context.route("**/*", self.handle)
+
+    def watch(self, page: "Page") -> None:
+        page.on("response", lambda response: self.on_response(page, response))
+        page.on("load", self.on_load)
+        page.on("close", self.on_close)
+
+    def check(self, url: str, resource_type: str) -> Tuple[bool, str]:
+        """返回请求是否需要拦截以及拦截的原因"""
+        parts = urlsplit(url)
+        host = parts.hostname or ""
+        if match_host(host, CLOUDFLARE_HOSTS) or parts.path.startswith(CLOUDFLARE_PATH):
+            return False, ""
+        if parts.scheme not in ("http", "https"):
+            return False, ""
+        if resource_type in self.block_resources:
+            return True, resource_type
+        if host == self.host:
+            return False, ""
+        if match_host(host, self.block_hosts):
+            return True, "host"
+        if self.allow_hosts and not match_host(host, self.allow_hosts):
+            return True, "host"
+        return False, ""
+
+    async def handle(self, route: "Route") -> None:
+        request = route.request
+        block, reason = self.check(request.url, request.resource_type)
+        try:
+            page = request.frame.page
+        except Exception:
+            page = None
+        if not block:
+            if page is not None:
+                self.allowed[page] = self.allowed.get(page, 0) + 1
+            await route.continue_()
+            return
+        metrics.inc("chatgpt_blocked_requests_total", reason=reason)
+        if page is not None:
+            self.blocked[page] = self.blocked.get(page, 0) + 1
+        await route.abort("blockedbyclient")
+
+    def on_response(self, page: "Page", response: "Response") -> None:
+        # 被拦截的请求没有响应，无法得知节省的流量，只统计实际加载的大小
+        try:
+            size = int(response.headers.get("content-length", 0))
+        except ValueError:
+            return
+        self.received[page] = self.received.get(page, 0) + size
+
+    def on_load(self, page: "Page") -> None:
+        blocked = self.blocked.pop(page, 0)
+        allowed = self.allowed.pop(page, 0)
+        received = self.received.pop(page, 0)
+        metrics.observe("chatgpt_page_blocked_requests", blocked)
+        metrics.observe("chatgpt_page_received_bytes", received)
+        logger.debug(
+            f"页面加载完成，放行 {allowed} 个请求，拦截 {blocked} 个请求，"
+            f"加载 {received / 1024:.1f} KiB"
+        )
+
+    def on_close(self, page: "Page") -> None:
+        self.blocked.pop(page, None)
+        self.allowed.pop(page, None)
+        self.received.pop(page, None)
@@ -0,0 +1,86 @@
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from .metrics import metrics
+
+TRAILING_PUNCTUATION = "?？!！.。~～…"
+
+
+def normalize(prompt: str) -> str:
+    """统一全半角、大小写和空白，忽略末尾的标点"""
+    text = unicodedata.normalize("NFKC", prompt).casefold()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip(TRAILING_PUNCTUATION).rstrip()
+
+
+class ResponseCache:
+    """新会话中相同问题的回复缓存
+
+    只缓存不带会话ID的请求，命中缓存时不会创建真正的会话。
+    命中后的问题记录为待重放，用户继续对话时先重放该问题创建会话。
+    """
+
+    def __init__(
+        self, *, size: int = 256, ttl: int = 3600, model: str = "", limit: int = 10000
+    ) -> None:
+        self.size = size
+        self.ttl = ttl
+        self.model = model
+        self.limit = limit
+        self.cache: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.pending: "OrderedDict[str, str]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def key(self, prompt: str) -> str:
+        return f"{self.model}\n{normalize(prompt)}"
+
+    def get(self, prompt: str) -> Optional[str]:
+        key = self.key(prompt)
+        if item := self.cache.get(key):
+            expires, reply = item
+            if expires > time.monotonic():
+                self.cache.move_to_end(key)
+                metrics.inc("chatgpt_response_cache_total", result="hit")
+                return reply
+            del self.cache[key]
+        metrics.inc("chatgpt_response_cache_total", result="miss")
+        return None
+
+    def put(self, prompt: str, reply: str) -> None:
+        if not reply or self.size <= 0:
+            return
+        key = self.key(prompt)
+        self.cache[key] = (time.monotonic() + self.ttl, reply)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    def defer(self, sid: str, prompt: str) -> None:
+        """记录命中缓存的问题，等待用户继续对话时重放"""
+        self.pending[sid] = prompt
+        self.pending.move_to_end(sid)
+        while len(self.pending) > self.limit:
+            self.pending.popitem(last=False)
+
+    def replay(self, sid: str) -> Optional[str]:
+        """取出需要重放的问题"""
+        return self.pending.pop(sid, None)
+
+    def sweep(self) -> int:
+        """清除过期的回复，返回清除的数量"""
+        now = time.monotonic()
+        expired = [key for key, (expires, _) in self.cache.items() if expires <= now]
+        for key in expired:
+            del self.cache[key]
+        return len(expired)
+
+    def clear(self) -> int:
+        """清空缓存，返回清除的数量"""
+        count = len(self.cache)
+        self.cache.clear()
+        return count
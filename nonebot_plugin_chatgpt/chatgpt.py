@@ -1,45 +1,189 @@
+import asyncio
+import time
 import uuid
 from contextlib import asynccontextmanager
-from typing import Any, Dict, Optional
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncGenerator,
+    Dict,
+    Literal,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
-from nonebot import get_driver
+import httpx
 from nonebot.log import logger
 from nonebot.utils import escape_tag
-from playwright.async_api import Page, Route, async_playwright
 from typing_extensions import Self
 
-driver = get_driver()
+from .auth import SESSION_TOKEN_KEY, AuthExecutor, TokenManager
+from .blocker import RequestFilter
+from .clearance import Clearance
+from .errors import (
+    BadResponse,
+    BrowserUnavailable,
+    Challenged,
+    ChatTimeout,
+    RateLimited,
+    RequestFailed,
+    SessionExpired,
+    classify,
+)
+from .metrics import metrics
+from .pool import PagePool
+from .retry import Deadline, RetryPolicy
+from .stream import EventStreamParser
+from .transport import HttpTransport, TransportError
+
+if TYPE_CHECKING:
+    from playwright.async_api import Browser, BrowserContext, Page, Route
+
 try:
     import ujson as json
 except ModuleNotFoundError:
     import json
 
 
-SESSION_TOKEN_KEY = "__Secure-next-auth.session-token"
+# 将 /backend-api/conversation 的响应流复制一份，逐段转发给 python 端
+STREAM_JS = """
+(() => {
+  const fetch = window.fetch;
+  window.fetch = async (...args) => {
+    const response = await fetch(...args);
+    const url = args[0] instanceof Request ? args[0].url : String(args[0]);
+    if (
+      !new URL(url, location.href).pathname.endsWith("/backend-api/conversation") ||
+      !response.body
+    ) {
+      return response;
+    }
+    const [body, copy] = response.body.tee();
+    (async () => {
+      try {
+        const reader = copy.getReader();
+        const decoder = new TextDecoder();
+        for (;;) {
+          const { done, value } = await reader.read();
+          if (done) break;
+          await window.chatgptStream("data", decoder.decode(value, { stream: true }));
+        }
+      } catch (e) {
+        await window.chatgptStream("error", String(e));
+      } finally {
+        await window.chatgptStream("end", null);
+      }
+    })();
+    return new Response(body, {
+      status: response.status,
+      statusText: response.statusText,
+      headers: response.headers,
+    });
+  };
+})();
+"""
+
+
+def new_id() -> str:
+    return str(uuid.uuid4())
+
+
+def is_rate_limited(error: str) -> bool:
+    """ChatGPT 在响应流中返回的错误信息是否表示请求过多"""
+    error = error.lower()
+    return "too many requests" in error or "rate limit" in error
+
+
+@dataclass
+class ChatContext:
+    """单次请求的会话状态，请求完成后会写入 ChatGPT 返回的会话ID和消息ID
+
+    account 为创建会话的账号，会话只能由该账号继续，新会话在请求完成后写入处理它的账号，
+    sid 为发起请求的会话，浏览器进程按 sid 排队
+    """
+
+    conversation_id: Optional[str] = None
+    parent_id: str = field(default_factory=new_id)
+    account: Optional[str] = None
+    sid: str = ""
+    prompt: str = ""
+    status: Optional[int] = None
+    reply: str = ""
+
+    @classmethod
+    def from_history(
+        cls, history: Sequence[Tuple[Optional[str], Optional[str], Optional[str]]]
+    ) -> Self:
+        """根据会话记录创建本次请求的上下文"""
+        conversation_id, parent_id, account = (
+            history[-1] if history else (None, None, None)
+        )
+        return cls(
+            conversation_id=conversation_id,
+            parent_id=parent_id or new_id(),
+            account=account if conversation_id else None,
+        )
 
 
 class Chatbot:
     def __init__(
         self,
         *,
+        name: str = "",
         token: str = "",
         account: str = "",
         password: str = "",
         api: str = "https://chat.openai.com/",
         proxies: Optional[str] = None,
         timeout: int = 10,
+        pool_size: int = 1,
+        page_max_uses: int = 20,
+        transport: Literal["browser", "http"] = "browser",
+        state_path: Optional[Path] = None,
+        clearance_margin: int = 300,
+        model: str = "text-davinci-002-render",
+        policy: Optional[RetryPolicy] = None,
+        refresh_margin: int = 86400,
+        refresh_interval: int = 1800,
+        request_filter: Optional[RequestFilter] = None,
+        executor: Optional[AuthExecutor] = None,
     ) -> None:
+        self.name = name or account
         self.session_token = token
         self.account = account
         self.password = password
-        self.api_url = api
+        self.api_url = api.rstrip("/") + "/"
+        self.conversation_url = f"{self.api_url}backend-api/conversation"
         self.proxies = proxies
         self.timeout = timeout
-        self.content = None
-        self.parent_id = None
-        self.conversation_id = None
-        self.browser = None
-        self.playwright = async_playwright()
+        self.policy = policy or RetryPolicy(send=timeout, stream=timeout)
+        self.model = model
+        self.request_filter = request_filter
+        self.executor = executor or AuthExecutor()
+        self.content: Optional["BrowserContext"] = None
+        self.user_agent = ""
+        self.http = (
+            HttpTransport(api, proxies, timeout) if transport == "http" else None
+        )
+        self.pool = PagePool(
+            self.open_page, self.check_page, size=pool_size, max_uses=page_max_uses
+        )
+        self.streams: Dict["Page", asyncio.Queue] = {}
+        self.routes: Dict["Page", Any] = {}
+        self.clearance = Clearance(state_path, clearance_margin)
+        self.keeping: Optional[asyncio.Task] = None
+        self.tokens = TokenManager(
+            self, margin=refresh_margin, interval=refresh_interval
+        )
+        self.opened: Dict["Page", float] = {}
+        self.temporary: Set["Page"] = set()
+        self.load = 0
+        self.strikes = 0
+        self.quarantine_until = 0.0
         if self.session_token:
             self.auto_auth = False
         elif self.account and self.password:
@@ -47,140 +191,455 @@ class Chatbot:
         else:
             raise ValueError("至少需要配置 session_token 或者 account 和 password")
 
-    async def playwright_start(self):
-        """启动浏览器，在插件开始运行时调用"""
-        playwright = await self.playwright.start()
-        try:
-            self.browser = await playwright.firefox.launch(
-                headless=True,
-                proxy={"server": self.proxies} if self.proxies else None,  # your proxy
-            )
-        except Exception as e:
-            logger.opt(exception=e).error("playwright未安装，请先在shell中运行playwright install")
-            return
-        ua = f"Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:72.0) Gecko/20100101 Firefox/{self.browser.version}"
-        self.content = await self.browser.new_context(user_agent=ua)
+    async def playwright_start(self, browser: "Browser"):
+        """创建独立的浏览器上下文，每个账号拥有各自的 cookies"""
+        self.user_agent = f"Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:72.0) Gecko/20100101 Firefox/{browser.version}"
+        self.content = await browser.new_context(
+            user_agent=self.user_agent,
+            storage_state=self.clearance.storage_state,
+        )
+        if self.clearance.valid:
+            logger.debug(f"账号 {self.name} 已恢复上次的 cf 验证结果")
+        if self.request_filter and self.request_filter.enabled:
+            await self.request_filter.attach(self.content)
         await self.set_cookie(self.session_token)
+        self.pool.reopen()
+        self.keeping = asyncio.create_task(self.keep_clearance())
+        self.tokens.start()
 
     async def set_cookie(self, session_token: str):
-        """设置session_token"""
+        """设置session_token，浏览器上下文尚未创建时在创建后设置"""
         self.session_token = session_token
+        if self.content is None:
+            return
         await self.content.add_cookies(
             [
                 {
                     "name": SESSION_TOKEN_KEY,
                     "value": session_token,
-                    "domain": "chat.openai.com",
-                    "path": "/",
+                    "url": self.api_url,
                 }
             ]
         )
 
-    @driver.on_shutdown
     async def playwright_close(self):
-        """关闭浏览器"""
-        await self.content.close()
-        await self.browser.close()
-        await self.playwright.__aexit__()
+        """关闭浏览器上下文"""
+        if self.keeping and not self.keeping.done():
+            self.keeping.cancel()
+        self.tokens.stop()
+        await self.pool.close()
+        if self.http:
+            await self.http.close()
+        if self.content:
+            # 先清空 content，使浏览器上下文的 close 事件可以区分主动关闭和意外关闭
+            content, self.content = self.content, None
+            try:
+                await self.clearance.save(content)
+            except Exception as e:
+                logger.opt(exception=e).warning("保存浏览器状态失败")
+            try:
+                await content.close()
+            except Exception as e:
+                logger.opt(exception=e).debug("关闭浏览器上下文失败")
+        self.opened.clear()
+        self.temporary.clear()
 
-    def __call__(
-        self, conversation_id: Optional[str] = None, parent_id: Optional[str] = None
-    ) -> Self:
-        self.conversation_id = conversation_id[-1] if conversation_id else None
-        self.parent_id = parent_id[-1] if parent_id else self.id
-        return self
+    def require_content(self) -> "BrowserContext":
+        """浏览器上下文已关闭时抛出 BrowserUnavailable，不再重试"""
+        if self.content is None:
+            raise BrowserUnavailable(f"账号 {self.name} 的浏览器上下文已关闭")
+        return self.content
 
-    @property
-    def id(self) -> str:
-        return str(uuid.uuid4())
+    def on_page_closed(self, page: "Page") -> None:
+        self.opened.pop(page, None)
 
-    def get_payload(self, prompt: str) -> Dict[str, Any]:
+    def get_payload(self, context: ChatContext) -> Dict[str, Any]:
         return {
             "action": "next",
             "messages": [
                 {
-                    "id": self.id,
+                    "id": new_id(),
                     "role": "user",
-                    "content": {"content_type": "text", "parts": [prompt]},
+                    "content": {"content_type": "text", "parts": [context.prompt]},
                 }
             ],
-            "conversation_id": self.conversation_id,
-            "parent_message_id": self.parent_id,
-            "model": "text-davinci-002-render",
+            "conversation_id": context.conversation_id,
+            "parent_message_id": context.parent_id,
+            "model": self.model,
         }
 
+    async def new_page(self) -> "Page":
+        page = await self.require_content().new_page()
+        self.opened[page] = time.monotonic()
+        page.on("close", self.on_page_closed)
+        try:
+            js = "Object.defineProperties(navigator, {webdriver:{get:()=>undefined}});"
+            await page.add_init_script(js)
+            await page.expose_binding("chatgptStream", self.on_stream)
+            await page.add_init_script(STREAM_JS)
+            with metrics.timer("goto"):
+                await page.goto(
+                    f"{self.api_url}chat", timeout=self.policy.navigation * 1000
+                )
+        except BaseException:
+            await page.close()
+            raise
+        return page
+
     @asynccontextmanager
     async def get_page(self):
         """打开网页，这是一个异步上下文管理器，使用async with调用"""
-        page = await self.content.new_page()
-        js = "Object.defineProperties(navigator, {webdriver:{get:()=>undefined}});"
-        await page.add_init_script(js)
-        await page.goto("https://chat.openai.com/chat")
-        yield page
-        await page.close()
-
-    async def get_chat_response(self, prompt: str) -> str:
-        async with self.get_page() as page:
+        page = await self.new_page()
+        self.temporary.add(page)
+        try:
+            yield page
+        finally:
+            self.temporary.discard(page)
+            if not page.is_closed():
+                await page.close()
+
+    async def close_leaked_pages(self, max_age: float) -> int:
+        """关闭打开时间超过 max_age 秒且不属于页面池或临时页面的页面，返回关闭的数量"""
+        now = time.monotonic()
+        leaked = [
+            page
+            for page, opened in list(self.opened.items())
+            if now - opened > max_age
+            and page not in self.pool.uses
+            and page not in self.temporary
+        ]
+        for page in leaked:
+            self.opened.pop(page, None)
+            try:
+                await page.close()
+            except Exception as e:
+                logger.opt(exception=e).debug("关闭泄漏的页面失败")
+        return len(leaked)
+
+    async def open_page(self) -> "Page":
+        """打开网页并完成 cf 验证，供页面池预热使用"""
+        page = await self.new_page()
+        try:
             await page.wait_for_load_state("domcontentloaded")
             if not await page.locator("text=Updates & FAQ").is_visible():
                 await self.get_cf_cookies(page)
-            logger.debug("正在发送请求")
+        except BaseException:
+            await page.close()
+            raise
+        return page
+
+    @staticmethod
+    async def check_page(page: "Page") -> bool:
+        """检查池中页面是否仍然可用"""
+        if await page.locator("button", has_text="Log in").is_visible():
+            return False
+        return await page.locator("textarea").count() > 0
+
+    async def get_chat_response(
+        self, prompt: str, context: Optional[ChatContext] = None
+    ) -> str:
+        stream = self.stream_chat_response(prompt, context)
+        return "".join([delta async for delta in stream])
 
-            async def change_json(route: Route):
-                await route.continue_(
-                    post_data=json.dumps(self.get_payload(prompt)),
+    async def stream_chat_response(
+        self, prompt: str, context: Optional[ChatContext] = None
+    ) -> AsyncGenerator[str, None]:
+        """以异步生成器的形式逐段返回回复内容
+
+        失败时按重试策略重试，已经返回过内容后不再重试，最终失败时抛出 ChatError
+        """
+        context = context or ChatContext()
+        context.prompt = prompt
+        deadline = Deadline(self.policy.total)
+        attempt = 0
+        while True:
+            attempt += 1
+            yielded = False
+            try:
+                async for delta in self.attempt_chat_response(context, deadline):
+                    yielded = True
+                    yield delta
+                return
+            except Exception as e:
+                error = classify(e)
+                if error is None:
+                    raise
+                if error.status:
+                    context.status = error.status
+                delay = self.policy.delay(attempt)
+                if (
+                    yielded
+                    or not error.retryable
+                    or attempt >= self.policy.attempts
+                    or delay >= deadline.remaining()
+                ):
+                    if error is e:
+                        raise
+                    raise error from e
+                metrics.inc("chatgpt_retries_total", reason=type(error).__name__)
+                logger.warning(
+                    f"请求失败，{delay:.1f} 秒后重试 "
+                    f"({attempt}/{self.policy.attempts - 1}): {error!r}"
                 )
+                await asyncio.sleep(delay)
 
-            await self.content.route(
-                "https://chat.openai.com/backend-api/conversation", change_json
-            )
-            await page.wait_for_load_state("domcontentloaded")
-            session_expired = page.locator("button", has_text="Log in")
-            if await session_expired.is_visible():
-                logger.debug("检测到session过期")
-                return "token失效，请重新设置token"
-            next_botton = page.get_by_role("button", name="Next")
-            next_botton2 = page.get_by_role("button", name="Done")
-            if await next_botton.is_visible():
-                logger.debug("检测到初次打开弹窗")
-                await next_botton.click()
-                await next_botton.click()
-                await next_botton2.click()
-            async with page.expect_response(
-                "https://chat.openai.com/backend-api/conversation",
-                timeout=self.timeout * 1000,
-            ) as response_info:
-                textarea = page.locator("textarea")
-                botton = page.locator('button[class="absolute p-1 rounded-md text-gray-500 bottom-1.5 right-1 md:bottom-2.5 md:right-2 hover:bg-gray-100 dark:hover:text-gray-400 dark:hover:bg-gray-900 disabled:hover:bg-transparent dark:disabled:hover:bg-transparent"]')
-                logger.debug("正在等待回复")
-                for _ in range(3):
-                    await textarea.fill(prompt)
-                    if await botton.is_enabled():
-                        await botton.click()
-                        break
-                    await page.wait_for_timeout(500)
-            response = await response_info.value
-            if response.status == 429:
-                return "请求过多，请放慢速度"
-            if response.status == 403:
-                await self.get_cf_cookies(page)
-                return await self.get_chat_response(prompt)
-            if response.status != 200:
+    async def attempt_chat_response(
+        self, context: ChatContext, deadline: Deadline
+    ) -> AsyncGenerator[str, None]:
+        async with self.tokens.use(deadline):
+            if self.http:
+                try:
+                    async for delta in self.http_chat_response(context, deadline):
+                        yield delta
+                    return
+                except TransportError as e:
+                    logger.warning(f"HTTP 请求失败，改用浏览器发送: {e}")
+            async for delta in self.browser_chat_response(context, deadline):
+                yield delta
+
+    async def http_chat_response(
+        self, context: ChatContext, deadline: Deadline
+    ) -> AsyncGenerator[str, None]:
+        """通过 HTTP 客户端发送请求，在返回任何内容前失败时抛出 TransportError
+
+        每次读取的超时时间不超过请求的剩余时间，读取回复期间超过剩余时间时抛出 ChatTimeout
+        """
+        assert self.http is not None
+        await self.http.sync(self.require_content(), self.user_agent)
+        start = time.perf_counter()
+        timeout = deadline.timeout(self.policy.send)
+        async with self.http.stream(self.get_payload(context), timeout) as response:
+            metrics.record("wait_response", time.perf_counter() - start)
+            status = response.status_code
+            if status == 429:
+                metrics.inc("chatgpt_http_errors_total", status="429")
+                raise RateLimited()
+            if status != 200:
+                text = (await response.aread()).decode(errors="replace")
                 logger.opt(colors=True).error(
-                    f"非预期的响应内容: <r>HTTP{response.status}</r> {escape_tag(response.text)}"
+                    f"非预期的响应内容: <r>HTTP{status}</r> {escape_tag(text)}"
+                )
+                raise BadResponse(status, text)
+            context.status = status
+            parser = EventStreamParser()
+            try:
+                with metrics.timer("stream"):
+                    async for chunk in response.aiter_text():
+                        for delta in parser.feed(chunk):
+                            yield delta
+                        if deadline.remaining() <= 0:
+                            raise ChatTimeout("total")
+            except httpx.TimeoutException as e:
+                raise ChatTimeout("stream") from e
+            except httpx.HTTPError as e:
+                if not parser.text:
+                    raise TransportError(f"读取回复失败: {e!r}") from e
+                raise RequestFailed(f"读取回复失败: {e!r}") from e
+            for delta in parser.close():
+                yield delta
+        self.finish_stream(parser, context)
+
+    def finish_stream(self, parser: EventStreamParser, context: ChatContext) -> None:
+        """记录回复的消息ID和处理会话的账号，响应中没有回复时抛出 ChatError"""
+        if parser.error:
+            logger.error(f"ChatGPT 返回了错误信息: {parser.error}")
+        if not parser.message_id:
+            error = parser.error or "响应中没有回复内容"
+            if is_rate_limited(error):
+                raise RateLimited(error)
+            # 状态码为 200 但请求并未成功，不应重置账号的出错次数
+            context.status = None
+            raise RequestFailed(error)
+        context.reply = parser.text
+        context.parent_id = parser.message_id
+        context.conversation_id = parser.conversation_id
+        if context.conversation_id:
+            context.account = self.name
+        logger.debug("发送请求结束")
+
+    async def browser_chat_response(
+        self, context: ChatContext, deadline: Deadline
+    ) -> AsyncGenerator[str, None]:
+        page = await self.hedged_send(context, deadline)
+        error = True
+        try:
+            parser = EventStreamParser()
+            with metrics.timer("stream"):
+                async for chunk in self.read_stream(page, deadline):
+                    for delta in parser.feed(chunk):
+                        yield delta
+            for delta in parser.close():
+                yield delta
+            self.finish_stream(parser, context)
+            error = False
+        finally:
+            await self.release_page(page, error=error)
+
+    async def hedged_send(self, context: ChatContext, deadline: Deadline) -> "Page":
+        """发送请求并等待响应头，返回收到响应的页面
+
+        第一个页面超过 hedge 秒没有响应时，从页面池中再取一个页面同时发送，
+        使用先收到响应的页面，另一个页面直接关闭。
+        """
+        attempts = [asyncio.create_task(self.send_on_page(context, deadline))]
+        hedged = self.policy.hedge <= 0
+        page: Optional["Page"] = None
+        error: Optional[BaseException] = None
+        try:
+            while attempts and page is None:
+                done, _ = await asyncio.wait(
+                    attempts,
+                    timeout=None if hedged else self.policy.hedge,
+                    return_when=asyncio.FIRST_COMPLETED,
                 )
-                return f"ChatGPT 服务器返回了非预期的内容: HTTP{response.status}\n{response.text}"
-            lines = await response.text()
-            lines = lines.splitlines()
-            data = lines[-4][6:]
-            response = json.loads(data)
-            self.parent_id = response["message"]["id"]
-            self.conversation_id = response["conversation_id"]
-            logger.debug("发送请求结束")
-        return response["message"]["content"]["parts"][0]
+                if not done:
+                    hedged = True
+                    metrics.inc("chatgpt_hedged_total")
+                    logger.debug("页面长时间没有响应，在另一个页面上同时发送")
+                    attempts.append(
+                        asyncio.create_task(self.send_on_page(context, deadline))
+                    )
+                    continue
+                for task in done:
+                    attempts.remove(task)
+                    if exception := task.exception():
+                        error = error or exception
+                    elif page is None:
+                        page = task.result()
+                    else:
+                        await self.release_page(task.result(), error=True)
+        finally:
+            for task in attempts:
+                task.cancel()
+            for result in await asyncio.gather(*attempts, return_exceptions=True):
+                if not isinstance(result, BaseException):
+                    await self.release_page(result, error=True)
+        if page is None:
+            assert error is not None
+            raise error
+        context.status = 200
+        return page
+
+    async def send_on_page(self, context: ChatContext, deadline: Deadline) -> "Page":
+        """从页面池中取出页面并发送请求，收到 200 响应后返回该页面"""
+        try:
+            page = await asyncio.wait_for(
+                self.pool.acquire(),
+                deadline.timeout(self.policy.navigation + self.policy.challenge),
+            )
+        except asyncio.TimeoutError:
+            raise ChatTimeout("navigation") from None
+        logger.debug("正在发送请求")
+
+        async def change_json(route: "Route"):
+            await route.continue_(
+                post_data=json.dumps(self.get_payload(context)),
+            )
+
+        self.routes[page] = change_json
+        self.streams[page] = asyncio.Queue()
+        try:
+            await page.route(self.conversation_url, change_json)
+            await self.send_message(page, context, deadline)
+        except BaseException:
+            await self.release_page(page, error=True)
+            raise
+        return page
+
+    async def release_page(self, page: "Page", *, error: bool) -> None:
+        self.streams.pop(page, None)
+        handler = self.routes.pop(page, None)
+        if handler and not page.is_closed():
+            try:
+                await page.unroute(self.conversation_url, handler)
+            except Exception:
+                error = True
+        await self.pool.release(page, error=error)
+
+    async def on_stream(self, source: Dict[str, Any], kind: str, data: Any) -> None:
+        """接收页面中转发的回复数据流"""
+        if queue := self.streams.get(source["page"]):
+            queue.put_nowait((kind, data))
+
+    async def send_message(
+        self, page: "Page", context: ChatContext, deadline: Deadline
+    ) -> None:
+        from playwright.async_api import Error as PlaywrightAPIError
+        from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+        try:
+            await page.wait_for_load_state(
+                "domcontentloaded",
+                timeout=deadline.timeout(self.policy.navigation) * 1000,
+            )
+        except PlaywrightTimeoutError as e:
+            raise ChatTimeout("navigation") from e
+        session_expired = page.locator("button", has_text="Log in")
+        if await session_expired.is_visible():
+            logger.debug("检测到session过期")
+            raise SessionExpired()
+        next_botton = page.get_by_role("button", name="Next")
+        next_botton2 = page.get_by_role("button", name="Done")
+        if await next_botton.is_visible():
+            logger.debug("检测到初次打开弹窗")
+            await next_botton.click()
+            await next_botton.click()
+            await next_botton2.click()
+        timeout = deadline.timeout(self.policy.send) * 1000
+        with metrics.timer("wait_response"):
+            try:
+                async with page.expect_response(
+                    self.conversation_url, timeout=timeout
+                ) as response_info:
+                    textarea = page.locator("textarea")
+                    botton = page.locator('button[class="absolute p-1 rounded-md text-gray-500 bottom-1.5 right-1 md:bottom-2.5 md:right-2 hover:bg-gray-100 dark:hover:text-gray-400 dark:hover:bg-gray-900 disabled:hover:bg-transparent dark:disabled:hover:bg-transparent"]')
+                    logger.debug("正在等待回复")
+                    await textarea.fill(context.prompt, timeout=timeout)
+                    # click 会等待按钮变为可用
+                    await botton.click(timeout=timeout)
+                response = await response_info.value
+            except PlaywrightTimeoutError as e:
+                raise ChatTimeout("send") from e
+            except PlaywrightAPIError as e:
+                raise RequestFailed(str(e)) from e
+        status = response.status
+        if status in (429, 403):
+            metrics.inc("chatgpt_http_errors_total", status=str(status))
+        if status == 429:
+            raise RateLimited()
+        if status == 403:
+            await self.get_cf_cookies(page, deadline.timeout(self.policy.challenge))
+            raise Challenged()
+        if status != 200:
+            text = await response.text()
+            logger.opt(colors=True).error(
+                f"非预期的响应内容: <r>HTTP{status}</r> {escape_tag(text)}"
+            )
+            raise BadResponse(status, text)
+
+    async def read_stream(
+        self, page: "Page", deadline: Deadline
+    ) -> AsyncGenerator[str, None]:
+        queue = self.streams[page]
+        while True:
+            try:
+                kind, data = await asyncio.wait_for(
+                    queue.get(), deadline.timeout(self.policy.stream)
+                )
+            except asyncio.TimeoutError:
+                raise ChatTimeout("stream") from None
+            if kind == "end":
+                return
+            if kind == "error":
+                # 页面中读取响应流时出错，例如连接中断
+                raise RequestFailed(f"读取回复失败: {data}")
+            if kind == "data":
+                yield data
 
     async def refresh_session(self) -> None:
+        """刷新 session token，通常由 TokenManager 在即将过期时调用"""
         logger.debug("正在刷新session")
+        metrics.inc("chatgpt_session_refresh_total")
         if self.auto_auth:
             await self.login()
         else:
@@ -191,19 +650,27 @@ class Chatbot:
                 session_expired = page.locator("text=Your session has expired")
                 if await session_expired.count():
                     logger.opt(colors=True).error("刷新会话失败, session token 已过期, 请重新设置")
-            cookies = await self.content.cookies()
+                    raise SessionExpired()
+            cookies = await self.require_content().cookies()
             for i in cookies:
                 if i["name"] == SESSION_TOKEN_KEY:
                     self.session_token = i["value"]
                     break
             logger.debug("刷新会话成功")
 
-    async def login(self) -> None:
+    def authenticate(self) -> Any:
+        """使用账号密码登录，会进行同步的网络请求，需要在线程中运行"""
         from OpenAIAuth.OpenAIAuth import OpenAIAuth
 
         auth = OpenAIAuth(self.account, self.password, bool(self.proxies), self.proxies)  # type: ignore
+        auth.begin()
+        return auth
+
+    async def login(self) -> None:
+        metrics.inc("chatgpt_login_total")
         try:
-            auth.begin()
+            # 在线程池中运行，登录期间不阻塞事件循环
+            auth = await self.executor.run(self.authenticate)
         except Exception as e:
             if str(e) == "Captcha detected":
                 logger.error("不支持验证码, 请使用 session token")
@@ -223,26 +690,56 @@ class Chatbot:
         else:
             logger.error("ChatGPT 登陆错误!")
 
-    @staticmethod
-    async def get_cf_cookies(page: Page) -> None:
-        logger.debug("正在获取cf cookies")
-        for _ in range(20):
-            button = page.get_by_role("button", name="Verify you are human")
-            if await button.count():
-                await button.click()
-            label = page.locator("label span")
-            if await label.count():
-                await label.click()
+    async def keep_clearance(self) -> None:
+        """在 cf_clearance 过期前提前验证，避免用户请求时才进行验证"""
+        while True:
+            delay = self.clearance.next_check()
+            if delay is None:
+                # 尚未记录到 cf_clearance，等待页面池完成首次验证
+                await asyncio.sleep(60)
+                continue
+            await asyncio.sleep(delay)
+            logger.debug(f"账号 {self.name} 的 cf_clearance 即将过期，正在重新验证")
             try:
-                label2 = page.frame_locator("iframe[title=\"Widget containing a Cloudflare security challenge\"]").get_by_label("Verify you are human")
-                if await label2.count():
-                    await label2.check()
-            except Exception as _:
-                pass
-            await page.wait_for_timeout(1000)
-            cf = page.locator("text=Updates & FAQ")
-            if await cf.is_visible():
-                break
-        else:
-            logger.error("cf cookies获取失败")
+                async with self.get_page() as page:
+                    await page.wait_for_load_state("domcontentloaded")
+                    if not await page.locator("text=Updates & FAQ").is_visible():
+                        await self.get_cf_cookies(page)
+                    else:
+                        await self.clearance.save(self.require_content())
+            except Exception as e:
+                logger.opt(exception=e).warning("提前进行 cf 验证失败")
+            if not self.clearance.valid:
+                # 验证失败或者 cookie 有效期短于提前量，稍后重试
+                await asyncio.sleep(60)
+
+    async def get_cf_cookies(
+        self, page: "Page", timeout: Optional[float] = None
+    ) -> None:
+        """进行 cf 验证，最多等待 timeout 秒，默认使用重试策略中的验证时间"""
+        logger.debug("正在获取cf cookies")
+        metrics.inc("chatgpt_challenges_total")
+        deadline = time.monotonic() + (timeout or self.policy.challenge)
+        with metrics.timer("challenge"):
+            while time.monotonic() < deadline:
+                button = page.get_by_role("button", name="Verify you are human")
+                if await button.count():
+                    await button.click()
+                label = page.locator("label span")
+                if await label.count():
+                    await label.click()
+                try:
+                    label2 = page.frame_locator("iframe[title=\"Widget containing a Cloudflare security challenge\"]").get_by_label("Verify you are human")
+                    if await label2.count():
+                        await label2.check()
+                except Exception as _:
+                    pass
+                await page.wait_for_timeout(1000)
+                cf = page.locator("text=Updates & FAQ")
+                if await cf.is_visible():
+                    break
+            else:
+                logger.error("cf cookies获取失败")
+                return
         logger.debug("cf cookies获取成功")
+        await self.clearance.save(page.context)
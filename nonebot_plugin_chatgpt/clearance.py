@@ -0,0 +1,96 @@
+import asyncio
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Optional, Sequence, Union
+
+from nonebot.log import logger
+
+from .files import safe_name, write_atomic
+
+if TYPE_CHECKING:
+    from playwright.async_api import BrowserContext, Cookie, StorageState
+
+try:
+    import ujson as json
+except ModuleNotFoundError:
+    import json
+
+# cf 验证写入的 cookies，其中 cf_clearance 决定下次访问是否需要重新验证
+CF_COOKIES = ("cf_clearance", "__cf_bm", "_cfuvid")
+CLEARANCE_KEY = "cf_clearance"
+
+
+class Clearance:
+    """记录 cf 验证得到的 cookies 及其过期时间
+
+    浏览器上下文的状态（cookies 和 localStorage）保存到文件中，
+    重启后创建浏览器上下文时恢复，仍在有效期内的验证结果可以直接复用。
+    """
+
+    def __init__(self, path: Optional[Path], margin: int = 300) -> None:
+        self.path = path
+        self.margin = margin
+        self.expires: Dict[str, float] = {}
+        self.state: Optional["StorageState"] = None
+        self.lock = asyncio.Lock()
+        if path and path.is_file():
+            try:
+                state = json.loads(path.read_text("utf-8"))
+            except ValueError:
+                logger.warning(f"浏览器状态文件已损坏，将重新验证: {path}")
+                path.unlink()
+            else:
+                self.update(state.get("cookies", []))
+
+    @property
+    def storage_state(self) -> Union["StorageState", str, None]:
+        """创建浏览器上下文时使用的状态，优先使用本次运行中最近保存的状态"""
+        if self.state is not None:
+            return self.state
+        if self.path and self.path.is_file():
+            return str(self.path)
+        return None
+
+    @property
+    def valid(self) -> bool:
+        """cf_clearance 是否仍在有效期内"""
+        return time.time() < self.expires.get(CLEARANCE_KEY, 0) - self.margin
+
+    def next_check(self) -> Optional[float]:
+        """距离下次提前验证的秒数，没有记录到 cf_clearance 时返回 None"""
+        if CLEARANCE_KEY not in self.expires:
+            return None
+        return max(self.expires[CLEARANCE_KEY] - self.margin - time.time(), 0)
+
+    def update(self, cookies: Sequence[Union["Cookie", Dict[str, Any]]]) -> None:
+        now = time.time()
+        self.expires = {
+            cookie["name"]: cookie["expires"]
+            for cookie in cookies
+            if cookie["name"] in CF_COOKIES and cookie.get("expires", -1) > now
+        }
+
+    async def save(self, context: "BrowserContext") -> None:
+        """读取浏览器上下文中的 cookies，并保存浏览器状态"""
+        async with self.lock:
+            state = await context.storage_state()
+            self.state = state
+            self.update(state["cookies"])
+            if CLEARANCE_KEY in self.expires:
+                expires = time.strftime(
+                    "%Y-%m-%d %H:%M:%S", time.localtime(self.expires[CLEARANCE_KEY])
+                )
+                logger.debug(f"cf_clearance 有效期至 {expires}")
+            if self.path:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.write, json.dumps(state))
+
+    def write(self, data: str) -> None:
+        assert self.path is not None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(self.path, data.encode("utf-8"))
+
+
+def state_path(directory: Path, name: str) -> Path:
+    """账号对应的浏览器状态文件"""
+    return directory / f"{safe_name(name)}.json"
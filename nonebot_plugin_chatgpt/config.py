@@ -4,18 +4,38 @@ from typing import List, Literal, Optional, Union
 from nonebot import get_driver
 from pydantic import BaseModel, Extra
 
+from .blocker import DEFAULT_BLOCK_HOSTS, DEFAULT_BLOCK_RESOURCES
+
 
 class Config(BaseModel, extra=Extra.ignore):
-    chatgpt_session_token: str = ""
-    chatgpt_account: str = ""
-    chatgpt_password: str = ""
+    chatgpt_session_token: Union[str, List[str]] = ""
+    chatgpt_account: Union[str, List[str]] = ""
+    chatgpt_password: Union[str, List[str]] = ""
     chatgpt_cd_time: int = 60
+    chatgpt_user_burst: int = 1
+    chatgpt_group_rate: float = 0
+    chatgpt_group_burst: int = 5
+    chatgpt_global_rate: float = 0
+    chatgpt_global_burst: int = 10
+    chatgpt_limit_backoff: float = 0.5
+    chatgpt_limit_recover_time: int = 300
     chatgpt_proxies: Optional[str] = None
     chatgpt_refresh_interval: int = 30
+    chatgpt_refresh_margin: int = 86400
+    chatgpt_auth_workers: int = 1
+    chatgpt_auth_timeout: float = 60
+    chatgpt_preauth: bool = False
     chatgpt_command: Union[str, List[str]] = ""
     chatgpt_to_me: bool = True
     chatgpt_timeout: int = 30
+    chatgpt_navigation_timeout: float = 30
+    chatgpt_challenge_timeout: float = 20
+    chatgpt_request_timeout: float = 120
+    chatgpt_retry_attempts: int = 3
+    chatgpt_retry_backoff: float = 1
+    chatgpt_hedge_delay: float = 0
     chatgpt_api: str = "https://chat.openai.com/"
+    chatgpt_model: str = "text-davinci-002-render"
     chatgpt_image: bool = False
     chatgpt_image_width: int = 500
     chatgpt_priority: int = 999
@@ -24,7 +44,48 @@ class Config(BaseModel, extra=Extra.ignore):
     chatgpt_scope: Literal["private", "public"] = "private"
     chatgpt_data: Path = Path(__file__).parent
     chatgpt_max_rollback: int = 5
+    chatgpt_history: bool = False
+    chatgpt_history_max_size: int = 1024
+    chatgpt_history_ttl: int = 30
+    chatgpt_session_limit: Optional[int] = None
+    chatgpt_session_ttl: Optional[int] = None
+    chatgpt_sweep_interval: int = 10
+    chatgpt_metrics_path: str = ""
+    chatgpt_metrics_log: bool = False
     chatgpt_detailed_error: bool = False
+    chatgpt_save_delay: float = 1
+    chatgpt_storage: Literal["json", "sqlite"] = "json"
+    chatgpt_shared: bool = False
+    chatgpt_worker: Literal["", "server", "client"] = ""
+    chatgpt_worker_socket: Optional[Path] = None
+    chatgpt_page_pool_size: int = 1
+    chatgpt_page_max_uses: int = 20
+    chatgpt_max_concurrency: int = 3
+    chatgpt_queue_notice: bool = False
+    chatgpt_quarantine_time: int = 60
+    chatgpt_quarantine_max: int = 3600
+    chatgpt_stream: bool = False
+    chatgpt_stream_interval: float = 3
+    chatgpt_transport: Literal["browser", "http"] = "browser"
+    chatgpt_image_cache_size: int = 64
+    chatgpt_image_cache_persist: bool = False
+    chatgpt_image_cache_max_size: int = 64
+    chatgpt_render_workers: int = 2
+    chatgpt_image_min_length: int = 0
+    chatgpt_split_length: int = 0
+    chatgpt_forward_threshold: int = 0
+    chatgpt_browser_state: bool = True
+    chatgpt_clearance_margin: int = 300
+    chatgpt_startup_wait: float = 30
+    chatgpt_supervise_interval: int = 30
+    chatgpt_browser_max_rss: int = 0
+    chatgpt_block_resources: List[str] = list(DEFAULT_BLOCK_RESOURCES)
+    chatgpt_block_hosts: List[str] = list(DEFAULT_BLOCK_HOSTS)
+    chatgpt_allow_hosts: List[str] = []
+    chatgpt_response_cache: bool = False
+    chatgpt_response_cache_size: int = 256
+    chatgpt_response_cache_ttl: int = 3600
+    chatgpt_response_cache_model: bool = True
 
 
 config = Config.parse_obj(get_driver().config)
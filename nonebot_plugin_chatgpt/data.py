@@ -1,9 +1,12 @@
+import asyncio
+import threading
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 from pydantic import BaseModel, Field, root_validator
 
 from .config import config
+from .files import write_atomic
 
 try:
     import ujson as json
@@ -14,8 +17,12 @@ except ModuleNotFoundError:
 class Setting(BaseModel):
     session: Dict[str, Dict[str, Any]] = Field(default_factory=dict)
     token: str = ""
+    tokens: Dict[str, str] = Field(default_factory=dict)
 
     __file_path: Path = config.chatgpt_data / "setting.json"
+    __lock = threading.Lock()
+    __handle: Optional[asyncio.TimerHandle] = None
+    __writing: Optional[asyncio.Future] = None
 
     @property
     def file_path(self) -> Path:
@@ -28,7 +35,53 @@ class Setting(BaseModel):
         return values
 
     def save(self) -> None:
-        self.file_path.write_text(self.json(), encoding="utf-8")
+        """延迟保存，防抖时间内的多次修改合并为一次写入，写入在后台线程中进行"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.write(self.json())
+            return
+        cls = self.__class__
+        if cls.__handle is None:
+            cls.__handle = loop.call_later(config.chatgpt_save_delay, self.write_later)
 
+    def write_later(self) -> None:
+        cls = self.__class__
+        loop = asyncio.get_running_loop()
+        if cls.__writing and not cls.__writing.done():
+            # 上一次写入尚未完成，等待下一轮
+            cls.__handle = loop.call_later(config.chatgpt_save_delay, self.write_later)
+            return
+        cls.__handle = None
+        cls.__writing = loop.run_in_executor(None, self.write, self.json())
 
-setting = Setting()
+    def write(self, data: str) -> None:
+        with self.__class__.__lock:
+            write_atomic(self.file_path, data.encode("utf-8"))
+
+    async def flush(self) -> None:
+        """立即写入尚未保存的修改"""
+        cls = self.__class__
+        if cls.__writing and not cls.__writing.done():
+            await cls.__writing
+        if cls.__handle is not None:
+            cls.__handle.cancel()
+            cls.__handle = None
+            self.write(self.json())
+
+
+_setting: Optional[Setting] = None
+
+
+def get_setting() -> Setting:
+    """首次使用时才读取 setting.json"""
+    global _setting
+    if _setting is None:
+        _setting = Setting()
+    return _setting
+
+
+async def flush_setting() -> None:
+    """写入尚未保存的修改，尚未读取过设置时无需写入"""
+    if _setting is not None:
+        await _setting.flush()
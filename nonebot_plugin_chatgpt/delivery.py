@@ -0,0 +1,177 @@
+import asyncio
+import re
+from typing import Iterator, List, Optional, Type, Union
+
+from nonebot.adapters.onebot.v11 import (
+    ActionFailed,
+    GroupMessageEvent,
+    Message,
+    MessageSegment,
+)
+from nonebot.log import logger
+from nonebot.matcher import Matcher, current_bot, current_event
+
+from .metrics import metrics
+from .render import Renderer
+
+FENCE_PATTERN = re.compile(r"^\s{0,3}(`{3,}|~{3,})(.*)$")
+
+
+def iter_blocks(text: str) -> Iterator[str]:
+    """按空行切分段落，代码块整体作为一段，代码块内的空行不切分"""
+    lines: List[str] = []
+    fence: Optional[str] = None
+    for line in text.splitlines():
+        match = FENCE_PATTERN.match(line)
+        if fence is None:
+            if match:
+                if lines:
+                    yield "\n".join(lines)
+                lines = [line]
+                fence = match.group(1)
+            elif line.strip():
+                lines.append(line)
+            elif lines:
+                yield "\n".join(lines)
+                lines = []
+            continue
+        lines.append(line)
+        if (
+            match
+            and not match.group(2).strip()
+            and match.group(1)[0] == fence[0]
+            and len(match.group(1)) >= len(fence)
+        ):
+            yield "\n".join(lines)
+            lines = []
+            fence = None
+    if lines:
+        yield "\n".join(lines)
+
+
+def pack(lines: List[str], limit: int) -> List[str]:
+    """将多行内容按行合并为不超过 limit 个字符的片段，过长的行直接截断"""
+    pieces: List[str] = []
+    current = ""
+    for line in lines:
+        while len(line) > limit:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            pieces.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def fit(block: str, limit: int) -> List[str]:
+    """切分单个过长的段落，代码块在每个片段中补全开始和结束标记"""
+    if len(block) <= limit:
+        return [block]
+    lines = block.split("\n")
+    match = FENCE_PATTERN.match(lines[0])
+    if not match:
+        return pack(lines, limit)
+    header, fence = lines[0].strip(), match.group(1)
+    body = lines[1:]
+    if body and body[-1].strip() == fence:
+        body.pop()
+    # 为开始和结束标记留出位置，至少保留一个字符的内容
+    size = max(limit - len(header) - len(fence) - 2, 1)
+    return [f"{header}\n{piece}\n{fence}" for piece in pack(body, size)]
+
+
+def split_reply(text: str, limit: int) -> List[str]:
+    """按段落和代码块边界将回复切分为不超过 limit 个字符的片段，limit 为 0 时不切分"""
+    if limit <= 0 or len(text) <= limit:
+        return [text]
+    chunks: List[str] = []
+    current = ""
+    for block in iter_blocks(text):
+        for piece in fit(block, limit):
+            if current and len(current) + 2 + len(piece) > limit:
+                chunks.append(current)
+                current = piece
+            else:
+                current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class Delivery:
+    """回复的发送流程
+
+    超过 split_length 的回复按段落和代码块切分后发送，以图片形式发送时各片段并发渲染，
+    渲染完成后按顺序发送，第一段不需要等待后面的片段。
+    群聊中片段数达到 forward_threshold 时合并为一条转发消息发送。
+    """
+
+    def __init__(
+        self,
+        renderer: Optional[Renderer] = None,
+        *,
+        split_length: int = 0,
+        forward_threshold: int = 0,
+        nickname: str = "ChatGPT",
+    ) -> None:
+        self.renderer = renderer
+        self.split_length = split_length
+        self.forward_threshold = forward_threshold
+        self.nickname = nickname
+
+    async def send(self, matcher: Type[Matcher], msg: str) -> None:
+        if not msg:
+            return
+        chunks = split_reply(msg, self.split_length)
+        metrics.inc("chatgpt_reply_chunks_total", len(chunks))
+        tasks = [asyncio.ensure_future(self.build(chunk)) for chunk in chunks]
+        try:
+            event = current_event.get()
+            if (
+                self.forward_threshold > 0
+                and len(chunks) >= self.forward_threshold
+                and isinstance(event, GroupMessageEvent)
+            ):
+                segments = await asyncio.gather(*tasks)
+                if not await self.forward(event, segments):
+                    for segment in segments:
+                        await matcher.send(segment, at_sender=True)
+                return
+            for task in tasks:
+                await matcher.send(await task, at_sender=True)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def build(self, chunk: str) -> Union[str, MessageSegment]:
+        if self.renderer is None or not self.renderer.should_render(chunk):
+            return chunk
+        if chunk.count("```") % 2 != 0:
+            chunk += "\n```"
+        return MessageSegment.image(await self.renderer.render(chunk))
+
+    async def forward(
+        self, event: GroupMessageEvent, segments: List[Union[str, MessageSegment]]
+    ) -> bool:
+        """以合并转发的形式发送，协议端不支持时返回 False"""
+        bot = current_bot.get()
+        nodes = [
+            MessageSegment.node_custom(int(bot.self_id), self.nickname, Message(s))
+            for s in segments
+        ]
+        try:
+            await bot.call_api(
+                "send_group_forward_msg", group_id=event.group_id, messages=nodes
+            )
+        except ActionFailed as e:
+            logger.opt(exception=e).warning("发送合并转发消息失败，改为依次发送")
+            return False
+        metrics.inc("chatgpt_forward_messages_total")
+        return True
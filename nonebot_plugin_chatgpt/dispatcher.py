@@ -0,0 +1,355 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncContextManager,
+    AsyncGenerator,
+    Dict,
+    List,
+    Optional,
+    Protocol,
+    Sequence,
+)
+
+from nonebot.log import logger
+
+from .auth import AuthExecutor
+from .blocker import RequestFilter
+from .chatgpt import ChatContext, Chatbot
+from .clearance import state_path
+from .config import config
+from .data import get_setting
+from .errors import BrowserUnavailable
+from .metrics import metrics
+from .retry import RetryPolicy
+from .supervisor import Supervisor
+
+if TYPE_CHECKING:
+    from playwright.async_api import Browser
+
+
+class TokenRecovery(Protocol):
+    async def recover(self, configured: Optional[str] = None) -> bool:
+        ...
+
+
+class ChatBackend(Protocol):
+    """Chatbot 和转发给浏览器进程的 RemoteChatbot 共同的接口"""
+
+    name: str
+
+    @property
+    def tokens(self) -> TokenRecovery:
+        ...
+
+    async def get_chat_response(
+        self, prompt: str, context: Optional[ChatContext] = None
+    ) -> str:
+        ...
+
+    def stream_chat_response(
+        self, prompt: str, context: Optional[ChatContext] = None
+    ) -> AsyncGenerator[str, None]:
+        ...
+
+
+class ChatDispatcher(Protocol):
+    """Dispatcher 和浏览器运行在其他进程中时使用的 RemoteDispatcher 共同的接口"""
+
+    ready: bool
+    configured: Dict[str, str]
+
+    @property
+    def bots(self) -> Sequence[Chatbot]:
+        ...
+
+    def warm_up(self) -> None:
+        ...
+
+    async def wait_ready(self, timeout: float) -> bool:
+        ...
+
+    async def close(self) -> None:
+        ...
+
+    def acquire(self, context: ChatContext) -> AsyncContextManager[ChatBackend]:
+        ...
+
+
+def load_bots(executor: Optional[AuthExecutor] = None) -> List[Chatbot]:
+    """根据配置为每个账号创建一个 Chatbot，所有账号共用同一个登录线程池"""
+    tokens = as_list(config.chatgpt_session_token)
+    accounts = as_list(config.chatgpt_account)
+    passwords = as_list(config.chatgpt_password)
+    setting = get_setting()
+    policy = RetryPolicy(
+        navigation=config.chatgpt_navigation_timeout,
+        challenge=config.chatgpt_challenge_timeout,
+        send=config.chatgpt_timeout,
+        stream=config.chatgpt_timeout,
+        total=config.chatgpt_request_timeout,
+        attempts=config.chatgpt_retry_attempts,
+        backoff=config.chatgpt_retry_backoff,
+        hedge=config.chatgpt_hedge_delay,
+    )
+    request_filter = RequestFilter(
+        config.chatgpt_api,
+        block_resources=config.chatgpt_block_resources,
+        block_hosts=config.chatgpt_block_hosts,
+        allow_hosts=config.chatgpt_allow_hosts,
+    )
+    bots = []
+    for i in range(max(len(tokens), len(accounts), 1)):
+        account = accounts[i] if i < len(accounts) else ""
+        name = account or f"token{i}"
+        token = setting.tokens.get(name) or (i == 0 and setting.token) or ""
+        bots.append(
+            Chatbot(
+                name=name,
+                token=token or (tokens[i] if i < len(tokens) else ""),
+                account=account,
+                password=passwords[i] if i < len(passwords) else "",
+                api=config.chatgpt_api,
+                proxies=config.chatgpt_proxies,
+                timeout=config.chatgpt_timeout,
+                pool_size=config.chatgpt_page_pool_size,
+                page_max_uses=config.chatgpt_page_max_uses,
+                transport=config.chatgpt_transport,
+                state_path=state_path(config.chatgpt_data / "browser", name)
+                if config.chatgpt_browser_state
+                else None,
+                clearance_margin=config.chatgpt_clearance_margin,
+                model=config.chatgpt_model,
+                policy=policy,
+                refresh_margin=config.chatgpt_refresh_margin,
+                refresh_interval=config.chatgpt_refresh_interval * 60,
+                request_filter=request_filter,
+                executor=executor,
+            )
+        )
+    return bots
+
+
+def as_list(value) -> List[str]:
+    return [value] if isinstance(value, str) else list(value)
+
+
+class Dispatcher:
+    """多账号调度器
+
+    所有账号共用一个浏览器，每个账号使用独立的浏览器上下文。
+    新会话分配给负载最低的可用账号，已有会话固定由创建它的账号处理，
+    创建会话的账号随会话记录一起保存，重启后仍然由同一个账号处理。
+    返回 429 或 403 的账号会按指数退避暂停使用。
+
+    账号和浏览器在插件启动后于后台创建，未传入 bots 时根据配置创建。
+    浏览器崩溃或内存超限时由 Supervisor 触发重启，重启期间的请求等待重启完成，
+    单个账号的浏览器上下文重建期间，分配给该账号的请求等待重建完成。
+    """
+
+    def __init__(self, bots: Optional[List[Chatbot]] = None) -> None:
+        self.bots: List[Chatbot] = bots or []
+        self.configured: Dict[str, str] = {}
+        self.playwright: Any = None
+        self.browser: Optional["Browser"] = None
+        self.ready = False
+        self.warming: Optional[asyncio.Task] = None
+        self.rebuilding: Dict[str, asyncio.Task] = {}
+        self.executor = AuthExecutor(
+            config.chatgpt_auth_workers, config.chatgpt_auth_timeout
+        )
+        self.supervisor = Supervisor(
+            self,
+            interval=config.chatgpt_supervise_interval,
+            max_rss=config.chatgpt_browser_max_rss,
+        )
+
+    @property
+    def started(self) -> bool:
+        return self.browser is not None
+
+    async def start(self) -> None:
+        """启动浏览器并预热页面池，完成后 ready 为 True"""
+        from playwright.async_api import async_playwright
+
+        if not self.bots:
+            self.bots = load_bots(self.executor)
+        self.configured = {
+            bot.name: token
+            for bot, token in zip(self.bots, as_list(config.chatgpt_session_token))
+        }
+        self.playwright = async_playwright()
+        playwright = await self.playwright.start()
+        try:
+            self.browser = await playwright.firefox.launch(
+                headless=True,
+                proxy={"server": config.chatgpt_proxies}
+                if config.chatgpt_proxies
+                else None,
+            )
+        except Exception as e:
+            logger.opt(exception=e).error("playwright未安装，请先在shell中运行playwright install")
+            await self.playwright.__aexit__()
+            self.playwright = None
+            return
+        self.supervisor.watch_browser(self.browser)
+        for bot in self.bots:
+            await bot.playwright_start(self.browser)
+            self.supervisor.watch_context(bot)
+        await asyncio.gather(*(bot.pool.wait() for bot in self.bots))
+        self.ready = True
+        self.supervisor.start()
+        logger.info(f"ChatGPT 已就绪，可用账号数: {len(self.bots)}")
+        if config.chatgpt_preauth:
+            self.preauth()
+
+    def preauth(self) -> None:
+        """在后台为需要登录的账号提前登录，切换账号时无需等待登录"""
+        for bot in self.bots:
+            if bot.auto_auth and (not bot.session_token or bot.tokens.due):
+                logger.debug(f"正在为账号 {bot.name} 提前登录")
+                bot.tokens.schedule()
+
+    def recover(self, reason: str) -> None:
+        """在后台重启浏览器，重启期间的请求等待重启完成"""
+        if self.warming and not self.warming.done():
+            return
+        logger.warning(f"{reason}，正在重启浏览器")
+        metrics.inc("chatgpt_browser_restarts_total")
+        self.ready = False
+        self.warming = asyncio.create_task(self.restart())
+        self.warming.add_done_callback(self.on_warmed_up)
+
+    async def restart(self) -> None:
+        await self.shutdown()
+        await self.start()
+
+    def rebuild(self, bot: Chatbot) -> None:
+        """在后台重建账号意外关闭的浏览器上下文"""
+        task = self.rebuilding.get(bot.name)
+        if task is None or task.done():
+            self.rebuilding[bot.name] = asyncio.create_task(self.recover_bot(bot))
+
+    async def recover_bot(self, bot: Chatbot) -> None:
+        """重建意外关闭的浏览器上下文"""
+        logger.warning(f"账号 {bot.name} 的浏览器上下文意外关闭，正在重建")
+        metrics.inc("chatgpt_context_restarts_total")
+        await bot.playwright_close()
+        if self.browser is None or not self.browser.is_connected():
+            self.recover("浏览器已断开")
+            return
+        try:
+            await bot.playwright_start(self.browser)
+        except Exception as e:
+            logger.opt(exception=e).error(f"重建账号 {bot.name} 的浏览器上下文失败")
+            self.recover("重建浏览器上下文失败")
+            return
+        self.supervisor.watch_context(bot)
+
+    def warm_up(self) -> None:
+        """在后台启动浏览器，启动失败后再次调用时会重试"""
+        if self.warming is None or (self.warming.done() and not self.ready):
+            self.warming = asyncio.create_task(self.start())
+            self.warming.add_done_callback(self.on_warmed_up)
+
+    @staticmethod
+    def on_warmed_up(task: asyncio.Task) -> None:
+        if not task.cancelled() and (e := task.exception()):
+            logger.opt(exception=e).error("ChatGPT 启动失败")
+
+    async def wait_ready(self, timeout: float) -> bool:
+        """等待启动完成，超时或启动失败时返回 False"""
+        self.warm_up()
+        assert self.warming is not None
+        try:
+            await asyncio.wait_for(asyncio.shield(self.warming), timeout)
+        except Exception:
+            # 超时或启动失败，启动失败的原因已在 on_warmed_up 中记录
+            return False
+        return self.ready
+
+    async def close(self) -> None:
+        """关闭浏览器"""
+        self.supervisor.stop()
+        if self.warming and not self.warming.done():
+            self.warming.cancel()
+        await self.shutdown()
+        self.executor.shutdown()
+
+    async def shutdown(self) -> None:
+        self.ready = False
+        for bot in self.bots:
+            await bot.playwright_close()
+        if self.browser:
+            # 先清空 browser，使 disconnected 事件可以区分主动关闭和意外断开
+            browser, self.browser = self.browser, None
+            try:
+                await browser.close()
+            except Exception as e:
+                logger.opt(exception=e).debug("关闭浏览器失败")
+        if self.playwright is not None:
+            try:
+                await self.playwright.__aexit__()
+            except Exception as e:
+                logger.opt(exception=e).debug("关闭 playwright 失败")
+            self.playwright = None
+
+    def pick(self, context: ChatContext) -> Chatbot:
+        if context.conversation_id and context.account:
+            for bot in self.bots:
+                if bot.name == context.account:
+                    return bot
+            logger.warning(f"找不到创建会话的账号 {context.account}，改用其他账号")
+        now = time.time()
+        available = [
+            bot
+            for bot in self.bots
+            if bot.quarantine_until <= now and bot.content is not None
+        ]
+        if not available:
+            return min(self.bots, key=lambda bot: bot.quarantine_until)
+        # 正在登录或刷新的账号需要等待，优先使用其他账号
+        idle = [bot for bot in available if not bot.tokens.busy]
+        return min(idle or available, key=lambda bot: bot.load)
+
+    @asynccontextmanager
+    async def acquire(self, context: ChatContext) -> AsyncGenerator[Chatbot, None]:
+        """为请求选择账号，这是一个异步上下文管理器，使用async with调用"""
+        if not self.ready and not await self.wait_ready(config.chatgpt_startup_wait):
+            raise BrowserUnavailable("浏览器正在重启")
+        bot = self.pick(context)
+        if bot.content is None:
+            await self.wait_context(bot)
+        bot.load += 1
+        try:
+            yield bot
+        finally:
+            bot.load -= 1
+            self.report(bot, context)
+
+    async def wait_context(self, bot: Chatbot) -> None:
+        """等待账号的浏览器上下文重建完成，超时或重建失败时抛出 BrowserUnavailable"""
+        timeout = config.chatgpt_startup_wait
+        if (task := self.rebuilding.get(bot.name)) and not task.done():
+            await asyncio.wait({task}, timeout=timeout)
+        if bot.content is None and not self.ready:
+            # 重建失败时会重启整个浏览器
+            await self.wait_ready(timeout)
+        if bot.content is None:
+            raise BrowserUnavailable(f"账号 {bot.name} 的浏览器上下文正在重建")
+
+    def report(self, bot: Chatbot, context: ChatContext) -> None:
+        if context.status in (429, 403):
+            bot.strikes += 1
+            delay = min(
+                config.chatgpt_quarantine_time * 2 ** (bot.strikes - 1),
+                config.chatgpt_quarantine_max,
+            )
+            bot.quarantine_until = time.time() + delay
+            logger.warning(
+                f"账号 {bot.name} 返回 HTTP{context.status}，暂停使用 {delay} 秒"
+            )
+        elif context.status == 200:
+            bot.strikes = 0
@@ -0,0 +1,95 @@
+from typing import Any, Dict, Optional
+
+
+class BrowserUnavailable(Exception):
+    """浏览器或账号的浏览器上下文正在启动或重启，等待超时"""
+
+
+class ChatError(Exception):
+    """请求 ChatGPT 失败
+
+    retryable 表示在尚未返回任何内容时是否可以重试，status 为 ChatGPT 返回的 HTTP 状态码
+    """
+
+    retryable = False
+    status: Optional[int] = None
+
+
+class SessionExpired(ChatError):
+    """session token 已失效"""
+
+
+class RateLimited(ChatError):
+    """ChatGPT 返回 429"""
+
+    status = 429
+
+
+class Challenged(ChatError):
+    """ChatGPT 返回 403，需要重新进行 cf 验证"""
+
+    retryable = True
+    status = 403
+
+
+class BadResponse(ChatError):
+    """ChatGPT 返回了非预期的状态码，5xx 可以重试"""
+
+    def __init__(self, status: int, text: str) -> None:
+        super().__init__(f"HTTP{status}")
+        self.status = status
+        self.text = text
+        self.retryable = status >= 500
+
+
+class ChatTimeout(ChatError):
+    """某个阶段超时，stage 为 navigation、challenge、send、stream、refresh、login 或 total"""
+
+    def __init__(self, stage: str) -> None:
+        super().__init__(f"{stage} timeout")
+        self.stage = stage
+        self.retryable = stage != "total"
+
+
+class RequestFailed(ChatError):
+    """页面或连接出错"""
+
+    retryable = True
+
+
+def classify(error: Exception) -> Optional[ChatError]:
+    """将 playwright 的异常转换为 ChatError，无法识别时返回 None"""
+    if isinstance(error, ChatError):
+        return error
+    from playwright.async_api import Error as PlaywrightAPIError
+    from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+    if isinstance(error, PlaywrightTimeoutError):
+        return ChatTimeout("page")
+    if isinstance(error, PlaywrightAPIError):
+        return RequestFailed(str(error))
+    return None
+
+
+def dump_error(error: ChatError) -> Dict[str, Any]:
+    """将 ChatError 转换为可以序列化的字典，用于跨进程传递"""
+    return {
+        "type": type(error).__name__,
+        "message": str(error),
+        "status": getattr(error, "status", None),
+        "text": getattr(error, "text", ""),
+        "stage": getattr(error, "stage", ""),
+    }
+
+
+def load_error(data: Dict[str, Any]) -> ChatError:
+    """从 dump_error 的结果还原 ChatError"""
+    kind = data.get("type")
+    if kind == "BadResponse":
+        return BadResponse(data["status"], data.get("text", ""))
+    if kind == "ChatTimeout":
+        return ChatTimeout(data.get("stage", "total"))
+    for cls in (SessionExpired, RateLimited, Challenged, RequestFailed):
+        if kind == cls.__name__:
+            return cls(data.get("message", ""))
+    return RequestFailed(data.get("message", ""))
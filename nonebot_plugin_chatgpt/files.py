@@ -0,0 +1,26 @@
+import os
+import re
+import tempfile
+from contextlib import suppress
+from pathlib import Path
+
+
+def safe_name(name: str) -> str:
+    """将会话ID、账号等转换为可以用作文件名的字符串"""
+    return re.sub(r"[^0-9A-Za-z_.@-]", "_", name)
+
+
+def write_atomic(path: Path, data: bytes) -> None:
+    """先写入临时文件再替换，避免写入中断导致文件损坏
+
+    每次写入使用不同的临时文件，多个线程或进程同时写入同一个文件时互不影响
+    """
+    fd, temp_name = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_name, path)
+    except BaseException:
+        with suppress(OSError):
+            os.unlink(temp_name)
+        raise
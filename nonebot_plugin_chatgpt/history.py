@@ -0,0 +1,309 @@
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from nonebot.log import logger
+
+from .files import safe_name, write_atomic
+
+# 导出对话时最多导出的问答数
+EXPORT_LIMIT = 20
+
+try:
+    import ujson as json
+except ModuleNotFoundError:
+    import json
+
+if sys.platform != "win32":
+    import fcntl
+
+
+class Record(NamedTuple):
+    """一次问答，message_id 为回复的消息ID，parent_id 为提问时使用的父消息ID"""
+
+    time: float
+    conversation_id: Optional[str]
+    message_id: str
+    parent_id: Optional[str]
+    root: bool
+    prompt: str
+    reply: str
+
+    def dump(self) -> bytes:
+        return json.dumps(self._asdict(), ensure_ascii=False).encode() + b"\n"
+
+    @classmethod
+    def load(cls, line: bytes) -> "Record":
+        return cls(**json.loads(line))
+
+    @property
+    def date(self) -> str:
+        return time.strftime("%m-%d %H:%M", time.localtime(self.time))
+
+    def format(self) -> str:
+        return f"[{self.date}]\n问: {self.prompt}\n答: {self.reply}"
+
+
+class Index:
+    """单个会话的索引，按消息ID查找偏移量，按时间二分查找
+
+    size 为已经读入索引的文件长度，inode 和 mtime 用于判断文件是否被其他进程改写
+    """
+
+    __slots__ = ("offsets", "times", "positions", "size", "inode", "mtime")
+
+    def __init__(self) -> None:
+        self.offsets: Dict[str, int] = {}
+        self.times: List[float] = []
+        self.positions: List[int] = []
+        self.size = 0
+        self.inode = 0
+        self.mtime = 0
+
+    def valid(self, stat: Optional[os.stat_result]) -> bool:
+        """文件只被追加写入时索引仍然有效，只需读入新增的部分"""
+        if stat is None:
+            return self.size == 0
+        if stat.st_ino != self.inode:
+            return self.size == 0
+        if stat.st_size == self.size:
+            return stat.st_mtime_ns == self.mtime
+        return stat.st_size > self.size
+
+    def update(self, stat: os.stat_result) -> None:
+        self.inode = stat.st_ino
+        # 只读入了部分内容时不记录修改时间，下次使用时继续读入
+        self.mtime = stat.st_mtime_ns if stat.st_size == self.size else 0
+
+    def add(self, record: Record, offset: int, length: int) -> None:
+        self.offsets[record.message_id] = offset
+        self.times.append(record.time)
+        self.positions.append(offset)
+        self.size = offset + length
+
+
+def history_path(directory: Path, sid: str) -> Path:
+    return directory / f"{safe_name(sid)}.jsonl"
+
+
+@contextmanager
+def locked(path: Path, mode: str) -> Iterator[IO[bytes]]:
+    """打开文件并获取排他锁，在其他进程中追加和压缩同一个文件时依次进行
+
+    等待锁期间文件可能已被压缩替换或删除，此时重新打开
+    """
+    while True:
+        f = path.open(mode)
+        if sys.platform == "win32":
+            # Windows 上没有 flock，对话记录只能由单个进程使用
+            break
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if os.fstat(f.fileno()).st_ino == path.stat().st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        except BaseException:
+            f.close()
+            raise
+        f.close()
+    with f:
+        yield f
+
+
+class HistoryLog:
+    """对话记录
+
+    每个会话的问答按顺序追加写入各自的文件，每行一条记录，
+    内存中为最近使用的会话保留消息ID和时间的索引，按消息ID读取记录只需要一次寻址。
+    使用索引前检查文件的大小和修改时间，其他进程追加的记录只需读入新增的部分。
+    单个文件超过 max_size 时丢弃最旧的记录，超过 ttl 的记录在清理时删除。
+    追加和压缩时持有文件锁，压缩不会丢失其他进程同时追加的记录。
+    所有方法都会进行阻塞的文件操作，需要在线程中调用。
+    """
+
+    def __init__(
+        self, directory: Path, *, max_size: int = 1048576, ttl: int = 0, limit: int = 1000
+    ) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        self.limit = limit
+        self.indexes: "OrderedDict[str, Index]" = OrderedDict()
+        self.lock = threading.RLock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def index(self, sid: str) -> Index:
+        path = history_path(self.directory, sid)
+        try:
+            stat: Optional[os.stat_result] = path.stat()
+        except FileNotFoundError:
+            stat = None
+        index = self.indexes.get(path.name)
+        if index is None or not index.valid(stat):
+            index = self.indexes[path.name] = Index()
+            while len(self.indexes) > self.limit:
+                self.indexes.popitem(last=False)
+        else:
+            self.indexes.move_to_end(path.name)
+        if stat is not None and stat.st_size > index.size:
+            self.scan(path, index)
+            index.update(stat)
+        return index
+
+    @staticmethod
+    def scan(path: Path, index: Index) -> None:
+        """读入文件中尚未加入索引的部分"""
+        offset = index.size
+        with path.open("rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # 其他进程正在写入的最后一行
+                    break
+                try:
+                    index.add(Record.load(line), offset, len(line))
+                except (TypeError, ValueError):
+                    logger.warning(f"对话记录 {path.name} 中有无法解析的内容，已跳过")
+                offset += len(line)
+        index.size = offset
+
+    def append(self, sid: str, record: Record) -> None:
+        path = history_path(self.directory, sid)
+        with self.lock:
+            index = self.index(sid)
+            data = record.dump()
+            with locked(path, "a+b") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(data)
+                f.flush()
+                stat = os.fstat(f.fileno())
+                if offset == index.size:
+                    index.add(record, offset, len(data))
+                    index.update(stat)
+                # 否则其他进程在此期间追加了记录，下次使用索引时一并读入
+                if self.max_size and stat.st_size > self.max_size:
+                    self.compact(path, f)
+
+    def get(self, sid: str, message_id: Optional[str]) -> Optional[Record]:
+        if not message_id:
+            return None
+        with self.lock:
+            index = self.index(sid)
+            if (offset := index.offsets.get(message_id)) is None:
+                return None
+            return self.read(sid, offset)
+
+    def read(self, sid: str, offset: int) -> Optional[Record]:
+        try:
+            with history_path(self.directory, sid).open("rb") as f:
+                f.seek(offset)
+                return Record.load(f.readline())
+        except (OSError, TypeError, ValueError):
+            return None
+
+    def since(self, sid: str, timestamp: float) -> List[Record]:
+        """指定时间之后的全部记录，从旧到新排列"""
+        with self.lock:
+            index = self.index(sid)
+            start = bisect_left(index.times, timestamp)
+            records = [self.read(sid, offset) for offset in index.positions[start:]]
+        return [record for record in records if record]
+
+    def chain(
+        self, sid: str, message_id: Optional[str], limit: int
+    ) -> List[Record]:
+        """从指定消息开始沿父消息向前查找，最多返回 limit 条记录，从旧到新排列"""
+        records: List[Record] = []
+        with self.lock:
+            while len(records) < limit and (record := self.get(sid, message_id)):
+                records.append(record)
+                if record.root:
+                    break
+                message_id = record.parent_id
+        records.reverse()
+        return records
+
+    def rollback(
+        self, sid: str, message_id: Optional[str], count: int
+    ) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        """回滚 count 次问答后的 (会话ID, 父消息ID)，记录不足时返回 None
+
+        回滚到会话的第一条消息之前时返回 (None, None)，即开始新的会话
+        """
+        state: Optional[Tuple[Optional[str], Optional[str]]] = None
+        with self.lock:
+            for _ in range(count):
+                record = self.get(sid, message_id)
+                if record is None or state == (None, None):
+                    return None
+                if record.root:
+                    state = None, None
+                else:
+                    state = record.conversation_id, record.parent_id
+                message_id = record.parent_id
+        return state
+
+    def compact(self, path: Path, f: Optional[IO[bytes]] = None) -> int:
+        """删除过期的记录，文件仍然过大时只保留最新的一半，返回删除的记录数
+
+        未过期的最新一条记录总是保留。f 为已经持有锁的文件，为 None 时打开文件并加锁
+        """
+        if f is None:
+            try:
+                with locked(path, "rb") as f:
+                    return self.compact(path, f)
+            except FileNotFoundError:
+                return 0
+        f.seek(0)
+        lines = f.read().splitlines(keepends=True)
+        kept = lines
+        if self.ttl > 0:
+            expired = time.time() - self.ttl
+            kept = [line for line in kept if self.fresh(line, expired)]
+        if self.max_size and sum(len(line) for line in kept) > self.max_size:
+            size = 0
+            for i in range(len(kept) - 1, -1, -1):
+                size += len(kept[i])
+                if size > self.max_size // 2:
+                    kept = kept[min(i + 1, len(kept) - 1):]
+                    break
+        removed = len(lines) - len(kept)
+        if not removed:
+            return 0
+        if kept:
+            write_atomic(path, b"".join(kept))
+        else:
+            path.unlink()
+        self.indexes.pop(path.name, None)
+        return removed
+
+    @staticmethod
+    def fresh(line: bytes, expired: float) -> bool:
+        try:
+            return Record.load(line).time > expired
+        except (TypeError, ValueError):
+            return False
+
+    def sweep(self) -> int:
+        """压缩包含过期记录的文件，返回删除的记录数"""
+        if self.ttl <= 0:
+            return 0
+        expired = time.time() - self.ttl
+        count = 0
+        for path in self.directory.glob("*.jsonl"):
+            try:
+                with path.open("rb") as f:
+                    first = f.readline()
+            except OSError:
+                continue
+            if not self.fresh(first, expired):
+                with self.lock:
+                    count += self.compact(path)
+        return count
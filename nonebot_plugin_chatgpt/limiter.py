@@ -0,0 +1,312 @@
+import asyncio
+import math
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+from nonebot.adapters.onebot.v11 import GroupMessageEvent, MessageEvent
+from nonebot.matcher import Matcher
+from nonebot.params import Depends
+
+from .metrics import metrics
+
+# 收到 429 后速率的最低比例
+MIN_SCALE = 0.1
+
+T = TypeVar("T")
+
+LIMITED_MESSAGES = {
+    "user": "ChatGPT 冷却中，请在 {} 秒后再试",
+    "group": "本群使用 ChatGPT 过于频繁，请在 {} 秒后再试",
+    "global": "ChatGPT 繁忙中，请在 {} 秒后再试",
+}
+
+
+class TokenBucket:
+    """令牌桶，每秒补充 rate 个令牌，最多保存 capacity 个"""
+
+    __slots__ = ("capacity", "tokens", "updated")
+
+    def __init__(self, capacity: float, now: float) -> None:
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, rate: float, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def wait_time(self, rate: float) -> float:
+        """距离可以取出一个令牌还需要的秒数"""
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / rate if rate > 0 else math.inf
+
+    @property
+    def full(self) -> bool:
+        return self.tokens >= self.capacity
+
+
+class BucketStore:
+    """令牌桶的存储，默认保存在内存中"""
+
+    # 令牌桶使用的时钟，只在单个进程内使用时可以使用单调时钟
+    clock: Callable[[], float] = staticmethod(time.monotonic)
+    # 为 True 时读写会阻塞，需要在线程中进行
+    blocking = False
+
+    def __init__(self) -> None:
+        self.buckets: Dict[str, Dict[Any, TokenBucket]] = {
+            "user": {},
+            "group": {},
+            "global": {},
+        }
+        self.scale = (1.0, self.clock())
+
+    def __len__(self) -> int:
+        return sum(len(buckets) for buckets in self.buckets.values())
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """其中的读写作为一个整体执行"""
+        yield
+
+    def get(self, scope: str, key: Any) -> Optional[TokenBucket]:
+        return self.buckets[scope].get(key)
+
+    def put(self, scope: str, key: Any, bucket: TokenBucket) -> None:
+        self.buckets[scope][key] = bucket
+
+    def delete(self, scope: str, key: Any) -> None:
+        self.buckets[scope].pop(key, None)
+
+    def items(self) -> List[Tuple[str, Any, TokenBucket]]:
+        return [
+            (scope, key, bucket)
+            for scope, buckets in self.buckets.items()
+            for key, bucket in buckets.items()
+        ]
+
+    def get_scale(self) -> Tuple[float, float]:
+        """返回速率比例以及比例降低的时间"""
+        return self.scale
+
+    def set_scale(self, scale: float, scaled_at: float) -> None:
+        self.scale = (scale, scaled_at)
+
+    def close(self) -> None:
+        """关闭存储"""
+
+
+class SqliteBucketStore(BucketStore):
+    """保存在 SQLite 数据库中，多个进程共用同一份限流状态
+
+    进程之间无法共用单调时钟，因此使用系统时间。
+    事务在线程中执行，同一时间只有一个线程使用连接。
+    """
+
+    clock = staticmethod(time.time)
+    blocking = True
+
+    def __init__(self, path: Path) -> None:
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False, timeout=5
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS buckets (
+                scope TEXT NOT NULL,
+                key TEXT NOT NULL,
+                capacity REAL NOT NULL,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (scope, key)
+            );
+            CREATE TABLE IF NOT EXISTS limiter (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                scale REAL NOT NULL,
+                scaled_at REAL NOT NULL
+            );
+            """
+        )
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM buckets").fetchone()[0]
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        with self.lock:
+            # 立即获取写锁，避免多个进程同时读到相同的令牌数
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def get(self, scope: str, key: Any) -> Optional[TokenBucket]:
+        row = self.db.execute(
+            "SELECT capacity, tokens, updated FROM buckets WHERE scope = ? AND key = ?",
+            (scope, str(key)),
+        ).fetchone()
+        return self.load(*row) if row else None
+
+    @staticmethod
+    def load(capacity: float, tokens: float, updated: float) -> TokenBucket:
+        bucket = TokenBucket(capacity, updated)
+        bucket.tokens = tokens
+        return bucket
+
+    def put(self, scope: str, key: Any, bucket: TokenBucket) -> None:
+        self.db.execute(
+            "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?)",
+            (scope, str(key), bucket.capacity, bucket.tokens, bucket.updated),
+        )
+
+    def delete(self, scope: str, key: Any) -> None:
+        self.db.execute(
+            "DELETE FROM buckets WHERE scope = ? AND key = ?", (scope, str(key))
+        )
+
+    def items(self) -> List[Tuple[str, Any, TokenBucket]]:
+        rows = self.db.execute(
+            "SELECT scope, key, capacity, tokens, updated FROM buckets"
+        ).fetchall()
+        return [(scope, key, self.load(*bucket)) for scope, key, *bucket in rows]
+
+    def get_scale(self) -> Tuple[float, float]:
+        row = self.db.execute("SELECT scale, scaled_at FROM limiter").fetchone()
+        return (row[0], row[1]) if row else (1.0, self.clock())
+
+    def set_scale(self, scale: float, scaled_at: float) -> None:
+        self.db.execute(
+            "INSERT OR REPLACE INTO limiter VALUES (0, ?, ?)", (scale, scaled_at)
+        )
+
+    def close(self) -> None:
+        self.db.close()
+
+
+class RateLimiter:
+    """按用户、群和全局分别限制请求速率
+
+    三种令牌桶都有令牌时才放行，放行时同时扣除。
+    ChatGPT 返回 429 时所有速率按比例降低，之后随时间逐渐恢复。
+    rate 为每秒补充的令牌数，为 0 时不限制。
+    令牌桶默认保存在内存中，多个进程共用限流状态时使用 SqliteBucketStore，
+    此时需要通过 call 在线程中调用 throttle 和 sweep 等方法。
+    """
+
+    def __init__(
+        self,
+        *,
+        user_rate: float = 0,
+        user_burst: int = 1,
+        group_rate: float = 0,
+        group_burst: int = 1,
+        global_rate: float = 0,
+        global_burst: int = 1,
+        backoff: float = 0.5,
+        recover_time: float = 300,
+        store: Optional[BucketStore] = None,
+    ) -> None:
+        self.rates = {"user": user_rate, "group": group_rate, "global": global_rate}
+        self.bursts = {
+            "user": max(user_burst, 1),
+            "group": max(group_burst, 1),
+            "global": max(global_burst, 1),
+        }
+        self.backoff = backoff
+        self.recover_time = recover_time
+        self.store = store if store is not None else BucketStore()
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    @property
+    def scale(self) -> float:
+        """当前速率相对于配置速率的比例，降低后每 recover_time 秒恢复到 1"""
+        scale, scaled_at = self.store.get_scale()
+        if scale < 1 and self.recover_time > 0:
+            elapsed = self.store.clock() - scaled_at
+            return min(1.0, scale + elapsed / self.recover_time)
+        return 1.0
+
+    async def call(self, func: Callable[..., T], *args: Any) -> T:
+        """存储会阻塞时在线程中执行，避免等待数据库锁时阻塞事件循环"""
+        if not self.store.blocking:
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    def throttle(self) -> None:
+        """收到 429 时降低速率"""
+        with self.store.transaction():
+            scale = max(self.scale * self.backoff, MIN_SCALE)
+            self.store.set_scale(scale, self.store.clock())
+
+    def keys(self, event: MessageEvent) -> List[Tuple[str, Any]]:
+        keys: List[Tuple[str, Any]] = [("user", event.user_id), ("global", None)]
+        if isinstance(event, GroupMessageEvent):
+            keys.insert(1, ("group", event.group_id))
+        return [(scope, key) for scope, key in keys if self.rates[scope] > 0]
+
+    def acquire(self, event: MessageEvent) -> Optional[Tuple[str, float]]:
+        """尝试放行一个请求，被限制时返回限制的范围和需要等待的秒数"""
+        keys = self.keys(event)
+        if not keys:
+            return None
+        with self.store.transaction():
+            now = self.store.clock()
+            scale = self.scale
+            buckets = []
+            limited: Optional[Tuple[str, float]] = None
+            for scope, key in keys:
+                rate = self.rates[scope] * scale
+                bucket = self.store.get(scope, key)
+                if bucket is None:
+                    bucket = TokenBucket(self.bursts[scope], now)
+                else:
+                    bucket.refill(rate, now)
+                wait = bucket.wait_time(rate)
+                if wait > 0 and (limited is None or wait > limited[1]):
+                    limited = scope, wait
+                buckets.append((scope, key, bucket))
+            if limited:
+                return limited
+            for scope, key, bucket in buckets:
+                bucket.tokens -= 1
+                self.store.put(scope, key, bucket)
+        return None
+
+    async def check(self, matcher: Matcher, event: MessageEvent) -> None:
+        if limited := await self.call(self.acquire, event):
+            scope, wait = limited
+            metrics.inc("chatgpt_rate_limited_total", scope=scope)
+            await matcher.finish(
+                LIMITED_MESSAGES[scope].format(math.ceil(wait)), at_sender=True
+            )
+
+    def sweep(self) -> int:
+        """清除已经补满的令牌桶，返回清除的数量"""
+        count = 0
+        with self.store.transaction():
+            now = self.store.clock()
+            scale = self.scale
+            for scope, key, bucket in self.store.items():
+                bucket.refill(self.rates[scope] * scale, now)
+                if bucket.full:
+                    self.store.delete(scope, key)
+                    count += 1
+        return count
+
+
+def limiter_checker(limiter: RateLimiter) -> Any:
+    return Depends(limiter.check)
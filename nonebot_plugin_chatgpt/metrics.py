@@ -0,0 +1,125 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+SAMPLE_SIZE = 1024
+QUANTILES = (0.5, 0.95, 0.99)
+
+spans: ContextVar[Optional[Dict[str, float]]] = ContextVar("spans", default=None)
+
+
+class Summary:
+    """记录最近若干次观测值，用于计算分位数"""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.sum = 0.0
+        self.samples: Deque[float] = deque(maxlen=SAMPLE_SIZE)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+
+    def quantile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        values = sorted(self.samples)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Metrics:
+    """插件运行指标，可以导出为 Prometheus 文本格式"""
+
+    def __init__(self) -> None:
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.summaries: Dict[str, Dict[Labels, Summary]] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+        self.help: Dict[str, str] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        """增加计数器"""
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        series = self.summaries.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series.setdefault(key, Summary()).observe(value)
+
+    def gauge(self, name: str, func: Callable[[], float], description: str = "") -> None:
+        """注册仪表，导出时调用 func 获取当前值"""
+        self.gauges[name] = func
+        if description:
+            self.help[name] = description
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        """记录一个阶段的耗时，同时计入当前请求的耗时明细"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage: str, elapsed: float) -> None:
+        self.observe("chatgpt_stage_seconds", elapsed, stage=stage)
+        if (current := spans.get()) is not None:
+            current[stage] = current.get(stage, 0.0) + elapsed
+
+    @contextmanager
+    def request(self) -> Iterator[Dict[str, float]]:
+        """开始记录一次请求的耗时明细"""
+        current: Dict[str, float] = {}
+        token = spans.set(current)
+        try:
+            yield current
+        finally:
+            spans.reset(token)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for name, counters in sorted(self.counters.items()):
+            self.header(lines, name, "counter")
+            for labels, value in counters.items():
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        for name, func in sorted(self.gauges.items()):
+            self.header(lines, name, "gauge")
+            try:
+                value = func()
+            except Exception:
+                continue
+            lines.append(f"{name} {value}")
+        for name, summaries in sorted(self.summaries.items()):
+            self.header(lines, name, "summary")
+            for labels, summary in summaries.items():
+                for q in QUANTILES:
+                    quantile = format_labels(labels + (("quantile", str(q)),))
+                    lines.append(f"{name}{quantile} {summary.quantile(q)}")
+                lines.append(f"{name}_sum{format_labels(labels)} {summary.sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {summary.count}")
+        return "\n".join(lines) + "\n"
+
+    def header(self, lines: List[str], name: str, kind: str) -> None:
+        if description := self.help.get(name):
+            lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{escape(value)}"' for key, value in labels)
+    return f"{{{pairs}}}"
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = Metrics()
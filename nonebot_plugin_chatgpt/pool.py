@@ -0,0 +1,117 @@
+import asyncio
+import contextvars
+from collections import deque
+from typing import TYPE_CHECKING, Awaitable, Callable, Deque, Dict, Optional
+
+from nonebot.log import logger
+
+if TYPE_CHECKING:
+    from playwright.async_api import Page
+
+
+class PagePool:
+    """预热的页面池，页面在放入池中前已完成打开和 cf 验证"""
+
+    def __init__(
+        self,
+        factory: Callable[[], Awaitable["Page"]],
+        check: Callable[["Page"], Awaitable[bool]],
+        *,
+        size: int = 1,
+        max_uses: int = 20,
+    ) -> None:
+        self.factory = factory
+        self.check = check
+        self.size = size
+        self.max_uses = max_uses
+        self.idle: Deque["Page"] = deque()
+        self.uses: Dict["Page", int] = {}
+        self.refilling: Optional[asyncio.Task] = None
+        self.closed = False
+
+    async def acquire(self) -> "Page":
+        """取出一个可用的页面，池中没有空闲页面时直接新建"""
+        while self.idle:
+            page = self.idle.popleft()
+            if await self.is_healthy(page):
+                return page
+            logger.debug("页面池中的页面已失效，正在丢弃")
+            await self.discard(page)
+        return await self.create()
+
+    async def release(self, page: "Page", *, error: bool = False) -> None:
+        """归还页面，出错、用尽次数或池已满时关闭页面"""
+        self.uses[page] = self.uses.get(page, 0) + 1
+        if (
+            error
+            or self.closed
+            or page.is_closed()
+            or self.uses[page] >= self.max_uses
+            or len(self.idle) >= self.size
+        ):
+            await self.discard(page)
+        else:
+            self.idle.append(page)
+        self.refill()
+
+    async def is_healthy(self, page: "Page") -> bool:
+        if page.is_closed():
+            return False
+        try:
+            return await self.check(page)
+        except Exception as e:
+            logger.opt(exception=e).debug("页面健康检查失败")
+            return False
+
+    async def create(self) -> "Page":
+        page = await self.factory()
+        self.uses[page] = 0
+        return page
+
+    async def discard(self, page: "Page") -> None:
+        self.uses.pop(page, None)
+        if not page.is_closed():
+            try:
+                await page.close()
+            except Exception as e:
+                logger.opt(exception=e).debug("关闭页面失败")
+
+    def reopen(self) -> None:
+        """浏览器重启后重新开始使用页面池"""
+        self.closed = False
+        self.refill()
+
+    def refill(self) -> None:
+        """在后台补充空闲页面"""
+        if self.closed or len(self.idle) >= self.size:
+            return
+        if self.refilling is None or self.refilling.done():
+            # 在空白上下文中运行，避免后台任务的耗时计入触发它的请求
+            self.refilling = contextvars.Context().run(
+                asyncio.create_task, self._refill()
+            )
+
+    async def wait(self) -> None:
+        """等待正在进行的预热完成"""
+        if self.refilling and not self.refilling.done():
+            await asyncio.shield(self.refilling)
+
+    async def _refill(self) -> None:
+        while not self.closed and len(self.idle) < self.size:
+            try:
+                page = await self.create()
+            except Exception as e:
+                logger.opt(exception=e).warning("页面池预热失败")
+                return
+            if self.closed:
+                await self.discard(page)
+                return
+            self.idle.append(page)
+        logger.debug(f"页面池已就绪，空闲页面数: {len(self.idle)}")
+
+    async def close(self) -> None:
+        self.closed = True
+        if self.refilling and not self.refilling.done():
+            self.refilling.cancel()
+        while self.idle:
+            await self.discard(self.idle.popleft())
@@ -0,0 +1,150 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import (
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Generic,
+    Hashable,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+from .metrics import metrics
+
+T = TypeVar("T")
+
+
+class FairQueue:
+    """请求调度器
+
+    限制全局同时进行的请求数，同一会话内的请求按顺序依次执行，
+    不同会话之间轮流获得执行机会。
+    """
+
+    def __init__(self, limit: int = 1) -> None:
+        self.limit = max(limit, 1)
+        self.running = 0
+        self.waiting: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self.busy: Set[str] = set()
+
+    @property
+    def depth(self) -> int:
+        """正在排队的请求数"""
+        return sum(len(waiters) for waiters in self.waiting.values())
+
+    def ahead(self, sid: str) -> Optional[int]:
+        """会话新请求需要排队时返回已经在排队的请求数，可以立即执行时返回 None
+
+        会话之间轮流执行，实际等待的轮数可能少于排队的请求数
+        """
+        if (
+            sid not in self.busy
+            and not self.waiting.get(sid)
+            and self.running < self.limit
+        ):
+            return None
+        return self.depth
+
+    @asynccontextmanager
+    async def acquire(self, sid: str) -> AsyncGenerator[None, None]:
+        """获取执行许可，这是一个异步上下文管理器，使用async with调用"""
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(sid, deque()).append(waiter)
+        start = time.monotonic()
+        self.dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(sid)
+            else:
+                self.discard(sid, waiter)
+            raise
+        metrics.record("queue", time.monotonic() - start)
+        try:
+            yield
+        finally:
+            self.release(sid)
+
+    def dispatch(self) -> None:
+        for sid in list(self.waiting):
+            if self.running >= self.limit:
+                return
+            if sid in self.busy:
+                continue
+            waiters = self.waiting.pop(sid)
+            waiter: Optional[asyncio.Future] = None
+            while waiters and (waiter is None or waiter.done()):
+                waiter = waiters.popleft()
+            if waiters:
+                # 重新加入队尾，实现会话之间的轮转
+                self.waiting[sid] = waiters
+            if waiter is None or waiter.done():
+                continue
+            self.busy.add(sid)
+            self.running += 1
+            waiter.set_result(None)
+
+    def release(self, sid: str) -> None:
+        self.busy.discard(sid)
+        self.running -= 1
+        self.dispatch()
+
+    def discard(self, sid: str, waiter: asyncio.Future) -> None:
+        waiters = self.waiting.get(sid)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self.waiting[sid]
+
+
+class SingleFlight(Generic[T]):
+    """合并相同的请求
+
+    同一个 key 的请求在执行期间只会执行一次，期间到达的相同请求等待同一个结果。
+    执行请求的一方被取消时，等待的一方改为自己执行，最先恢复的一方成为新的执行者。
+    kind 用于区分指标中不同用途的合并次数。
+    """
+
+    def __init__(self, kind: str = "chat") -> None:
+        self.kind = kind
+        self.flights: Dict[Hashable, "asyncio.Future[T]"] = {}
+
+    def __len__(self) -> int:
+        return len(self.flights)
+
+    async def run(
+        self, key: Hashable, func: Callable[[], Awaitable[T]]
+    ) -> Tuple[T, bool]:
+        """执行请求，返回结果以及本次调用是否实际执行了请求"""
+        while future := self.flights.get(key):
+            metrics.inc("chatgpt_coalesced_total", kind=self.kind)
+            try:
+                return await asyncio.shield(future), False
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    # 取消的是等待的一方
+                    raise
+        future = asyncio.get_running_loop().create_future()
+        self.flights[key] = future
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved"
+            future.exception()
+            raise
+        finally:
+            del self.flights[key]
+        future.set_result(result)
+        return result, True
@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import os
+import re
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from nonebot.log import logger
+
+from .metrics import metrics
+from .queue import SingleFlight
+
+MARKDOWN_PATTERN = re.compile(
+    r"```|`[^`\n]+`|^\s{0,3}#{1,6}\s|^\s*(?:[-*+]|\d+\.)\s|^\s*>|\|.*\||"
+    r"\*\*|__|\[[^\]]*\]\([^)]*\)|\$",
+    re.MULTILINE,
+)
+
+
+class Renderer:
+    """md_to_pic 的渲染缓存
+
+    渲染结果按 (markdown 内容, 宽度) 缓存，同时限制并发渲染的数量，
+    内容相同的渲染请求只会渲染一次。
+    保存到 cache_dir 的图片超过 disk_size 字节时，清理时删除最久未使用的图片。
+    """
+
+    def __init__(
+        self,
+        width: int = 500,
+        *,
+        cache_size: int = 64,
+        cache_dir: Optional[Path] = None,
+        disk_size: int = 0,
+        workers: int = 2,
+        min_length: int = 0,
+    ) -> None:
+        self.width = width
+        self.cache_size = cache_size
+        self.cache_dir = cache_dir
+        self.disk_size = disk_size
+        self.workers = max(workers, 1)
+        self.min_length = min_length
+        self.cache: "OrderedDict[str, bytes]" = OrderedDict()
+        self.rendering: SingleFlight[bytes] = SingleFlight("render")
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def should_render(self, msg: str) -> bool:
+        """较短且不包含 markdown 语法的回复直接以文字发送"""
+        return len(msg) >= self.min_length or bool(MARKDOWN_PATTERN.search(msg))
+
+    def key(self, msg: str) -> str:
+        return hashlib.sha256(f"{self.width}:{msg}".encode()).hexdigest()
+
+    async def render(self, msg: str) -> bytes:
+        key = self.key(msg)
+        if img := self.cache.get(key):
+            self.cache.move_to_end(key)
+            metrics.inc("chatgpt_render_cache_total", result="hit")
+            return img
+        img, leader = await self.rendering.run(key, lambda: self.produce(key, msg))
+        if not leader:
+            metrics.inc("chatgpt_render_cache_total", result="shared")
+        return img
+
+    async def produce(self, key: str, msg: str) -> bytes:
+        """从磁盘缓存中读取或重新渲染"""
+        metrics.inc("chatgpt_render_cache_total", result="miss")
+        img = await self.load(key)
+        if img is None:
+            img = await self.draw(msg)
+            await self.dump(key, img)
+        self.remember(key, img)
+        return img
+
+    async def draw(self, msg: str) -> bytes:
+        from nonebot_plugin_htmlrender import md_to_pic
+
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.workers)
+        async with self.semaphore:
+            with metrics.timer("render"):
+                return await md_to_pic(msg, width=self.width)
+
+    def remember(self, key: str, img: bytes) -> None:
+        self.cache[key] = img
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def load(self, key: str) -> Optional[bytes]:
+        if not self.cache_dir:
+            return None
+        path = self.cache_dir / f"{key}.png"
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, self.read, path)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def read(path: Path) -> bytes:
+        img = path.read_bytes()
+        # 更新修改时间，清理时按修改时间删除最久未使用的图片
+        os.utime(path)
+        return img
+
+    async def dump(self, key: str, img: bytes) -> None:
+        if not self.cache_dir:
+            return
+        path = self.cache_dir / f"{key}.png"
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, path.write_bytes, img)
+        except OSError as e:
+            logger.opt(exception=e).warning("保存图片缓存失败")
+
+    def sweep(self) -> int:
+        """删除超出大小上限的最久未使用的图片，返回删除的数量，会进行阻塞的文件操作"""
+        if not self.cache_dir or self.disk_size <= 0:
+            return 0
+        files = []
+        for path in self.cache_dir.glob("*.png"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        count = 0
+        for _, size, path in sorted(files):
+            if total <= self.disk_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            count += 1
+        return count
@@ -0,0 +1,49 @@
+import random
+import time
+from dataclasses import dataclass
+
+from .errors import ChatTimeout
+
+
+@dataclass
+class RetryPolicy:
+    """请求各阶段的超时时间和重试策略，时间单位均为秒
+
+    navigation: 打开页面
+    challenge: cf 验证
+    send: 发送消息到收到响应头
+    stream: 读取回复时两段内容之间的最长间隔
+    total: 单次请求包括重试在内的总时间
+    hedge: 第一个页面超过该时间没有响应时在第二个页面上同时发送，为 0 时不启用
+    """
+
+    navigation: float = 30
+    challenge: float = 20
+    send: float = 30
+    stream: float = 30
+    total: float = 120
+    attempts: int = 3
+    backoff: float = 1
+    backoff_max: float = 8
+    hedge: float = 0
+
+    def delay(self, attempt: int) -> float:
+        """第 attempt 次失败后重试前的等待时间，指数退避并加入随机抖动"""
+        return random.uniform(0, min(self.backoff * 2 ** (attempt - 1), self.backoff_max))
+
+
+class Deadline:
+    """单次请求的剩余时间"""
+
+    def __init__(self, budget: float) -> None:
+        self.expires = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return self.expires - time.monotonic()
+
+    def timeout(self, limit: float) -> float:
+        """某个阶段可用的时间，不超过剩余时间，没有剩余时间时抛出 ChatTimeout"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise ChatTimeout("total")
+        return min(limit, remaining)
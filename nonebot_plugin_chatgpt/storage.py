@@ -0,0 +1,243 @@
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from nonebot.log import logger
+
+from .config import config
+from .data import get_setting
+
+# (会话ID, 父消息ID, 创建会话的账号)
+History = List[Tuple[Optional[str], Optional[str], Optional[str]]]
+
+
+class Storage:
+    """会话数据的存储接口
+
+    persistent 为 True 时会话记录写入存储，内存中的会话记录被淘汰后可以重新读取，
+    shared 为 True 时存储由多个进程共用，调用方不应在内存中缓存会话记录
+    """
+
+    persistent = False
+    shared = False
+
+    def save(
+        self,
+        sid: str,
+        name: str,
+        conversation_id: Optional[str],
+        parent_id: Optional[str],
+        account: Optional[str] = None,
+    ) -> None:
+        """保存会话"""
+        raise NotImplementedError
+
+    def find(self, sid: str) -> Dict[str, Dict[str, Any]]:
+        """获取已保存的所有会话"""
+        raise NotImplementedError
+
+    def load_history(self, sid: str) -> History:
+        """读取可回滚的会话记录，从旧到新排列"""
+        return []
+
+    def push(
+        self,
+        sid: str,
+        conversation_id: Optional[str],
+        parent_id: Optional[str],
+        account: Optional[str] = None,
+    ) -> None:
+        """追加一条会话记录"""
+
+    def pop(self, sid: str) -> None:
+        """删除最新的一条会话记录"""
+
+    def clear(self, sid: str) -> None:
+        """删除全部会话记录"""
+
+    def close(self) -> None:
+        """关闭存储"""
+
+
+class JsonStorage(Storage):
+    """保存在 setting.json 中，会话记录只保存在内存中"""
+
+    def save(
+        self,
+        sid: str,
+        name: str,
+        conversation_id: Optional[str],
+        parent_id: Optional[str],
+        account: Optional[str] = None,
+    ) -> None:
+        setting = get_setting()
+        setting.session.setdefault(sid, {})[name] = {
+            "conversation_id": conversation_id,
+            "parent_id": parent_id,
+            "account": account,
+        }
+        setting.save()
+
+    def find(self, sid: str) -> Dict[str, Dict[str, Any]]:
+        return get_setting().session.get(sid, {})
+
+
+class SqliteStorage(Storage):
+    """保存在 SQLite 数据库中，会话记录在重启后仍然保留
+
+    各个方法会在不同的线程中调用，同一个连接上的操作需要依次进行
+    """
+
+    persistent = True
+
+    def __init__(self, path: Path, max_history: int, shared: bool = False) -> None:
+        self.max_history = max_history
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False, timeout=5
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS saved (
+                sid TEXT NOT NULL,
+                name TEXT NOT NULL,
+                conversation_id TEXT,
+                parent_id TEXT,
+                account TEXT,
+                PRIMARY KEY (sid, name)
+            );
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sid TEXT NOT NULL,
+                conversation_id TEXT,
+                parent_id TEXT,
+                account TEXT
+            );
+            CREATE INDEX IF NOT EXISTS history_sid ON history (sid, id);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            """
+        )
+        self.add_account_column()
+        self.migrate()
+
+    def add_account_column(self) -> None:
+        """旧版本的数据库没有记录创建会话的账号"""
+        for table in ("saved", "history"):
+            columns = [row[1] for row in self.db.execute(f"PRAGMA table_info({table})")]
+            if "account" not in columns:
+                self.db.execute(f"ALTER TABLE {table} ADD COLUMN account TEXT")
+
+    def migrate(self) -> None:
+        """将 setting.json 中已保存的会话导入数据库，只执行一次"""
+        if self.db.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone():
+            return
+        rows = [
+            (
+                sid,
+                name,
+                cvst.get("conversation_id"),
+                cvst.get("parent_id"),
+                cvst.get("account"),
+            )
+            for sid, saved in get_setting().session.items()
+            for name, cvst in saved.items()
+        ]
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO saved VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self.db.execute("INSERT INTO meta VALUES ('migrated', '1')")
+        if rows:
+            logger.info(f"已将 {len(rows)} 条已保存的会话导入数据库")
+
+    def save(
+        self,
+        sid: str,
+        name: str,
+        conversation_id: Optional[str],
+        parent_id: Optional[str],
+        account: Optional[str] = None,
+    ) -> None:
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO saved VALUES (?, ?, ?, ?, ?)",
+                (sid, name, conversation_id, parent_id, account),
+            )
+
+    def find(self, sid: str) -> Dict[str, Dict[str, Any]]:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name, conversation_id, parent_id, account FROM saved "
+                "WHERE sid = ?",
+                (sid,),
+            ).fetchall()
+        return {
+            name: {
+                "conversation_id": conversation_id,
+                "parent_id": parent_id,
+                "account": account,
+            }
+            for name, conversation_id, parent_id, account in rows
+        }
+
+    def load_history(self, sid: str) -> History:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT conversation_id, parent_id, account FROM history "
+                "WHERE sid = ? ORDER BY id",
+                (sid,),
+            ).fetchall()
+        return rows
+
+    def push(
+        self,
+        sid: str,
+        conversation_id: Optional[str],
+        parent_id: Optional[str],
+        account: Optional[str] = None,
+    ) -> None:
+        with self.lock, self.db:
+            self.db.execute("BEGIN")
+            self.db.execute(
+                "INSERT INTO history (sid, conversation_id, parent_id, account) "
+                "VALUES (?, ?, ?, ?)",
+                (sid, conversation_id, parent_id, account),
+            )
+            self.db.execute(
+                "DELETE FROM history WHERE sid = ? AND id NOT IN "
+                "(SELECT id FROM history WHERE sid = ? ORDER BY id DESC LIMIT ?)",
+                (sid, sid, self.max_history),
+            )
+
+    def pop(self, sid: str) -> None:
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM history WHERE id = "
+                "(SELECT MAX(id) FROM history WHERE sid = ?)",
+                (sid,),
+            )
+
+    def clear(self, sid: str) -> None:
+        with self.lock:
+            self.db.execute("DELETE FROM history WHERE sid = ?", (sid,))
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def create_storage() -> Storage:
+    if config.chatgpt_storage == "sqlite" or config.chatgpt_shared:
+        return SqliteStorage(
+            config.chatgpt_data / "chatgpt.db",
+            config.chatgpt_max_rollback,
+            shared=config.chatgpt_shared,
+        )
+    return JsonStorage()
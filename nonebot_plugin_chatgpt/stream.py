@@ -0,0 +1,70 @@
+from typing import List, Optional
+
+try:
+    import ujson as json
+except ModuleNotFoundError:
+    import json
+
+
+class EventStreamParser:
+    """增量解析 ChatGPT 返回的 text/event-stream
+
+    ChatGPT 每一帧都会返回到目前为止的完整回复，解析器记录已经输出的部分，
+    每次喂入数据后只返回新增的内容。
+    """
+
+    def __init__(self) -> None:
+        self.buffer = ""
+        self.text = ""
+        self.message_id: Optional[str] = None
+        self.conversation_id: Optional[str] = None
+        self.error: Optional[str] = None
+        self.done = False
+
+    def feed(self, chunk: str) -> List[str]:
+        """喂入一段数据，返回新增的回复内容"""
+        self.buffer += chunk
+        deltas = []
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            if delta := self.parse_line(line.rstrip("\r")):
+                deltas.append(delta)
+        return deltas
+
+    def close(self) -> List[str]:
+        """数据接收完毕，解析缓冲区中剩余的内容"""
+        line, self.buffer = self.buffer, ""
+        delta = self.parse_line(line.rstrip("\r"))
+        return [delta] if delta else []
+
+    def parse_line(self, line: str) -> str:
+        if not line.startswith("data:"):
+            return ""
+        data = line[5:].strip()
+        if data == "[DONE]":
+            self.done = True
+            return ""
+        try:
+            event = json.loads(data)
+        except ValueError:
+            return ""
+        if not isinstance(event, dict):
+            return ""
+        if event.get("error"):
+            self.error = str(event["error"])
+        message = event.get("message")
+        if not message:
+            return ""
+        role = (message.get("author") or {}).get("role", "assistant")
+        if role != "assistant":
+            return ""
+        parts = (message.get("content") or {}).get("parts") or [""]
+        text = parts[0] or ""
+        self.message_id = message.get("id", self.message_id)
+        self.conversation_id = event.get("conversation_id", self.conversation_id)
+        if text.startswith(self.text):
+            delta = text[len(self.text) :]
+        else:
+            delta = ""
+        self.text = text
+        return delta
@@ -0,0 +1,134 @@
+import asyncio
+import os
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from nonebot.log import logger
+
+from .metrics import metrics
+
+if TYPE_CHECKING:
+    from playwright.async_api import Browser, BrowserContext
+
+    from .chatgpt import Chatbot
+    from .dispatcher import Dispatcher
+
+# 页面打开超过该时间仍不属于页面池或临时页面时视为泄漏，单位：秒
+LEAK_AGE = 300
+# 内存超限后等待进行中的请求结束的最长时间，单位：秒
+DRAIN_TIMEOUT = 60
+
+
+def process_tree_rss(pid: Optional[int] = None, *, include_self: bool = True) -> int:
+    """进程及其所有子进程（playwright 驱动和浏览器）的常驻内存，单位：字节
+
+    include_self 为 False 时只统计子进程，仅支持 Linux，无法读取时返回 0
+    """
+    pid = pid or os.getpid()
+    children: Dict[int, List[int]] = {}
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return 0
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    total = 0
+    stack = [pid] if include_self else list(children.get(pid, []))
+    while stack:
+        current = stack.pop()
+        stack.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class Supervisor:
+    """浏览器守护
+
+    监听浏览器断开和浏览器上下文关闭事件，定期关闭泄漏的页面并检查浏览器的内存占用。
+    浏览器断开或内存超限时重启浏览器，单个浏览器上下文意外关闭时只重建该账号的上下文，
+    重启后从保存的浏览器状态中恢复 cookies。
+    """
+
+    def __init__(
+        self, dispatcher: "Dispatcher", *, interval: int = 30, max_rss: int = 0
+    ) -> None:
+        self.dispatcher = dispatcher
+        self.interval = interval
+        self.max_rss = max_rss * 1024 * 1024
+        self.task: Optional[asyncio.Task] = None
+
+    def watch_browser(self, browser: "Browser") -> None:
+        browser.on("disconnected", self.on_disconnected)
+
+    def watch_context(self, bot: "Chatbot") -> None:
+        assert bot.content is not None
+        bot.content.on("close", lambda context: self.on_context_closed(bot, context))
+
+    def on_disconnected(self, browser: "Browser") -> None:
+        # 主动关闭时 dispatcher.browser 已经被清空
+        if browser is self.dispatcher.browser:
+            self.dispatcher.recover("浏览器意外断开")
+
+    def on_context_closed(self, bot: "Chatbot", context: "BrowserContext") -> None:
+        # 主动关闭时 bot.content 已经被清空，浏览器断开时由 on_disconnected 处理
+        browser = self.dispatcher.browser
+        if context is bot.content and browser and browser.is_connected():
+            self.dispatcher.rebuild(bot)
+
+    def start(self) -> None:
+        if self.interval > 0 and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task and not self.task.done():
+            self.task.cancel()
+        self.task = None
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.opt(exception=e).warning("检查浏览器状态失败")
+
+    async def check(self) -> None:
+        dispatcher = self.dispatcher
+        if not dispatcher.ready or dispatcher.browser is None:
+            return
+        if not dispatcher.browser.is_connected():
+            dispatcher.recover("浏览器已断开")
+            return
+        for bot in dispatcher.bots:
+            if leaked := await bot.close_leaked_pages(LEAK_AGE):
+                metrics.inc("chatgpt_page_leaks_total", leaked)
+                logger.warning(f"账号 {bot.name} 有 {leaked} 个页面未被关闭，已自动关闭")
+        if self.max_rss and (rss := process_tree_rss(include_self=False)) > self.max_rss:
+            logger.warning(
+                f"浏览器内存占用 {rss / 1024 / 1024:.0f} MiB 超过上限，"
+                "等待进行中的请求结束后重启"
+            )
+            await self.drain()
+            dispatcher.recover("浏览器内存占用过高")
+
+    async def drain(self) -> None:
+        """等待进行中的请求结束，最多等待 DRAIN_TIMEOUT 秒"""
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while time.monotonic() < deadline and any(
+            bot.load for bot in self.dispatcher.bots
+        ):
+            await asyncio.sleep(1)
@@ -0,0 +1,136 @@
+import base64
+import json
+import time
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Dict, Optional
+
+import httpx
+from nonebot.log import logger
+
+if TYPE_CHECKING:
+    from playwright.async_api import BrowserContext
+
+ACCESS_TOKEN_TTL = 600
+# access token 在过期前多久重新获取，单位：秒
+ACCESS_TOKEN_MARGIN = 60
+
+
+def token_expiry(token: str) -> Optional[float]:
+    """读取 JWT 格式的 access token 中的过期时间，无法读取时返回 None"""
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TransportError(Exception):
+    """HTTP 请求无法完成，需要改用浏览器发送"""
+
+
+class HttpTransport:
+    """直接通过 HTTP 请求 ChatGPT 接口
+
+    浏览器只负责获取和刷新 cookies，对话请求使用带连接池的 HTTP 客户端发送，
+    并沿用浏览器的 cookies 和 User-Agent。
+    """
+
+    def __init__(
+        self, api: str, proxies: Optional[str] = None, timeout: int = 10
+    ) -> None:
+        self.api_url = api.rstrip("/") + "/"
+        self.proxies = proxies
+        self.timeout = timeout
+        self.client: Optional[httpx.AsyncClient] = None
+        self.access_token: Optional[str] = None
+        self.access_token_expires = 0.0
+
+    async def sync(self, context: "BrowserContext", user_agent: str) -> None:
+        """从浏览器上下文同步 cookies"""
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                proxy=self.proxies,
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=60),
+            )
+        self.client.headers["User-Agent"] = user_agent
+        self.client.cookies.clear()
+        for cookie in await context.cookies(self.api_url):
+            self.client.cookies.set(
+                cookie["name"],
+                cookie["value"],
+                domain=cookie["domain"],
+                path=cookie["path"],
+            )
+
+    def invalidate(self) -> None:
+        self.access_token = None
+        self.access_token_expires = 0.0
+
+    async def get_access_token(self, timeout: Optional[float] = None) -> str:
+        if self.access_token and time.time() < self.access_token_expires:
+            return self.access_token
+        assert self.client is not None
+        try:
+            response = await self.client.get(
+                f"{self.api_url}api/auth/session",
+                timeout=timeout or httpx.USE_CLIENT_DEFAULT,
+            )
+        except httpx.HTTPError as e:
+            raise TransportError(f"获取 access token 失败: {e!r}") from e
+        if response.status_code != 200:
+            raise TransportError(f"获取 access token 失败: HTTP{response.status_code}")
+        try:
+            access_token = response.json().get("accessToken")
+        except ValueError:
+            access_token = None
+        if not access_token:
+            raise TransportError("获取 access token 失败: session 已失效")
+        self.access_token = access_token
+        if expires := token_expiry(access_token):
+            self.access_token_expires = expires - ACCESS_TOKEN_MARGIN
+        else:
+            self.access_token_expires = time.time() + ACCESS_TOKEN_TTL
+        return access_token
+
+    @asynccontextmanager
+    async def stream(
+        self, payload: Dict[str, Any], timeout: Optional[float] = None
+    ) -> AsyncGenerator[httpx.Response, None]:
+        """发送对话请求，这是一个异步上下文管理器，使用async with调用
+
+        timeout 为连接和每次读取的超时时间，未指定时使用创建客户端时的超时时间
+        """
+        access_token = await self.get_access_token(timeout)
+        assert self.client is not None
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Accept": "text/event-stream",
+            "Content-Type": "application/json",
+            "Referer": f"{self.api_url}chat",
+        }
+        request = self.client.build_request(
+            "POST",
+            f"{self.api_url}backend-api/conversation",
+            json=payload,
+            headers=headers,
+            timeout=timeout or httpx.USE_CLIENT_DEFAULT,
+        )
+        try:
+            response = await self.client.send(request, stream=True)
+        except httpx.HTTPError as e:
+            raise TransportError(f"发送请求失败: {e!r}") from e
+        try:
+            if response.status_code in (401, 403):
+                self.invalidate()
+                raise TransportError(f"请求被拒绝: HTTP{response.status_code}")
+            yield response
+        finally:
+            await response.aclose()
+
+    async def close(self) -> None:
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+            logger.debug("HTTP 客户端已关闭")
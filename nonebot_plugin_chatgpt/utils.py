@@ -1,41 +1,35 @@
-from collections import defaultdict, deque
+import asyncio
+import sys
+import time
+from collections import OrderedDict, deque
 from typing import (
     Any,
-    AsyncGenerator,
+    Callable,
+    Deque,
     Dict,
     List,
     Literal,
     Optional,
     Tuple,
     Type,
+    TypeVar,
     Union,
 )
 
 from nonebot import on_command, on_message
 from nonebot.adapters.onebot.v11 import GROUP, GroupMessageEvent, MessageEvent
+from nonebot.log import logger
 from nonebot.matcher import Matcher
-from nonebot.params import Depends
 from nonebot.rule import to_me
 
 from .config import config
-from .data import setting
+from .storage import History, Storage
 
+# 使用 sqlite 存储时的默认会话数上限和存活时间，单位：秒
+DEFAULT_SESSION_LIMIT = 10000
+DEFAULT_SESSION_TTL = 86400
 
-def cooldow_checker(cd_time: int) -> Any:
-    cooldown = defaultdict(int)
-
-    async def check_cooldown(
-        matcher: Matcher, event: MessageEvent
-    ) -> AsyncGenerator[None, None]:
-        cooldown_time = cooldown[event.user_id] + cd_time
-        if event.time < cooldown_time:
-            await matcher.finish(
-                f"ChatGPT 冷却中，剩余 {cooldown_time - event.time} 秒", at_sender=True
-            )
-        yield
-        cooldown[event.user_id] = event.time
-
-    return Depends(check_cooldown)
+T = TypeVar("T")
 
 
 def create_matcher(
@@ -66,46 +60,144 @@ def create_matcher(
     return on_matcher(**params)
 
 
-class Session(dict):
-    def __init__(self, scope: Literal["private", "public"]) -> None:
-        super().__init__()
-        self.is_private = scope == "private"
+class Entry:
+    """会话记录，保存最近的 (会话ID, 父消息ID, 创建会话的账号)"""
 
-    def __getitem__(self, event: MessageEvent) -> Dict[str, Any]:
-        return super().__getitem__(self.id(event))
+    __slots__ = ("history", "last_used")
 
-    def __setitem__(
+    def __init__(self, history: History) -> None:
+        self.history: Deque[Tuple[Optional[str], Optional[str], Optional[str]]] = deque(
+            history, maxlen=config.chatgpt_max_rollback
+        )
+        self.last_used = time.monotonic()
+
+    def size(self) -> int:
+        return (
+            sys.getsizeof(self)
+            + sys.getsizeof(self.history)
+            + sum(
+                sys.getsizeof(item) + sum(sys.getsizeof(i) for i in item)
+                for item in self.history
+            )
+        )
+
+
+class Session:
+    """会话记录表
+
+    超过数量上限时淘汰最久未使用的会话，超过存活时间的会话会被定期清理。
+    使用 sqlite 存储时会话记录已经写入数据库，被淘汰的会话在下次使用时重新读取。
+    会话记录只保存在内存中时，被淘汰的会话无法恢复，因此 limit 和 ttl 为 None 时不淘汰。
+    存储由多个进程共用时不在内存中缓存，每次都从存储中读取。
+    读写 sqlite 存储的操作在线程中进行，因此访问会话记录的方法都是异步的。
+    """
+
+    def __init__(
+        self,
+        scope: Literal["private", "public"],
+        storage: Storage,
+        *,
+        limit: Optional[int] = None,
+        ttl: Optional[int] = None,
+    ) -> None:
+        self.is_private = scope == "private"
+        self.storage = storage
+        if storage.persistent:
+            self.limit = DEFAULT_SESSION_LIMIT if limit is None else limit
+            self.ttl = DEFAULT_SESSION_TTL if ttl is None else ttl
+        else:
+            self.limit = limit or 0
+            self.ttl = ttl or 0
+            if self.limit or self.ttl:
+                logger.warning("会话记录只保存在内存中，被淘汰或清理的会话将丢失上下文")
+        self.entries: "OrderedDict[str, Entry]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    async def call(self, func: Callable[..., T], *args: Any) -> T:
+        """使用 sqlite 存储时在线程中访问数据库，避免阻塞事件循环"""
+        if not self.storage.persistent:
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def load(
+        self, event: MessageEvent
+    ) -> Deque[Tuple[Optional[str], Optional[str], Optional[str]]]:
+        """读取可回滚的会话记录，从旧到新排列"""
+        entry = await self.get(self.id(event))
+        return entry.history if entry else deque()
+
+    async def push(
         self,
         event: MessageEvent,
-        value: Union[Tuple[Optional[str], Optional[str]], Dict[str, Any]],
+        value: Union[Tuple[Optional[str], ...], Dict[str, Any]],
     ) -> None:
+        """value 为 (会话ID, 父消息ID, 账号) 或已保存的会话，不知道账号时可以省略"""
         if isinstance(value, tuple):
-            conversation_id, parent_id = value
+            conversation_id, parent_id, account = (value + (None,))[:3]
         else:
             conversation_id = value["conversation_id"]
             parent_id = value["parent_id"]
-        if self[event]:
-            if isinstance(value, tuple):
-                self[event]["conversation_id"].append(conversation_id)
-                self[event]["parent_id"].append(parent_id)
-        else:
-            super().__setitem__(
-                self.id(event),
-                {
-                    "conversation_id": deque(
-                        [conversation_id], maxlen=config.chatgpt_max_rollback
-                    ),
-                    "parent_id": deque([parent_id], maxlen=config.chatgpt_max_rollback),
-                },
-            )
-
-    def __delitem__(self, event: MessageEvent) -> None:
+            account = value.get("account")
         sid = self.id(event)
-        if sid in self:
-            super().__delitem__(sid)
-
-    def __missing__(self, _) -> Dict[str, Any]:
-        return {}
+        item = conversation_id, parent_id, account
+        if entry := await self.get(sid):
+            entry.history.append(item)
+        elif not self.storage.shared:
+            # 读取存储期间其他请求可能已经创建了这个会话
+            self.entries.setdefault(sid, Entry([])).history.append(item)
+            self.evict()
+        await self.call(self.storage.push, sid, conversation_id, parent_id, account)
+
+    async def clear(self, event: MessageEvent) -> None:
+        sid = self.id(event)
+        self.entries.pop(sid, None)
+        await self.call(self.storage.clear, sid)
+
+    async def get(self, sid: str) -> Optional[Entry]:
+        if self.storage.shared:
+            history = await self.call(self.storage.load_history, sid)
+            return Entry(history) if history else None
+        if entry := self.entries.get(sid):
+            self.entries.move_to_end(sid)
+        elif history := await self.call(self.storage.load_history, sid):
+            entry = self.entries.setdefault(sid, Entry(history))
+            self.evict()
+        else:
+            return None
+        entry.last_used = time.monotonic()
+        return entry
+
+    def evict(self) -> None:
+        while self.limit > 0 and len(self.entries) > self.limit:
+            self.entries.popitem(last=False)
+
+    def sweep(self) -> int:
+        """清除超过存活时间的会话，返回清除的数量"""
+        if self.ttl <= 0:
+            return 0
+        expired = time.monotonic() - self.ttl
+        count = 0
+        while self.entries:
+            sid, entry = next(iter(self.entries.items()))
+            if entry.last_used > expired:
+                break
+            del self.entries[sid]
+            count += 1
+        return count
+
+    def stats(self) -> Dict[str, int]:
+        """会话数量和估算的内存占用（字节）"""
+        return {
+            "entries": len(self.entries),
+            "memory": sys.getsizeof(self.entries)
+            + sum(
+                sys.getsizeof(sid) + entry.size()
+                for sid, entry in self.entries.items()
+            ),
+        }
 
     def id(self, event: MessageEvent) -> str:
         if self.is_private:
@@ -114,24 +206,21 @@ class Session(dict):
             event.group_id if isinstance(event, GroupMessageEvent) else event.user_id
         )
 
-    def save(self, name: str, event: MessageEvent) -> None:
-        sid = self.id(event)
-        if setting.session.get(sid) is None:
-            setting.session[sid] = {}
-        setting.session[sid][name] = {
-            "conversation_id": self[event]["conversation_id"][-1],
-            "parent_id": self[event]["parent_id"][-1],
-        }
-        setting.save()
+    async def save(self, name: str, event: MessageEvent) -> None:
+        conversation_id, parent_id, account = (await self.load(event))[-1]
+        await self.call(
+            self.storage.save, self.id(event), name, conversation_id, parent_id, account
+        )
 
-    def find(self, event: MessageEvent) -> Dict[str, Any]:
-        sid = self.id(event)
-        return setting.session[sid]
+    async def find(self, event: MessageEvent) -> Dict[str, Any]:
+        return await self.call(self.storage.find, self.id(event))
 
-    def count(self, event: MessageEvent) -> int:
-        return len(self[event]["conversation_id"])
+    async def count(self, event: MessageEvent) -> int:
+        return len(await self.load(event))
 
-    def pop(self, event: MessageEvent) -> Tuple[str, str]:
-        conversation_id = self[event]["conversation_id"].pop()
-        parent_id = self[event]["parent_id"].pop()
-        return conversation_id, parent_id
+    async def pop(
+        self, event: MessageEvent
+    ) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+        conversation_id, parent_id, account = (await self.load(event)).pop()
+        await self.call(self.storage.pop, self.id(event))
+        return conversation_id, parent_id, account
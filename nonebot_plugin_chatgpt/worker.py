@@ -0,0 +1,239 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncGenerator, Dict, List, Optional
+
+from nonebot.log import logger
+
+from .chatgpt import ChatContext, new_id
+from .dispatcher import ChatDispatcher
+from .errors import (
+    BrowserUnavailable,
+    ChatError,
+    SessionExpired,
+    dump_error,
+    load_error,
+)
+from .queue import FairQueue
+
+try:
+    import ujson as json
+except ModuleNotFoundError:
+    import json
+
+# 单行消息的长度上限，完整的回复会放在最后一行中返回
+LINE_LIMIT = 16 * 1024 * 1024
+
+
+def encode(data: Dict[str, Any]) -> bytes:
+    return json.dumps(data, ensure_ascii=False).encode() + b"\n"
+
+
+class WorkerServer:
+    """浏览器进程
+
+    在 Unix socket 上接收其他机器人进程的请求，使用本进程的浏览器发送并逐段返回回复。
+    请求和本进程的请求一起按 sid 在 queue 中排队，所有进程的请求共用同一个并发上限。
+    每个连接处理一个请求，请求和响应都是一行一个 JSON：
+
+        -> {"prompt": ..., "sid": ..., "conversation_id": ..., "parent_id": ..., "account": ...}
+        <- {"delta": ...}
+        <- {"done": {"conversation_id": ..., "parent_id": ..., "account": ..., "status": ..., "reply": ...}}
+        <- {"error": {"type": ..., ...}}
+    """
+
+    def __init__(
+        self, dispatcher: ChatDispatcher, path: Path, queue: FairQueue
+    ) -> None:
+        self.dispatcher = dispatcher
+        self.path = path
+        self.queue = queue
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        if self.path.exists():
+            # 上次退出时未删除的 socket 文件
+            self.path.unlink()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.server = await asyncio.start_unix_server(
+            self.handle, str(self.path), limit=LINE_LIMIT
+        )
+        os.chmod(self.path, 0o600)
+        logger.info(f"ChatGPT 浏览器进程已在 {self.path} 上等待请求")
+
+    async def close(self) -> None:
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request = json.loads(await reader.readline())
+            await self.serve(request, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            logger.debug("机器人进程已断开连接")
+        except Exception as e:
+            logger.opt(exception=e).error("处理机器人进程的请求失败")
+        finally:
+            writer.close()
+
+    async def serve(self, request: Dict[str, Any], writer: asyncio.StreamWriter) -> None:
+        context = ChatContext.from_history(
+            [
+                (
+                    request.get("conversation_id"),
+                    request.get("parent_id"),
+                    request.get("account"),
+                )
+            ]
+        )
+        prompt = request["prompt"]
+        # 旧版本的机器人进程不会发送 sid，此时每个请求单独排队
+        sid = request.get("sid") or new_id()
+        try:
+            async with self.queue.acquire(sid), self.dispatcher.acquire(context) as bot:
+                try:
+                    await self.stream(bot.stream_chat_response(prompt, context), writer)
+                except SessionExpired:
+                    if context.reply or not await bot.tokens.recover(
+                        self.dispatcher.configured.get(bot.name)
+                    ):
+                        raise
+                    await self.stream(bot.stream_chat_response(prompt, context), writer)
+        except BrowserUnavailable:
+            writer.write(encode({"error": {"type": "BrowserUnavailable"}}))
+        except ChatError as e:
+            writer.write(encode({"error": dump_error(e), "status": context.status}))
+        else:
+            writer.write(
+                encode(
+                    {
+                        "done": {
+                            "conversation_id": context.conversation_id,
+                            "parent_id": context.parent_id,
+                            "account": context.account,
+                            "status": context.status,
+                            "reply": context.reply,
+                        }
+                    }
+                )
+            )
+        await writer.drain()
+
+    @staticmethod
+    async def stream(
+        deltas: AsyncGenerator[str, None], writer: asyncio.StreamWriter
+    ) -> None:
+        """机器人进程断开时立即关闭 deltas，释放正在使用的页面"""
+        try:
+            async for delta in deltas:
+                writer.write(encode({"delta": delta}))
+                await writer.drain()
+        finally:
+            await deltas.aclose()
+
+
+class RemoteTokens:
+    """浏览器进程已经处理过 session 过期，机器人进程无需再次处理"""
+
+    async def recover(self, configured: Optional[str] = None) -> bool:
+        return False
+
+
+class RemoteChatbot:
+    """通过 Unix socket 将请求转发给浏览器进程，实现 ChatBackend 接口"""
+
+    name = "worker"
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.tokens = RemoteTokens()
+
+    async def get_chat_response(
+        self, prompt: str, context: Optional[ChatContext] = None
+    ) -> str:
+        stream = self.stream_chat_response(prompt, context)
+        return "".join([delta async for delta in stream])
+
+    async def stream_chat_response(
+        self, prompt: str, context: Optional[ChatContext] = None
+    ) -> AsyncGenerator[str, None]:
+        context = context or ChatContext()
+        context.prompt = prompt
+        try:
+            reader, writer = await asyncio.open_unix_connection(
+                str(self.path), limit=LINE_LIMIT
+            )
+        except OSError as e:
+            raise BrowserUnavailable(f"无法连接浏览器进程: {e}") from e
+        try:
+            writer.write(
+                encode(
+                    {
+                        "prompt": prompt,
+                        "sid": context.sid,
+                        "conversation_id": context.conversation_id,
+                        "parent_id": context.parent_id,
+                        "account": context.account,
+                    }
+                )
+            )
+            await writer.drain()
+            while line := await reader.readline():
+                message = json.loads(line)
+                if "delta" in message:
+                    yield message["delta"]
+                elif "done" in message:
+                    done = message["done"]
+                    context.conversation_id = done["conversation_id"]
+                    context.parent_id = done["parent_id"]
+                    context.account = done.get("account")
+                    context.status = done["status"]
+                    context.reply = done["reply"]
+                    return
+                elif "error" in message:
+                    error = message["error"]
+                    if error["type"] == "BrowserUnavailable":
+                        raise BrowserUnavailable("浏览器进程正在重启")
+                    context.status = message.get("status")
+                    raise load_error(error)
+            raise BrowserUnavailable("浏览器进程意外断开")
+        finally:
+            writer.close()
+
+
+class RemoteDispatcher:
+    """浏览器运行在其他进程中时使用的调度器，实现 ChatDispatcher 接口
+
+    账号调度、重试和浏览器守护都在浏览器进程中进行。
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.bots: List[Any] = []
+        self.configured: Dict[str, str] = {}
+        self.ready = True
+        self.bot = RemoteChatbot(path)
+
+    def warm_up(self) -> None:
+        """浏览器由浏览器进程启动"""
+
+    async def wait_ready(self, timeout: float) -> bool:
+        return True
+
+    async def close(self) -> None:
+        """浏览器由浏览器进程关闭"""
+
+    @asynccontextmanager
+    async def acquire(
+        self, context: ChatContext
+    ) -> AsyncGenerator[RemoteChatbot, None]:
+        yield self.bot
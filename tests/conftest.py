@@ -0,0 +1,52 @@
+import tempfile
+from itertools import count
+from typing import Callable, Optional
+
+import nonebot
+import pytest
+
+# 插件在导入时读取配置，需要在收集测试模块之前初始化
+nonebot.init(chatgpt_data=tempfile.mkdtemp(prefix="chatgpt-test-"))
+
+from nonebot.adapters.onebot.v11 import (  # noqa: E402
+    GroupMessageEvent,
+    Message,
+    MessageEvent,
+    PrivateMessageEvent,
+)
+from nonebot.adapters.onebot.v11.event import Sender  # noqa: E402
+
+message_ids = count(1)
+
+
+@pytest.fixture
+def make_event() -> Callable[..., MessageEvent]:
+    def make(user_id: int, group_id: Optional[int] = None) -> MessageEvent:
+        fields = {
+            "time": 0,
+            "self_id": 10000,
+            "post_type": "message",
+            "message_id": next(message_ids),
+            "message": Message("hello"),
+            "original_message": Message("hello"),
+            "raw_message": "hello",
+            "font": 0,
+            "user_id": user_id,
+            "to_me": True,
+        }
+        if group_id is None:
+            return PrivateMessageEvent(
+                message_type="private",
+                sub_type="friend",
+                sender=Sender(user_id=user_id),
+                **fields,
+            )
+        return GroupMessageEvent(
+            message_type="group",
+            sub_type="normal",
+            group_id=group_id,
+            sender=Sender(user_id=user_id, role="member"),
+            **fields,
+        )
+
+    return make
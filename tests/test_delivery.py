@@ -0,0 +1,46 @@
+from nonebot_plugin_chatgpt.delivery import FENCE_PATTERN, split_reply
+
+
+def fences(chunk: str) -> int:
+    return sum(bool(FENCE_PATTERN.match(line)) for line in chunk.split("\n"))
+
+
+def test_short_or_unlimited_reply_is_not_split() -> None:
+    text = "a" * 100
+    assert split_reply(text, 0) == [text]
+    assert split_reply(text, 100) == [text]
+
+
+def test_splits_on_paragraphs() -> None:
+    text = "\n\n".join(["一" * 30, "二" * 30, "三" * 30])
+    assert split_reply(text, 70) == ["一" * 30 + "\n\n" + "二" * 30, "三" * 30]
+
+
+def test_long_line_is_cut() -> None:
+    assert split_reply("x" * 25, 10) == ["x" * 10, "x" * 10, "x" * 5]
+
+
+def test_code_block_is_kept_whole() -> None:
+    code = "```python\nprint(1)\n\nprint(2)\n```"
+    chunks = split_reply("说明" * 10 + "\n\n" + code + "\n\n结束", len(code) + 5)
+    assert any(code in chunk for chunk in chunks)
+
+
+def test_long_code_block_keeps_fences_balanced() -> None:
+    body = "\n".join(f"line = {i}" for i in range(40))
+    text = f"前言\n\n```python\n{body}\n```\n\n结尾"
+    chunks = split_reply(text, 80)
+    assert len(chunks) > 2
+    for chunk in chunks:
+        assert len(chunk) <= 80
+        assert fences(chunk) % 2 == 0
+    code = [chunk for chunk in chunks if "line = " in chunk]
+    assert all("```python\n" in chunk for chunk in code)
+    lines = [line for chunk in code for line in chunk.split("\n") if "line = " in line]
+    assert lines == body.split("\n")
+
+
+def test_tilde_fence_is_not_closed_by_backticks() -> None:
+    text = "~~~\n```\n" + "a\n" * 30 + "~~~"
+    for chunk in split_reply(text, 24):
+        assert chunk.startswith("~~~\n") and chunk.endswith("\n~~~")
@@ -0,0 +1,110 @@
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from nonebot_plugin_chatgpt.history import HistoryLog, Record, history_path
+
+
+def record(
+    n: int, parent: Optional[int] = None, *, root: bool = False, at: float = 0
+) -> Record:
+    return Record(
+        time=at or time.time(),
+        conversation_id="c1",
+        message_id=f"m{n}",
+        parent_id=f"m{parent}" if parent else None,
+        root=root,
+        prompt=f"问题{n}",
+        reply=f"回答{n}",
+    )
+
+
+def ids(records: List[Record]) -> List[str]:
+    return [r.message_id for r in records]
+
+
+def fill(log: HistoryLog, count: int, sid: str = "private_1") -> None:
+    log.append(sid, record(1, root=True))
+    for n in range(2, count + 1):
+        log.append(sid, record(n, n - 1))
+
+
+def test_chain_follows_parents(tmp_path: Path) -> None:
+    log = HistoryLog(tmp_path)
+    fill(log, 4)
+    # 另一个分支
+    log.append("private_1", record(5, 2))
+    assert ids(log.chain("private_1", "m4", 10)) == ["m1", "m2", "m3", "m4"]
+    assert ids(log.chain("private_1", "m5", 10)) == ["m1", "m2", "m5"]
+    assert ids(log.chain("private_1", "m4", 2)) == ["m3", "m4"]
+    assert log.chain("private_1", "unknown", 10) == []
+    assert log.chain("private_2", "m4", 10) == []
+
+
+def test_rollback(tmp_path: Path) -> None:
+    log = HistoryLog(tmp_path)
+    fill(log, 3)
+    assert log.rollback("private_1", "m3", 1) == ("c1", "m2")
+    assert log.rollback("private_1", "m3", 2) == ("c1", "m1")
+    assert log.rollback("private_1", "m3", 3) == (None, None)
+    assert log.rollback("private_1", "m3", 4) is None
+    assert log.rollback("private_1", "missing", 1) is None
+
+
+def test_reads_records_appended_by_other_process(tmp_path: Path) -> None:
+    log = HistoryLog(tmp_path)
+    other = HistoryLog(tmp_path)
+    fill(log, 2)
+    assert log.get("private_1", "m2") is not None
+    other.append("private_1", record(3, 2))
+    assert ids(log.chain("private_1", "m3", 10)) == ["m1", "m2", "m3"]
+    # 写了一半的行不会被读入
+    with history_path(tmp_path, "private_1").open("ab") as f:
+        f.write(record(4, 3).dump()[:10])
+    assert log.get("private_1", "m4") is None
+    assert ids(log.since("private_1", 0)) == ["m1", "m2", "m3"]
+
+
+def test_since(tmp_path: Path) -> None:
+    log = HistoryLog(tmp_path)
+    log.append("group_1", record(1, root=True, at=100))
+    log.append("group_1", record(2, 1, at=200))
+    log.append("group_1", record(3, 2, at=300))
+    assert ids(log.since("group_1", 200)) == ["m2", "m3"]
+    assert log.since("group_1", 301) == []
+
+
+def test_compact_drops_expired_records(tmp_path: Path) -> None:
+    log = HistoryLog(tmp_path, ttl=60)
+    now = time.time()
+    log.append("private_1", record(1, root=True, at=now - 120))
+    log.append("private_1", record(2, 1, at=now - 90))
+    log.append("private_1", record(3, 2, at=now))
+    assert log.sweep() == 2
+    assert ids(log.since("private_1", 0)) == ["m3"]
+    assert log.get("private_1", "m1") is None
+    # 全部过期时删除文件
+    log.append("private_2", record(1, root=True, at=now - 120))
+    assert log.sweep() == 1
+    assert not history_path(tmp_path, "private_2").exists()
+
+
+def test_append_keeps_newest_half_when_too_large(tmp_path: Path) -> None:
+    size = len(record(10, 9).dump())
+    log = HistoryLog(tmp_path, max_size=size * 10)
+    fill(log, 30)
+    path = history_path(tmp_path, "private_1")
+    assert path.stat().st_size <= size * 10
+    kept = ids(log.since("private_1", 0))
+    assert kept[-1] == "m30"
+    assert kept == [f"m{n}" for n in range(31 - len(kept), 31)]
+    assert ids(log.chain("private_1", "m30", 3)) == ["m28", "m29", "m30"]
+
+
+def test_compact_keeps_latest_record(tmp_path: Path) -> None:
+    log = HistoryLog(tmp_path, max_size=1)
+    log.append("private_1", record(1, root=True))
+    log.append("private_1", record(2, 1))
+    assert ids(log.since("private_1", 0)) == ["m2"]
+    assert log.compact(history_path(tmp_path, "private_1")) == 0
+    assert log.compact(history_path(tmp_path, "missing")) == 0
@@ -0,0 +1,113 @@
+import math
+from pathlib import Path
+from typing import Callable, Iterator, List
+
+import pytest
+from nonebot.adapters.onebot.v11 import MessageEvent
+
+from nonebot_plugin_chatgpt.limiter import (
+    MIN_SCALE,
+    BucketStore,
+    RateLimiter,
+    SqliteBucketStore,
+    TokenBucket,
+)
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_token_bucket_refill() -> None:
+    bucket = TokenBucket(2, now=0)
+    bucket.tokens = 0
+    assert bucket.wait_time(0.5) == 2
+    assert bucket.wait_time(0) == math.inf
+    bucket.refill(0.5, now=1)
+    assert bucket.tokens == 0.5
+    assert bucket.wait_time(0.5) == 1
+    bucket.refill(0.5, now=100)
+    assert bucket.tokens == 2
+    assert bucket.full
+    assert bucket.wait_time(0.5) == 0
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request: pytest.FixtureRequest, tmp_path: Path) -> Iterator[BucketStore]:
+    store = (
+        BucketStore() if request.param == "memory" else SqliteBucketStore(tmp_path / "limiter.db")
+    )
+    store.clock = Clock()  # type: ignore[assignment]
+    yield store
+    store.close()
+
+
+async def test_user_burst_and_refill(
+    store: BucketStore, make_event: Callable[..., MessageEvent]
+) -> None:
+    limiter = RateLimiter(user_rate=0.5, user_burst=2, store=store)
+    event = make_event(1)
+    assert await limiter.call(limiter.acquire, event) is None
+    assert await limiter.call(limiter.acquire, event) is None
+    assert await limiter.call(limiter.acquire, event) == ("user", 2)
+    # 其他用户不受影响
+    assert await limiter.call(limiter.acquire, make_event(2)) is None
+    store.clock.now += 2  # type: ignore[attr-defined]
+    assert await limiter.call(limiter.acquire, event) is None
+
+
+async def test_group_limit_reports_longest_wait(
+    store: BucketStore, make_event: Callable[..., MessageEvent]
+) -> None:
+    limiter = RateLimiter(user_rate=1, group_rate=0.1, store=store)
+    assert await limiter.call(limiter.acquire, make_event(1, 10)) is None
+    assert await limiter.call(limiter.acquire, make_event(1, 10)) == ("group", 10)
+    assert await limiter.call(limiter.acquire, make_event(2, 10)) == ("group", 10)
+    # 被拒绝的请求不扣除其他令牌桶
+    assert await limiter.call(limiter.acquire, make_event(2)) is None
+    assert await limiter.call(limiter.acquire, make_event(3, 20)) is None
+
+
+async def test_throttle_and_recover(
+    store: BucketStore, make_event: Callable[..., MessageEvent]
+) -> None:
+    limiter = RateLimiter(global_rate=1, backoff=0.5, recover_time=100, store=store)
+    await limiter.call(limiter.throttle)
+    assert limiter.scale == 0.5
+    for _ in range(10):
+        await limiter.call(limiter.throttle)
+    assert limiter.scale == MIN_SCALE
+    store.clock.now += 45  # type: ignore[attr-defined]
+    assert limiter.scale == pytest.approx(0.55)
+    assert await limiter.call(limiter.acquire, make_event(1)) is None
+    assert await limiter.call(limiter.acquire, make_event(2)) == (
+        "global",
+        pytest.approx(1 / 0.55),
+    )
+    store.clock.now += 100  # type: ignore[attr-defined]
+    assert limiter.scale == 1
+
+
+async def test_sweep_removes_full_buckets(
+    store: BucketStore, make_event: Callable[..., MessageEvent]
+) -> None:
+    limiter = RateLimiter(user_rate=1, group_rate=0.01, store=store)
+    await limiter.call(limiter.acquire, make_event(1, 10))
+    assert len(limiter) == 2
+    store.clock.now += 5  # type: ignore[attr-defined]
+    assert await limiter.call(limiter.sweep) == 1
+    assert len(limiter) == 1
+    store.clock.now += 100  # type: ignore[attr-defined]
+    assert await limiter.call(limiter.sweep) == 1
+    assert len(limiter) == 0
+
+
+def test_disabled_limiter_keeps_no_state(make_event: Callable[..., MessageEvent]) -> None:
+    limiter = RateLimiter()
+    events: List[MessageEvent] = [make_event(1), make_event(1, 10)]
+    assert all(limiter.acquire(event) is None for event in events * 5)
+    assert len(limiter) == 0
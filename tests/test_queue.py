@@ -0,0 +1,170 @@
+import asyncio
+from typing import List
+
+import pytest
+
+from nonebot_plugin_chatgpt.queue import FairQueue, SingleFlight
+
+
+async def test_sessions_take_turns() -> None:
+    queue = FairQueue(1)
+    order: List[str] = []
+    gate = asyncio.Event()
+
+    async def run(sid: str, name: str) -> None:
+        async with queue.acquire(sid):
+            order.append(name)
+            await gate.wait()
+
+    first = asyncio.create_task(run("a", "a0"))
+    await asyncio.sleep(0)
+    tasks = [
+        asyncio.create_task(run(sid, name))
+        for sid, name in [("a", "a1"), ("a", "a2"), ("b", "b1"), ("c", "c1")]
+    ]
+    await asyncio.sleep(0)
+    assert queue.running == 1
+    assert queue.depth == 4
+    assert queue.ahead("b") == 4
+    gate.set()
+    await asyncio.gather(first, *tasks)
+    assert order == ["a0", "a1", "b1", "c1", "a2"]
+    assert queue.running == 0
+    assert queue.depth == 0
+    assert queue.ahead("a") is None
+
+
+async def test_same_session_runs_in_order() -> None:
+    queue = FairQueue(4)
+    active: List[str] = []
+    order: List[int] = []
+
+    async def run(i: int) -> None:
+        async with queue.acquire("a"):
+            assert not active
+            active.append("a")
+            order.append(i)
+            await asyncio.sleep(0)
+            active.pop()
+
+    await asyncio.gather(*(run(i) for i in range(5)))
+    assert order == list(range(5))
+
+
+async def test_cancelled_waiter_leaves_queue() -> None:
+    queue = FairQueue(1)
+    gate = asyncio.Event()
+    order: List[str] = []
+
+    async def run(sid: str) -> None:
+        async with queue.acquire(sid):
+            order.append(sid)
+            await gate.wait()
+
+    holder = asyncio.create_task(run("a"))
+    await asyncio.sleep(0)
+    waiter = asyncio.create_task(run("b"))
+    other = asyncio.create_task(run("c"))
+    await asyncio.sleep(0)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert queue.depth == 1
+    gate.set()
+    await asyncio.gather(holder, other)
+    assert order == ["a", "c"]
+    assert queue.running == 0
+
+
+async def test_cancel_after_dispatch_releases_slot() -> None:
+    queue = FairQueue(1)
+    holder_done = asyncio.Event()
+
+    async def hold() -> None:
+        async with queue.acquire("a"):
+            await holder_done.wait()
+
+    holder = asyncio.create_task(hold())
+    await asyncio.sleep(0)
+    waiter = asyncio.create_task(hold())
+    await asyncio.sleep(0)
+    # 许可已经交给 waiter，但 waiter 还没有恢复运行时被取消
+    holder_done.set()
+    await asyncio.sleep(0)
+    assert holder.done()
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert queue.running == 0
+    assert not queue.busy
+    async with queue.acquire("b"):
+        pass
+
+
+async def test_single_flight_coalesces() -> None:
+    flight: SingleFlight[int] = SingleFlight()
+    calls = 0
+
+    async def work() -> int:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return 42
+
+    results = await asyncio.gather(*(flight.run("k", work) for _ in range(3)))
+    assert calls == 1
+    assert sorted(results) == [(42, False), (42, False), (42, True)]
+    assert len(flight) == 0
+
+
+async def test_single_flight_shares_errors() -> None:
+    flight: SingleFlight[int] = SingleFlight()
+
+    async def fail() -> int:
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    results = await asyncio.gather(
+        flight.run("k", fail), flight.run("k", fail), return_exceptions=True
+    )
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len(flight) == 0
+
+
+async def test_follower_takes_over_cancelled_leader() -> None:
+    flight: SingleFlight[str] = SingleFlight()
+    started = asyncio.Event()
+
+    async def slow() -> str:
+        started.set()
+        await asyncio.sleep(10)
+        return "leader"
+
+    async def fast() -> str:
+        return "follower"
+
+    leader = asyncio.create_task(flight.run("k", slow))
+    await started.wait()
+    follower = asyncio.create_task(flight.run("k", fast))
+    await asyncio.sleep(0)
+    leader.cancel()
+    assert await follower == ("follower", True)
+    with pytest.raises(asyncio.CancelledError):
+        await leader
+
+
+async def test_cancelled_follower_does_not_affect_leader() -> None:
+    flight: SingleFlight[str] = SingleFlight()
+
+    async def work() -> str:
+        await asyncio.sleep(0.01)
+        return "done"
+
+    leader = asyncio.create_task(flight.run("k", work))
+    await asyncio.sleep(0)
+    follower = asyncio.create_task(flight.run("k", work))
+    await asyncio.sleep(0)
+    follower.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await follower
+    assert await leader == ("done", True)
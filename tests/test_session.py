@@ -0,0 +1,133 @@
+import asyncio
+import time
+from pathlib import Path
+from typing import Callable, Iterator
+
+import pytest
+from nonebot.adapters.onebot.v11 import MessageEvent
+
+from nonebot_plugin_chatgpt.storage import JsonStorage, SqliteStorage
+from nonebot_plugin_chatgpt.utils import Session
+
+MakeEvent = Callable[..., MessageEvent]
+
+
+@pytest.fixture
+def sqlite(tmp_path: Path) -> Iterator[SqliteStorage]:
+    storage = SqliteStorage(tmp_path / "session.db", max_history=10)
+    yield storage
+    storage.close()
+
+
+def expire(session: Session, event: MessageEvent) -> None:
+    session.entries[session.id(event)].last_used = time.monotonic() - session.ttl - 1
+
+
+async def test_json_session_without_limit_keeps_everything(make_event: MakeEvent) -> None:
+    session = Session("private", JsonStorage())
+    for user_id in range(5):
+        await session.push(make_event(user_id), ("c", f"p{user_id}"))
+    assert len(session) == 5
+    assert session.sweep() == 0
+    assert list(await session.load(make_event(0))) == [("c", "p0", None)]
+
+
+async def test_json_session_lru(make_event: MakeEvent) -> None:
+    session = Session("private", JsonStorage(), limit=2)
+    a, b, c = make_event(1), make_event(2), make_event(3)
+    await session.push(a, ("c", "a", "acct"))
+    await session.push(b, ("c", "b"))
+    # 访问 a 之后 b 成为最久未使用的会话
+    assert await session.count(a) == 1
+    await session.push(c, ("c", "c"))
+    assert list(session.entries) == [session.id(a), session.id(c)]
+    # 只保存在内存中，被淘汰的会话无法恢复
+    assert await session.count(b) == 0
+    assert list(await session.load(a)) == [("c", "a", "acct")]
+
+
+async def test_json_session_ttl(make_event: MakeEvent) -> None:
+    session = Session("private", JsonStorage(), ttl=60)
+    a, b = make_event(1), make_event(2)
+    await session.push(a, ("c", "a"))
+    await session.push(b, ("c", "b"))
+    expire(session, a)
+    assert session.sweep() == 1
+    assert await session.count(a) == 0
+    assert await session.count(b) == 1
+
+
+async def test_sqlite_session_reloads_evicted_entries(
+    sqlite: SqliteStorage, make_event: MakeEvent
+) -> None:
+    session = Session("private", sqlite, limit=2, ttl=60)
+    a, b, c = make_event(1), make_event(2), make_event(3)
+    await session.push(a, ("c", "a1", "acct"))
+    await session.push(a, {"conversation_id": "c", "parent_id": "a2"})
+    await session.push(b, ("c", "b"))
+    await session.push(c, ("c", "c"))
+    assert session.id(a) not in session.entries
+    assert list(await session.load(a)) == [("c", "a1", "acct"), ("c", "a2", None)]
+    assert len(session) == 2
+    expire(session, c)
+    assert session.sweep() == 1
+    assert list(await session.load(c)) == [("c", "c", None)]
+
+
+async def test_sqlite_session_defaults_to_bounded(sqlite: SqliteStorage) -> None:
+    session = Session("private", sqlite)
+    assert session.limit > 0
+    assert session.ttl > 0
+
+
+async def test_sqlite_session_pop_and_clear(
+    sqlite: SqliteStorage, make_event: MakeEvent
+) -> None:
+    session = Session("private", sqlite, limit=1)
+    a = make_event(1)
+    for n in range(3):
+        await session.push(a, ("c", f"p{n}"))
+    assert await session.pop(a) == ("c", "p2", None)
+    # 淘汰后重新读取的记录中不再包含弹出的记录
+    await session.push(make_event(2), ("c", "x"))
+    assert [item[1] for item in await session.load(a)] == ["p0", "p1"]
+    await session.clear(a)
+    assert await session.count(a) == 0
+    session.entries.clear()
+    assert await session.count(a) == 0
+
+
+async def test_concurrent_pushes_to_new_session(
+    sqlite: SqliteStorage, make_event: MakeEvent
+) -> None:
+    session = Session("private", sqlite)
+    a = make_event(1)
+    await asyncio.gather(*(session.push(a, ("c", f"p{n}")) for n in range(5)))
+    assert await session.count(a) == 5
+    session.entries.clear()
+    assert await session.count(a) == 5
+
+
+async def test_shared_storage_is_not_cached(tmp_path: Path, make_event: MakeEvent) -> None:
+    path = tmp_path / "shared.db"
+    storages = [SqliteStorage(path, max_history=10, shared=True) for _ in range(2)]
+    first, second = (Session("public", storage) for storage in storages)
+    try:
+        await first.push(make_event(1, 10), ("c", "p1"))
+        await second.push(make_event(2, 10), ("c", "p2"))
+        assert len(first) == len(second) == 0
+        assert [item[1] for item in await first.load(make_event(3, 10))] == ["p1", "p2"]
+        assert await second.count(make_event(1, 20)) == 0
+    finally:
+        for storage in storages:
+            storage.close()
+
+
+async def test_saved_sessions(sqlite: SqliteStorage, make_event: MakeEvent) -> None:
+    session = Session("private", sqlite)
+    a = make_event(1)
+    await session.push(a, ("c", "p", "acct"))
+    await session.save("work", a)
+    assert await session.find(a) == {
+        "work": {"conversation_id": "c", "parent_id": "p", "account": "acct"}
+    }
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from nonebot_plugin_chatgpt.stream import EventStreamParser
+
+
+def frame(text: str, **event) -> str:
+    message = {
+        "id": "m1",
+        "author": {"role": "assistant"},
+        "content": {"parts": [text]},
+    }
+    return "data: " + json.dumps({"message": message, "conversation_id": "c1", **event}) + "\n\n"
+
+
+STREAM = frame("你") + frame("你好") + frame("你好，世界") + "data: [DONE]\n\n"
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 64, len(STREAM)])
+def test_chunking_does_not_change_deltas(size: int) -> None:
+    parser = EventStreamParser()
+    deltas = []
+    for i in range(0, len(STREAM), size):
+        deltas += parser.feed(STREAM[i : i + size])
+    deltas += parser.close()
+    assert deltas == ["你", "好", "，世界"]
+    assert parser.text == "你好，世界"
+    assert parser.message_id == "m1"
+    assert parser.conversation_id == "c1"
+    assert parser.done
+
+
+def test_crlf_and_unterminated_last_line() -> None:
+    parser = EventStreamParser()
+    assert parser.feed(frame("a").replace("\n", "\r\n")) == ["a"]
+    assert parser.feed(frame("ab").rstrip("\n")) == []
+    assert parser.close() == ["b"]
+
+
+def test_ignores_other_roles_and_garbage() -> None:
+    parser = EventStreamParser()
+    user = frame("问题").replace('"assistant"', '"user"')
+    assert parser.feed(": ping\n" + "data: {oops\n" + "data: 1\n" + user) == []
+    assert parser.feed(frame("回答")) == ["回答"]
+
+
+def test_rewritten_reply_yields_no_delta() -> None:
+    parser = EventStreamParser()
+    assert parser.feed(frame("abc")) == ["abc"]
+    assert parser.feed(frame("xyz")) == []
+    assert parser.feed(frame("xyz!")) == ["!"]
+
+
+def test_error_event() -> None:
+    parser = EventStreamParser()
+    parser.feed('data: {"message": null, "error": "Too many requests"}\n')
+    assert parser.error == "Too many requests"
+    assert not parser.done